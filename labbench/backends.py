@@ -25,7 +25,9 @@
 # licenses.
 
 from . import core, util
-from collections import OrderedDict
+import asyncio
+from collections import deque, OrderedDict
+from concurrent.futures import Future
 import contextlib
 import inspect
 import numpy as np
@@ -36,10 +38,15 @@ import re
 import socket
 import select
 import sys
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 import warnings
 
-__all__ = ['CommandLineWrapper',
+__all__ = ['AsyncLabviewSocketInterface',
+           'AsyncSerialDevice',
+           'AsyncStreamDevice',
+           'AsyncTelnetDevice',
+           'AsyncVISADevice',
+           'CommandLineWrapper',
            'DotNetDevice',
            'EmulatedVISADevice',
            'LabviewSocketInterface',
@@ -450,6 +457,10 @@ class DotNetDevice(core.Device):
         * `backend` may be set by a subclass `connect` method (otherwise it is left as None)
 
     """
+    class settings(core.Device.settings):
+        thread_affinity = core.Bool(default_value=True, read_only=True,
+                                    help='Whether calls in concurrently threads need to run in one dedicated thread for this device')
+
     library = None  # Must be a module
     dll_name = None
     _dlls = {}
@@ -587,6 +598,11 @@ class LabviewSocketInterface(core.Device):
         rx, addr = self.backend['rx'].recvfrom(self.settings.rx_buffer_size)
         if addr is None:
             raise Exception('received no data')
+        return self._parse_read(rx, convert_func)
+
+    def _parse_read(self, rx, convert_func=None):
+        """ Parse a received 'prefix: key value' message into `{key: value}`.
+        """
         rx_disp = rx[:min(80, len(rx))] + ('...' if len(rx) > 80 else '')
         self.logger.debug(f'read {repr(rx_disp)}')
 
@@ -669,6 +685,20 @@ class SerialDevice(core.Device):
         self.backend.close()
         self.logger.debug(f'{repr(self)} disconnected')
 
+    def __cancel_io__(self):
+        """ Close the serial port to interrupt blocking reads and writes
+            when a call to this device in `concurrently` is cancelled. The
+            device is disconnected.
+        """
+        if not self.state.connected:
+            return
+        backend, self.backend = self.backend, core.DisconnectedBackend(self)
+        try:
+            backend.close()
+        except Exception as e:
+            self.logger.warning('unhandled error closing on cancel: ' + str(e))
+        self.state.clear_cache()
+
     @classmethod
     def from_hwid(cls, hwid=None, *args, **connection_params):
         """ Instantiate a new SerialDevice from a `hwid' resource instead
@@ -870,6 +900,20 @@ class TelnetDevice(core.Device):
         """
         self.backend.close()
 
+    def __cancel_io__(self):
+        """ Close the telnet connection to interrupt blocking reads and writes
+            when a call to this device in `concurrently` is cancelled. The
+            device is disconnected.
+        """
+        if not self.state.connected:
+            return
+        backend, self.backend = self.backend, core.DisconnectedBackend(self)
+        try:
+            backend.close()
+        except Exception as e:
+            self.logger.warning('unhandled error closing on cancel: ' + str(e))
+        self.state.clear_cache()
+
 
 class VISADevice(core.Device):
     r""" .. class:: VISADevice(resource, read_termination='\\n', write_termination='\\n')
@@ -908,8 +952,13 @@ class VISADevice(core.Device):
                                         help='termination character to indicate end of message on receive from the instrument')
         write_termination = core.Unicode('\n', read_only='connected',
                                          help='termination character to indicate end of message in messages sent to the instrument')
+        async_depth = core.Int(8, min=1,
+                               help='the most queries from query_async to send ahead before reading their replies, to stay within the input buffer of the instrument')
 
     __opc = False  # Whether or not to append ;*OPC to each call to write()
+    __io_queue = None  # Requests from query_async waiting for the I/O worker
+    __io_thread = None
+    __io_start_lock = Lock()  # Guards the start of I/O workers for all instances
     _rm = None
 
     @classmethod
@@ -969,6 +1018,7 @@ class VISADevice(core.Device):
             :returns: None
         """
         try:
+            self.__stop_io_worker()
             with contextlib.suppress(pyvisa.errors.VisaIOError):
                 self.__release_remote_control()
             with contextlib.suppress(pyvisa.Error):
@@ -978,6 +1028,25 @@ class VISADevice(core.Device):
         finally:
             self.backend.close()
 
+    def __cancel_io__(self):
+        """ Close the VISA session to interrupt blocking I/O when a call to
+            this device in `concurrently` is cancelled. The device is
+            disconnected.
+        """
+        if not self.state.connected:
+            return
+        backend, self.backend = self.backend, core.DisconnectedBackend(self)
+        try:
+            backend.close()
+        except Exception as e:
+            self.logger.warning('unhandled error closing on cancel: ' + str(e))
+
+        # The I/O worker finishes once queries in progress fail
+        if self.__io_queue is not None:
+            self.__io_queue.put((None, None))
+            self.__io_queue = self.__io_thread = None
+        self.state.clear_cache()
+
     @classmethod
     def set_backend(cls, backend_name):
         """ Set the pyvisa resource manager for all VISA objects.
@@ -1003,11 +1072,13 @@ class VISADevice(core.Device):
             :param str msg: the SCPI command to send by VISA
             :returns: None
         """
+        self.__wait_io_worker()
         if self.__opc:
             msg = msg + ';*OPC'
         msg_out = repr(msg) if len(msg) < 1024 else f'({len(msg)} bytes)'
         self.logger.debug(f'write {repr(msg_out)}')
         self.backend.write(msg)
+        self._check_reset(msg)
 
     def query(self, msg, timeout=None):
         """ Query an SCPI command to the device with pyvisa,
@@ -1019,6 +1090,7 @@ class VISADevice(core.Device):
             :param str msg: the SCPI command to send by VISA
             :returns: the response to the query from the device
         """
+        self.__wait_io_worker()
         if timeout is not None:
             _to, self.backend.timeout = self.backend.timeout, timeout
         msg_out = repr(msg) if len(msg) < 80 else f'({len(msg)} bytes)'
@@ -1028,10 +1100,190 @@ class VISADevice(core.Device):
         finally:
             if timeout is not None:
                 self.backend.timeout = _to
+        self._check_reset(msg)
         msg_out = repr(ret) if len(ret) < 80 else f'({len(msg)} bytes)'
         self.logger.debug(f'      -> {msg_out}')
         return ret
 
+    def query_binary(self, msg, dtype='float32', into=None, expect_termination=True):
+        """ Query an SCPI command that responds with an IEEE 488.2 binary
+            block, '#<n><length><data>' (or '#0<data>' of indefinite length),
+            and return the data as a numpy array, without decoding it as text.
+
+            Unless `into` is given, the array is a read-only view of the bytes
+            received from the backend.
+
+            :param str msg: the SCPI command to send by VISA
+            :param dtype: numpy data type of the values in the block (including the byte order, as in '>f4', if it is not native)
+            :param into: a preallocated numpy array to fill with the values, or None to return a new array
+            :param expect_termination: whether the instrument sends `settings.read_termination` after a definite-length block
+            :returns: numpy array of the values (a view into `into`, if it is given)
+        """
+        dtype = np.dtype(dtype)
+        self.__wait_io_worker()
+        self.logger.debug(f'query_binary {repr(msg)}')
+        self.backend.write(msg)
+
+        term = self.settings.read_termination.encode()
+        header = self.backend.read_bytes(2)
+        if header[:1] != b'#' or not header[1:2].isdigit():
+            raise ValueError(f'expected a binary block, but received {repr(header)}')
+        digits = int(header[1:2])
+
+        if digits == 0:
+            data = self.backend.read_raw()
+            if term and data.endswith(term):
+                data = data[:-len(term)]
+        else:
+            data = self.backend.read_bytes(int(self.backend.read_bytes(digits)))
+            if expect_termination and term:
+                self.backend.read_bytes(len(term))
+        self.logger.debug(f'      -> ({len(data)} bytes)')
+        return self._binary_values(data, dtype, into)
+
+    @staticmethod
+    def _binary_values(data, dtype, into=None):
+        """ Interpret the bytes of a binary block as an array of values for
+            :func:`query_binary`.
+        """
+        if len(data) % dtype.itemsize != 0:
+            raise ValueError(f'received {len(data)} bytes, which is not a whole number of {dtype} values')
+        values = np.frombuffer(data, dtype=dtype)
+
+        if into is None:
+            return values
+        elif into.size < values.size:
+            raise ValueError(f'`into` has room for {into.size} values, but received {values.size}')
+        out = into.reshape(-1)[:values.size]
+        out[:] = values
+        return out
+
+    def write_binary(self, msg, values):
+        """ Write an SCPI command followed by an array of values as an
+            IEEE 488.2 definite-length binary block, '#<n><length><data>'.
+
+            :param str msg: the SCPI command, including any separator before the block (such as a trailing space)
+            :param values: numpy array of values, sent with their own data type and byte order
+            :returns: None
+        """
+        self.__wait_io_worker()
+        data = np.ascontiguousarray(values).tobytes()
+        length = str(len(data))
+        self.logger.debug(f'write_binary {repr(msg)} ({len(data)} bytes)')
+        self.backend.write_raw(msg.encode() + f'#{len(length)}{length}'.encode() + data
+                               + self.settings.write_termination.encode())
+
+    def query_async(self, msg):
+        """ Send an SCPI query to the device from a background I/O worker, and
+            return a future for the response without waiting for it. For example::
+
+                futures = [inst.query_async(f'TRAC{i}?') for i in range(1, 5)]
+                # ... do something else while the instrument responds ...
+                traces = [f.result() for f in futures]
+
+            The worker writes up to `settings.async_depth` queries ahead before
+            reading their replies, which are matched to the queries in order.
+            Calls to :func:`write` and :func:`query` wait for the queries from
+            :func:`query_async` to finish first.
+
+            :param str msg: the SCPI command to send by VISA
+            :returns: a `concurrent.futures.Future` that resolves to the response string
+        """
+        # Start the I/O worker on the first call, guarding against another
+        # thread starting a second one for the same device at the same time
+        with self.__io_start_lock:
+            if self.__io_queue is None:
+                self.__io_queue = Queue()
+                self.__io_thread = Thread(target=self.__io_worker, args=(self.__io_queue,),
+                                          name=f'{self} I/O', daemon=True)
+                self.__io_thread.start()
+            queue = self.__io_queue
+
+        future = Future()
+        queue.put((msg, future))
+        return future
+
+    def __io_worker(self, queue):
+        """ Write queries from :func:`query_async` and read their replies, with
+            up to `settings.async_depth` queries in flight.
+        """
+        depth = self.settings.async_depth
+        inflight = deque()
+        held = None
+        stopping = False
+
+        while True:
+            # Take the next request, blocking only if there are no replies to read
+            if held is None and not stopping:
+                try:
+                    held = queue.get(block=len(inflight) == 0)
+                except Empty:
+                    pass
+                else:
+                    if held[0] is None:
+                        stopping, held = True, None
+                        queue.task_done()
+
+            # Write ahead while there is room for another query in flight
+            if held is not None and len(inflight) < depth:
+                (msg, future), held = held, None
+                if not future.set_running_or_notify_cancel():
+                    queue.task_done()
+                    continue
+                msg_out = repr(msg) if len(msg) < 80 else f'({len(msg)} bytes)'
+                self.logger.debug(f'query_async {repr(msg_out)}')
+                try:
+                    self.backend.write(msg)
+                except BaseException as e:
+                    future.set_exception(e)
+                    queue.task_done()
+                else:
+                    # Only now does the device have the '*RST', so a cached value
+                    # from a get in the meantime is out of date
+                    self._check_reset(msg)
+                    inflight.append(future)
+                continue
+
+            if len(inflight) == 0:
+                if stopping:
+                    return
+                continue
+
+            # Otherwise, read the reply to the oldest query in flight
+            future = inflight.popleft()
+            try:
+                ret = self.backend.read()
+            except BaseException as e:
+                # Later replies can no longer be matched to their queries
+                for f in [future] + list(inflight):
+                    f.set_exception(e)
+                    queue.task_done()
+                inflight.clear()
+            else:
+                future.set_result(ret)
+                queue.task_done()
+
+    def __wait_io_worker(self):
+        """ Block until the I/O worker has finished all queries from :func:`query_async`.
+        """
+        if self.__io_queue is not None:
+            self.__io_queue.join()
+
+    def __stop_io_worker(self):
+        """ Finish the queries from :func:`query_async`, and stop the I/O worker.
+        """
+        if self.__io_queue is not None:
+            self.__io_queue.put((None, None))
+            self.__io_thread.join()
+            self.__io_queue = self.__io_thread = None
+
+    def _check_reset(self, msg):
+        """ Invalidate cached state values if `msg` includes '\\*RST',
+            which returns the device to its default state.
+        """
+        if '*RST' in msg.upper():
+            self.state.clear_cache()
+
     def __get_state__(self, trait):
         """ Send an SCPI command to get a state value from the
             device. This function
@@ -1042,6 +1294,8 @@ class VISADevice(core.Device):
             :param str command: The SCPI command to send
             :param trait: The trait state corresponding with the command (ignored)
         """
+        if isinstance(trait, core.Array):
+            return self.query_binary(trait.command + '?', trait.dtype)
         return self.query(trait.command + '?').rstrip()
 
     def __set_state__(self, trait, value):
@@ -1054,7 +1308,67 @@ class VISADevice(core.Device):
             :param trait: The trait state corresponding with the command (ignored)
             :param str value: The value to assign to the parameter
         """
-        self.write(trait.command + ' ' + str(value))
+        if isinstance(trait, core.Array):
+            self.write_binary(trait.command + ' ', value)
+        else:
+            self.write(trait.command + ' ' + str(value))
+
+    def __get_states__(self, traits):
+        """ Get several state values from the device with one query that
+            joins their SCPI commands with ';', such as 'CMD1?;:CMD2?'. The
+            response is split at each ';' into the values. This is applied to
+            traits that use :func:`__get_state__`; others are queried with their
+            own getters.
+
+            :param traits: list of state traits
+            :returns: list of the values retrieved from the device
+        """
+        joined = [t for t in traits if t.metadata['getter'] is VISADevice.__get_state__
+                  and not isinstance(t, core.Array)]
+        values = {}
+
+        if len(joined) > 1:
+            reply = self.query(self.__join_commands([t.command + '?' for t in joined])).rstrip()
+            replies = reply.split(';')
+            if len(replies) == len(joined):
+                values = dict(zip(joined, [r.rstrip() for r in replies]))
+            else:
+                self.logger.debug(f'expected {len(joined)} values, but received {len(replies)}; '
+                                  f'querying each one separately')
+
+        return [values[t] if t in values else t.metadata['getter'](self, t)
+                for t in traits]
+
+    def __set_states__(self, items):
+        """ Set several state values on the device, joining the SCPI commands
+            of consecutive traits that use :func:`__set_state__` into one write,
+            such as 'CMD1 value1;:CMD2 value2'. Others are set with their own
+            setters, in order.
+
+            :param items: list of (trait, value) pairs, in the order they were set
+        """
+        pending = []
+        for trait, value in items:
+            if trait.metadata['setter'] is VISADevice.__set_state__\
+                    and not isinstance(trait, core.Array):
+                pending.append(trait.command + ' ' + str(value))
+                continue
+            if pending:
+                self.write(self.__join_commands(pending))
+                pending = []
+            trait.metadata['setter'](self, trait, value)
+
+        if pending:
+            self.write(self.__join_commands(pending))
+
+    @staticmethod
+    def __join_commands(commands):
+        """ Join SCPI commands with ';' into a single message. Commands after
+            the first are prefixed with ':' (unless they are common '*' commands)
+            so that each one starts from the root of the command tree.
+        """
+        return ';'.join([commands[0]] + [c if c.startswith((':', '*')) else ':' + c
+                                         for c in commands[1:]])
 
     def wait(self):
         """ Convenience function to send standard SCPI '\\*WAI'
@@ -1072,7 +1386,9 @@ class VISADevice(core.Device):
             VISA commands written while in this context. At the end
             of the block, wait until the instrument confirms that all
             operations have finished. This is the standard VISA ';\\*OPC'
-            and '\\*OPC?' behavior.
+            and '\\*OPC?' behavior. Queries from :func:`query_async` are
+            not modified; they are finished before the single '\\*OPC?'
+            that ends the block.
 
             This is meant to be used in `with` blocks as follows::
 
@@ -1125,9 +1441,12 @@ class EmulatedVISADevice(core.Device):
     """ Act as a VISA device without dispatching any visa commands
     """
 
-    generators = {core.Bool: lambda trait: str(np.random.choice(trait._trues + trait._falses)),
+    generators = {core.Bool: lambda trait: [trait.remap.get(False, False), trait.remap.get(True, True)][np.random.randint(2)],
                   core.Bytes: lambda trait: 'text',
-                  core.Float: lambda trait: str(np.random.uniform(low=trait.min, high=trait.max)), }
+                  core.Float: lambda trait: str(np.random.uniform(low=trait.min, high=trait.max)),
+                  core.Int: lambda trait: str(np.random.randint(low=trait.min, high=trait.max)),
+                  core.Unicode: lambda trait: 'text',
+                  core.Array: lambda trait: np.random.uniform(size=1001).astype(trait.dtype), }
 
     class state(VISADevice.state):
         pass
@@ -1218,3 +1537,415 @@ class Win32ComDevice(core.Device):
 
     def disconnect(self):
         pass
+
+
+class AsyncStreamDevice(core.AsyncDevice):
+    """ Base class for devices that communicate through an asyncio stream
+        (a `(reader, writer)` pair) in an event loop, so that many devices
+        can be driven from one thread without blocking it. The writer is
+        assigned to `self.backend`.
+
+        Subclasses implement :func:`_open_stream` to open the connection, and
+        define `read_termination`, `write_termination`, and `timeout` in
+        `settings`. The stream is opened only by :func:`aconnect` (or `async with`),
+        not by the blocking `connect`.
+
+        Blocking calls to :func:`write`, :func:`read`, and :func:`query` from
+        another thread (such as the executor that runs custom getters and
+        setters for `state.aget` and `state.aset`) are passed to the event loop.
+    """
+
+    _reader = None
+    _io_lock = None
+
+    async def _open_stream(self):
+        """ Open the connection, returning the `(reader, writer)` pair.
+        """
+        raise NotImplementedError
+
+    async def aconnect(self):
+        """ Open the stream to the device in the running event loop.
+        """
+        if self.state.connected:
+            self.logger.debug(f'{repr(self)} already connected')
+            return
+        self._loop = asyncio.get_running_loop()
+        self._io_lock = asyncio.Lock()
+        self._reader, self.backend = await asyncio.wait_for(self._open_stream(),
+                                                            self.settings.timeout)
+        self.state.connected
+        self.logger.debug(f'{repr(self)} connected')
+
+    async def adisconnect(self):
+        """ Close the stream to the device.
+        """
+        if not self.state.connected:
+            self.logger.debug(f'{repr(self)} already disconnected')
+            return
+        writer = self.backend
+        self.backend = core.DisconnectedBackend(self)
+        writer.close()
+        with contextlib.suppress(OSError):
+            await writer.wait_closed()
+        self.state.connected
+        self.state.clear_cache()
+        self.logger.debug(f'{repr(self)} disconnected')
+
+    def __connect_wrapper__(self, *args, **kws):
+        raise core.ConnectionError(f'{repr(self)} connects in an event loop, with '
+                                   f'`async with` or `await device.aconnect()`')
+
+    def __disconnect_wrapper__(self, *args, **kws):
+        if not self.state.connected:
+            return
+        writer = self.backend
+        self.backend = core.DisconnectedBackend(self)
+        self.state.clear_cache()
+        with contextlib.suppress(RuntimeError):
+            self._loop.call_soon_threadsafe(writer.close)
+
+    @staticmethod
+    def _encode(msg, termination):
+        if isinstance(msg, str):
+            msg = msg.encode()
+        if isinstance(termination, str):
+            termination = termination.encode()
+        return msg + termination
+
+    async def _awrite(self, msg):
+        self.backend.write(self._encode(msg, self.settings.write_termination))
+        await self.backend.drain()
+
+    async def _aread(self):
+        term = self._encode(b'', self.settings.read_termination)
+        ret = await self._reader.readuntil(term)
+        return ret[:-len(term)].decode()
+
+    async def awrite(self, msg):
+        """ Send a message to the device, followed by `settings.write_termination`.
+
+            :param str msg: the message to send
+            :returns: None
+        """
+        msg_out = repr(msg) if len(msg) < 1024 else f'({len(msg)} bytes)'
+        self.logger.debug(f'write {msg_out}')
+        async with self._io_lock:
+            await asyncio.wait_for(self._awrite(msg), self.settings.timeout)
+
+    async def aread(self):
+        """ Receive a message from the device, up to `settings.read_termination`.
+
+            :returns: the message (without the termination)
+        """
+        async with self._io_lock:
+            ret = await asyncio.wait_for(self._aread(), self.settings.timeout)
+        msg_out = repr(ret) if len(ret) < 80 else f'({len(ret)} bytes)'
+        self.logger.debug(f'read {msg_out}')
+        return ret
+
+    async def aquery(self, msg):
+        """ Send a message to the device, and receive the response. Other tasks
+            that use the device wait until the response is received.
+
+            :param str msg: the message to send
+            :returns: the response (without the termination)
+        """
+        msg_out = repr(msg) if len(msg) < 80 else f'({len(msg)} bytes)'
+        self.logger.debug(f'query {msg_out}')
+
+        async def query():
+            await self._awrite(msg)
+            return await self._aread()
+
+        async with self._io_lock:
+            ret = await asyncio.wait_for(query(), self.settings.timeout)
+        msg_out = repr(ret) if len(ret) < 80 else f'({len(ret)} bytes)'
+        self.logger.debug(f'      -> {msg_out}')
+        return ret
+
+    def write(self, msg):
+        """ Blocking :func:`awrite`, for use outside the event loop.
+        """
+        return self._call_in_loop(self.awrite(msg))
+
+    def read(self):
+        """ Blocking :func:`aread`, for use outside the event loop.
+        """
+        return self._call_in_loop(self.aread())
+
+    def query(self, msg):
+        """ Blocking :func:`aquery`, for use outside the event loop.
+        """
+        return self._call_in_loop(self.aquery(msg))
+
+
+class AsyncVISADevice(AsyncStreamDevice, VISADevice):
+    r""" A :class:`VISADevice` for raw TCP/IP socket connections, such as
+        'TCPIP0::192.168.1.2::5025::SOCKET', with native asyncio I/O in place of
+        pyvisa. For example, to get the identity of many instruments at once
+        in one thread::
+
+            async def identify(resource):
+                async with AsyncVISADevice(resource) as inst:
+                    return await inst.state.aget('identity')
+
+            ids = await lb.async_concurrently(**{r: identify(r) for r in resources})
+
+        State traits with a `command` are queried and set with SCPI messages
+        through :func:`aquery` and :func:`awrite`. The blocking methods of
+        :class:`VISADevice` (such as :func:`query_binary` and :func:`query_async`)
+        pass their I/O to the event loop, for use from other threads.
+    """
+
+    class settings(VISADevice.settings):
+        timeout = core.Float(2, min=0,
+                             help='maximum time to wait for a connection or a response before raising TimeoutError')
+
+    @classmethod
+    def __imports__(cls):
+        pass
+
+    async def _open_stream(self):
+        match = re.match(r'^TCPIP\d*::([^:]+)::(\d+)::SOCKET$', self.settings.resource, re.IGNORECASE)
+        if match is None:
+            raise ValueError(f'AsyncVISADevice supports TCPIP SOCKET resources, like '
+                             f'"TCPIP0::192.168.1.2::5025::SOCKET", but got {repr(self.settings.resource)}')
+        return await asyncio.open_connection(match.group(1), int(match.group(2)))
+
+    async def awrite(self, msg):
+        """ Send an SCPI command to the device.
+
+            :param str msg: the SCPI command to send
+            :returns: None
+        """
+        await super().awrite(msg)
+        self._check_reset(msg)
+
+    async def aquery(self, msg):
+        """ Send an SCPI query to the device, and receive the response.
+
+            :param str msg: the SCPI command to send
+            :returns: the response from the device
+        """
+        ret = await super().aquery(msg)
+        self._check_reset(msg)
+        return ret
+
+    async def aquery_binary(self, msg, dtype='float32', into=None, expect_termination=True):
+        """ Query an SCPI command that responds with an IEEE 488.2 binary block,
+            like :func:`VISADevice.query_binary`.
+
+            :param str msg: the SCPI command to send
+            :param dtype: numpy data type of the values in the block
+            :param into: a preallocated numpy array to fill with the values, or None to return a new array
+            :param expect_termination: whether the instrument sends `settings.read_termination` after a definite-length block
+            :returns: numpy array of the values (a view into `into`, if it is given)
+        """
+        dtype = np.dtype(dtype)
+        term = self._encode(b'', self.settings.read_termination)
+        self.logger.debug(f'query_binary {repr(msg)}')
+
+        async def query():
+            await self._awrite(msg)
+            header = await self._reader.readexactly(2)
+            if header[:1] != b'#' or not header[1:2].isdigit():
+                raise ValueError(f'expected a binary block, but received {repr(header)}')
+            digits = int(header[1:2])
+            if digits == 0:
+                return (await self._reader.readuntil(term))[:-len(term)]
+            data = await self._reader.readexactly(int(await self._reader.readexactly(digits)))
+            if expect_termination and term:
+                await self._reader.readexactly(len(term))
+            return data
+
+        async with self._io_lock:
+            data = await asyncio.wait_for(query(), self.settings.timeout)
+        self.logger.debug(f'      -> ({len(data)} bytes)')
+        return self._binary_values(data, dtype, into)
+
+    async def awrite_binary(self, msg, values):
+        """ Write an SCPI command followed by an array of values as an
+            IEEE 488.2 definite-length binary block, like :func:`VISADevice.write_binary`.
+
+            :param str msg: the SCPI command, including any separator before the block
+            :param values: numpy array of values
+            :returns: None
+        """
+        data = np.ascontiguousarray(values).tobytes()
+        length = str(len(data))
+        self.logger.debug(f'write_binary {repr(msg)} ({len(data)} bytes)')
+        async with self._io_lock:
+            await asyncio.wait_for(self._awrite(msg.encode() + f'#{len(length)}{length}'.encode() + data),
+                                   self.settings.timeout)
+
+    def query_binary(self, msg, dtype='float32', into=None, expect_termination=True):
+        """ Blocking :func:`aquery_binary`, for use outside the event loop.
+        """
+        return self._call_in_loop(self.aquery_binary(msg, dtype, into, expect_termination))
+
+    def write_binary(self, msg, values):
+        """ Blocking :func:`awrite_binary`, for use outside the event loop.
+        """
+        return self._call_in_loop(self.awrite_binary(msg, values))
+
+    def query_async(self, msg):
+        """ Schedule :func:`aquery` in the event loop from another thread, and
+            return a future for the response without waiting for it. In the
+            event loop, use `asyncio.ensure_future(inst.aquery(msg))` instead.
+
+            :param str msg: the SCPI command to send
+            :returns: a `concurrent.futures.Future` that resolves to the response string
+        """
+        return self._submit_to_loop(self.aquery(msg))
+
+    def __cancel_io__(self):
+        """ Close the stream to interrupt I/O in progress when a call to this
+            device in `concurrently` is cancelled. The device is disconnected.
+        """
+        self.__disconnect_wrapper__()
+
+    async def __aget_state__(self, trait):
+        """ Send an SCPI query for a state value (see :func:`VISADevice.__get_state__`).
+        """
+        if isinstance(trait, core.Array):
+            return await self.aquery_binary(trait.command + '?', trait.dtype)
+        return (await self.aquery(trait.command + '?')).rstrip()
+
+    async def __aset_state__(self, trait, value):
+        """ Send an SCPI command to set a state value (see :func:`VISADevice.__set_state__`).
+        """
+        if isinstance(trait, core.Array):
+            await self.awrite_binary(trait.command + ' ', value)
+        else:
+            await self.awrite(trait.command + ' ' + str(value))
+
+
+class AsyncTelnetDevice(AsyncStreamDevice, TelnetDevice):
+    """ A :class:`TelnetDevice` with native asyncio I/O over a raw TCP
+        connection to `settings.resource` at `settings.port`. Telnet option
+        negotiation is not implemented, which suits the line-based command
+        interfaces of most instruments.
+    """
+
+    class settings(TelnetDevice.settings):
+        read_termination = core.Unicode('\n', read_only='connected',
+                                        help='termination character to indicate end of message on receive from the device')
+        write_termination = core.Unicode('\n', read_only='connected',
+                                         help='termination character to indicate end of message in messages sent to the device')
+
+    def __imports__(self):
+        pass
+
+    async def _open_stream(self):
+        return await asyncio.open_connection(self.settings.resource, self.settings.port)
+
+
+class AsyncSerialDevice(AsyncStreamDevice, SerialDevice):
+    """ A :class:`SerialDevice` with native asyncio I/O, which requires
+        the pyserial-asyncio package.
+    """
+
+    class settings(SerialDevice.settings):
+        read_termination = core.Bytes('\n', is_metadata=True,
+                                      help='Termination character to indicate end of message on receive.')
+
+    def __imports__(self):
+        global serial_asyncio
+        super().__imports__()
+        import serial_asyncio
+
+    async def _open_stream(self):
+        return await serial_asyncio.open_serial_connection(
+            url=self.settings.resource, baudrate=self.settings.baud_rate,
+            parity=self.settings.parity.decode(), stopbits=self.settings.stopbits,
+            xonxoff=self.settings.xonxoff, rtscts=self.settings.rtscts,
+            dsrdtr=self.settings.dsrdtr)
+
+
+class _DatagramQueue(asyncio.DatagramProtocol):
+    """ Put each datagram received by an asyncio endpoint into a queue.
+    """
+    def __init__(self, queue):
+        self.queue = queue
+
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait((data, addr))
+
+
+class AsyncLabviewSocketInterface(core.AsyncDevice, LabviewSocketInterface):
+    """ A :class:`LabviewSocketInterface` with native asyncio UDP endpoints
+        in place of blocking sockets. Datagrams received on `settings.rx_port`
+        are queued for :func:`aread`.
+    """
+
+    _rx_queue = None
+
+    async def aconnect(self):
+        """ Open the UDP endpoints in the running event loop.
+        """
+        if self.state.connected:
+            self.logger.debug(f'{repr(self)} already connected')
+            return
+        self._loop = asyncio.get_running_loop()
+        self._rx_queue = asyncio.Queue()
+        tx, _ = await self._loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, remote_addr=(self.settings.resource, self.settings.tx_port))
+        rx, _ = await self._loop.create_datagram_endpoint(
+            lambda: _DatagramQueue(self._rx_queue),
+            local_addr=(self.settings.resource, self.settings.rx_port))
+        self.backend = {'tx': tx, 'rx': rx}
+        self.state.connected
+
+    async def adisconnect(self):
+        """ Close the UDP endpoints.
+        """
+        self.__disconnect_wrapper__()
+
+    def __connect_wrapper__(self, *args, **kws):
+        raise core.ConnectionError(f'{repr(self)} connects in an event loop, with '
+                                   f'`async with` or `await device.aconnect()`')
+
+    def __disconnect_wrapper__(self, *args, **kws):
+        if not self.state.connected:
+            return
+        transports = self.backend.values()
+        self.backend = core.DisconnectedBackend(self)
+        self.state.clear_cache()
+        for transport in transports:
+            with contextlib.suppress(RuntimeError):
+                self._loop.call_soon_threadsafe(transport.close)
+
+    async def awrite(self, msg):
+        """ Send a message over the tx endpoint, and wait `settings.delay`.
+        """
+        self.logger.debug(f'write {repr(msg)}')
+        self.backend['tx'].sendto(msg.encode() if isinstance(msg, str) else msg)
+        await asyncio.sleep(self.settings.delay)
+
+    async def aread(self, convert_func=None):
+        """ Receive a message from the rx endpoint, waiting up to `settings.timeout`
+            (see :func:`LabviewSocketInterface.read`).
+        """
+        rx, addr = await asyncio.wait_for(self._rx_queue.get(), self.settings.timeout)
+        return self._parse_read(rx.decode(), convert_func)
+
+    def write(self, msg):
+        """ Blocking :func:`awrite`, for use outside the event loop.
+        """
+        return self._call_in_loop(self.awrite(msg))
+
+    def read(self, convert_func=None):
+        """ Blocking :func:`aread`, for use outside the event loop.
+        """
+        return self._call_in_loop(self.aread(convert_func))
+
+    def clear(self):
+        """ Discard any received messages that have not been read.
+        """
+        while not self._rx_queue.empty():
+            self._rx_queue.get_nowait()
+
+    async def __aset_state__(self, trait, value):
+        """ Send a formatted command string to implement state control.
+        """
+        await self.awrite(f'{trait.command} {value} ')
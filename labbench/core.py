@@ -34,13 +34,17 @@ reverse-engineering this code.
 from . import util
 
 from collections import OrderedDict
+import asyncio
+import contextlib
 from textwrap import dedent
 
 import traitlets
 import inspect
 import logging
+import numpy as np
 import copy
 import sys
+import time
 import traceback
 import warnings
 from traitlets import All, Undefined, TraitType
@@ -49,8 +53,8 @@ __all__ = ['ConnectionError', 'DeviceException', 'DeviceNotReady', 'DeviceFatalE
            'DeviceConnectionLost', 'Undefined', 'All', 'DeviceStateError',
            'UnimplementedState', 'setter', 'getter',
            'Int', 'Float', 'Unicode', 'Complex', 'Bytes', 'CaselessBytesEnum',
-           'Bool', 'List', 'Dict', 'TCPAddress',
-           'CaselessStrEnum', 'Device', 'list_devices', 'logger', 'CommandNotImplementedError',
+           'Bool', 'List', 'Dict', 'TCPAddress', 'Array',
+           'CaselessStrEnum', 'Device', 'AsyncDevice', 'list_devices', 'logger', 'CommandNotImplementedError',
            ]
 
 logger = logging.getLogger('labbench')
@@ -224,6 +228,170 @@ class HasStateTraits(HasTraits):
         cls.__getter__ = func
         return func
 
+    # Cached trait values, keyed on trait name: (value, time.perf_counter() when cached)
+    _cache = None
+    # Cache [hits, misses] of each trait, keyed on trait name
+    _cache_hits = None
+    # Names of traits with cached values to invalidate on a set, keyed on trait name
+    _dependents = None
+    # (trait, value) pairs waiting to be set on exit from batch(), or None outside batch()
+    _batch = None
+
+    def __init__(self, device, *args, **kws):
+        super(HasStateTraits, self).__init__(device, *args, **kws)
+        self._cache = {}
+        self._cache_hits = {}
+        self._dependents = {}
+        for name, trait in self.traits().items():
+            for dep in getattr(trait, 'depends', ()):
+                self._dependents.setdefault(dep, []).append(name)
+
+    def clear_cache(self, *names):
+        ''' Invalidate cached values of traits, so that the next get of each one
+            queries the device. This is done automatically on disconnect, and by
+            :class:`VISADevice` on `*RST`.
+
+            :param names: names of the traits to invalidate, or none to invalidate all
+        '''
+        if len(names) == 0:
+            self._cache.clear()
+        else:
+            for name in names:
+                self._cache.pop(name, None)
+
+    @contextlib.contextmanager
+    def batch(self):
+        ''' Defer sets of state traits in this block, so that they are made
+            together on exit with one call to the `__set_states__` method of the
+            device. Backends like :class:`VISADevice` use this to combine the
+            commands into fewer messages. Each value is validated when it is
+            assigned, so if any assignment fails, nothing is sent to the device.
+            Gets in the block are not deferred. For example::
+
+                with device.state.batch():
+                    device.state.frequency = 1e9
+                    device.state.span = 10e6
+        '''
+        if self._batch is not None:
+            # Nested in another batch, which does the set
+            yield
+            return
+
+        self._batch = []
+        try:
+            yield
+            pending = self._batch
+        finally:
+            self._batch = None
+
+        if len(pending) > 0:
+            self._device.__set_states__(pending)
+            for trait, value in pending:
+                trait._apply_set(self, value)
+
+    def update(self, **values):
+        ''' Set several state traits together (see :func:`batch`).
+
+            :param values: the value to set, keyed on state trait name
+        '''
+        with self.batch():
+            for name, value in values.items():
+                setattr(self, name, value)
+
+    def get_many(self, names):
+        ''' Get several state traits together. Values that are not cached are
+            retrieved with one call to the `__get_states__` method of the device,
+            which backends like :class:`VISADevice` use to combine queries into
+            fewer messages.
+
+            :param names: iterable of state trait names
+            :returns: dictionary of {name: value}
+        '''
+        traits = self.traits()
+        ret, pending = {}, []
+        for name in names:
+            if name not in traits:
+                raise AttributeError(f"{self._device} has no '{name}' state definition")
+            value = traits[name]._lookup(self)
+            if value is Undefined:
+                pending.append(traits[name])
+            ret[name] = value
+
+        if len(pending) > 0:
+            values = self._device.__get_states__(pending)
+            for trait, value in zip(pending, values):
+                ret[trait.name] = trait._apply_get(self, value)
+
+        return ret
+
+    async def aget(self, name):
+        ''' Get the value of a state trait from a coroutine, for devices
+            controlled in an asyncio event loop. For example::
+
+                value = await device.state.aget('frequency')
+
+            Devices with native asyncio I/O (such as :class:`AsyncVISADevice`)
+            implement `__aget_state__`, which is awaited for traits that use the
+            default getter of the device. Other getters are called in the default
+            executor of the event loop.
+
+            :param name: name of the state trait
+            :returns: the value of the trait
+        '''
+        trait = self.__trait(name)
+        value = trait._lookup(self)
+        if value is not Undefined:
+            return value
+
+        getter = trait.metadata['getter']
+        if getter is getattr(type(self), '__getter__', None)\
+                and hasattr(self._device, '__aget_state__'):
+            new = await self._device.__aget_state__(trait)
+        else:
+            loop = asyncio.get_running_loop()
+            new = await loop.run_in_executor(None, getter, self._device, trait)
+
+        return trait._apply_get(self, new)
+
+    async def aset(self, name, value):
+        ''' Set the value of a state trait from a coroutine (see :func:`aget`).
+            For example::
+
+                await device.state.aset('frequency', 1e9)
+
+            :param name: name of the state trait
+            :param value: the value to set
+        '''
+        trait = self.__trait(name)
+        if trait.read_only:
+            raise traitlets.TraitError(f"the '{name}' state of {self._device} is read-only")
+        value = trait._prepare_set(self, value)
+
+        setter = trait.metadata['setter']
+        if setter is getattr(type(self), '__setter__', None)\
+                and hasattr(self._device, '__aset_state__'):
+            await self._device.__aset_state__(trait, value)
+        else:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, setter, self._device, trait, value)
+
+        trait._apply_set(self, value)
+
+    def __trait(self, name):
+        trait = self.traits().get(name, None)
+        if trait is None:
+            raise AttributeError(f"{self._device} has no '{name}' state definition")
+        return trait
+
+    def cache_stats(self):
+        ''' Count the gets of each cached trait that returned its cached value
+            (hits) and that queried the device (misses).
+
+            :returns: dictionary of {trait name: {'hits': int, 'misses': int}}
+        '''
+        return dict([(name, {'hits': hits, 'misses': misses})
+                     for name, (hits, misses) in self._cache_hits.items()])
+
     @classmethod
     def _register_callbacks(cls):
         for name, trait in cls.class_traits().items():
@@ -232,6 +400,11 @@ class HasStateTraits(HasTraits):
     def __setattr__(self, key, value):
         ''' Prevent silent errors that could result from typos in state names
         '''
+        # Assign traits directly. The checks below would otherwise get the
+        # current value of the trait, querying the device.
+        if isinstance(getattr(type(self), key, None), TraitType):
+            super(HasStateTraits, self).__setattr__(key, value)
+            return
 
         exists = hasattr(self, key)
 
@@ -249,7 +422,7 @@ class HasStateTraits(HasTraits):
         super(HasStateTraits, self).__setattr__(key, value)
 
 defaults = dict(default_value=Undefined, read_only=False, write_only=False,
-                cache=False, allow_none=False, remap={})
+                cache=False, allow_none=False, remap={}, depends=())
 
 class TraitMixIn(object):
     ''' Includes added mix-in features for device control into traitlets types:
@@ -269,15 +442,17 @@ class TraitMixIn(object):
             pass
     '''
 
-    doc_attrs = 'command', 'read_only', 'write_only', 'remap', 'cache'
+    doc_attrs = 'command', 'read_only', 'write_only', 'remap', 'cache', 'cache_ttl', 'depends'
     default_value = traitlets.Undefined
     write_only = False
     cache = False
+    cache_ttl = None
+    depends = ()
     read_only_if_connected = False
 
     def __init__(self, default_value=Undefined, allow_none=False, read_only=None, help=None,
                  write_only=None, cache=None, command=None, #getter=None, setter=None,
-                 remap={}, **kwargs):
+                 remap={}, cache_ttl=None, depends=(), **kwargs):
 
         # Identify the underlying class from Trait
         for c in inspect.getmro(self.__class__):
@@ -306,11 +481,15 @@ class TraitMixIn(object):
             self.write_only = write_only
         if cache is not None:
             self.cache = cache
+        if cache_ttl is not None:
+            self.cache_ttl = cache_ttl
+        if isinstance(depends, str):
+            depends = (depends,)
+        self.depends = tuple(depends)
         if not isinstance(remap, dict):
             raise TypeError('remap must be a dictionary')
 
         self.command = command
-        self.__last = None
 
 #        self.tag(setter=setter,
 #                 getter=getter)
@@ -431,24 +610,58 @@ class TraitMixIn(object):
             raise TypeError('obj (of type {}) must be an instance of HasSettingsTraits or HasStateTraits'
                             .format(type(obj)))
 
-        # If self.write_only, bail if we haven't cached the value
-        if self.write_only and self.__last is None:
-            raise traitlets.TraitError(
-                'tried to get state value, but it is write-only and has not been set yet')
-
-        # If self.write_only or we are caching, return a cached value
-        elif self.write_only or (self.cache and self.__last is not None):
-            return self.__last
+        value = self._lookup(obj)
+        if value is not Undefined:
+            return value
 
         # Get the value from the device
-        new = self.metadata['getter'](obj._device, self)
+        return self._apply_get(obj, self.metadata['getter'](obj._device, self), cls)
 
+    def _lookup(self, obj):
+        ''' Return the cached value of this trait in `obj` if it is write-only,
+            or if it is cached and has not expired. Otherwise, return Undefined.
+        '''
+        # If self.write_only, bail if we haven't cached the value
+        if self.write_only:
+            if self.name not in obj._cache:
+                raise traitlets.TraitError(
+                    'tried to get state value, but it is write-only and has not been set yet')
+            return obj._cache[self.name][0]
+
+        # If we are caching, return a cached value that has not expired
+        if self._caching(obj):
+            counts = obj._cache_hits.setdefault(self.name, [0, 0])
+            if self.name in obj._cache:
+                value, t = obj._cache[self.name]
+                if self.cache_ttl is None or time.perf_counter() - t < self.cache_ttl:
+                    counts[0] += 1
+                    return value
+            counts[1] += 1
+
+        return Undefined
+
+    def _apply_get(self, obj, new, cls=None):
+        ''' Remap, validate, and store a value `new` received from the device
+            for this trait in `obj`.
+
+            :returns: the validated value
+        '''
         # Remap the resulting value.
-        new = self.remap_inbound.get(new, new)
+        if self.remap_inbound:
+            new = self.remap_inbound.get(new, new)
+
+        if self._observed(obj):
+            # Apply the value with the parent traitlet class.
+            self._parent.set(self, obj, new)
+            new = self._parent.get(self, obj, cls)
+        else:
+            # Nothing to notify: validate and store the value directly
+            new = self._fast_validate(obj, new)
+            obj._trait_values[self.name] = new
 
-        # Apply the value with the parent traitlet class.
-        self._parent.set(self, obj, new)
-        return self._parent.get(self, obj, cls)
+        if self._caching(obj):
+            obj._cache[self.name] = new, time.perf_counter()
+        return new
 
     def set(self, obj, value):
         ''' Overload the traitlet's get method to inject a call to a
@@ -463,23 +676,86 @@ class TraitMixIn(object):
 
         # Trait.set already implements a check for self.read_only, so we don't
         # do that here.
+        value = self._prepare_set(obj, value)
+
+        # Inside a HasStateTraits.batch() block, the device is set on exit
+        if obj._batch is not None:
+            obj._batch.append((self, value))
+            return
+
+        # Set the value on the device
+        self.metadata['setter'](obj._device, self, value)
+        self._apply_set(obj, value)
 
+    def _prepare_set(self, obj, value):
+        ''' Validate `value` for this trait in `obj`, and remap it to the
+            value to send to the device.
+        '''
         # Make sure the (potentially remapped) value meets criteria defined by
         # this traitlet subclass
         value = self.validate(obj, value)
 
         # Remap the resulting value to the remote value
-        value = self.remap.get(value, value)
-
-        # Set the value on the device
-        self.metadata['setter'](obj._device, self, value)
+        if self.remap:
+            value = self.remap.get(value, value)
+        return value
 
-        # Apply the value to the traitlet, saving the cached value if necessary
-        rd_only, self.read_only = self.read_only, False
-        self._parent.set(self, obj, value)
-        if self.cache or self.write_only:
-            self.__last = self._parent.get(self, obj, self._parent)
-        self.read_only = rd_only
+    def _apply_set(self, obj, value):
+        ''' Store the (remapped) `value` that was just set on the device for
+            this trait in `obj`.
+        '''
+        if self._observed(obj):
+            # Apply the value to the traitlet
+            rd_only, self.read_only = self.read_only, False
+            self._parent.set(self, obj, value)
+            value = self._parent.get(self, obj, self._parent)
+            self.read_only = rd_only
+        else:
+            # Nothing to notify: store the value directly. Like _parent.set,
+            # the remapped value is what gets validated and stored.
+            if self.remap:
+                value = self._fast_validate(obj, value)
+            obj._trait_values[self.name] = value
+
+        # Save the cached value if necessary, and invalidate the cached
+        # values of traits that depend on this one
+        if self.write_only or self._caching(obj):
+            obj._cache[self.name] = value, time.perf_counter()
+        for name in obj._dependents.get(self.name, ()):
+            obj._cache.pop(name, None)
+
+    def _caching(self, obj):
+        ''' Whether to cache the value of this trait in `obj`: if it is
+            defined with `cache` or `cache_ttl`, or if it can be set and
+            the device has `settings.coherent_cache` enabled.
+        '''
+        if self.cache or self.cache_ttl is not None:
+            return True
+        return self.metadata['setter'] is not None\
+            and obj._device.settings.coherent_cache
+
+    def _observed(self, obj):
+        ''' Whether a change to this trait in `obj` needs to go through
+            traitlets, because observers or cross-validators are registered
+            for it. Otherwise, :func:`get` and :func:`set` store values
+            directly in `obj` without building change notifications.
+        '''
+        # traitlets leaves empty handler lists behind after unobserve
+        notifiers = obj._trait_notifiers
+        for name in (self.name, All):
+            for handlers in notifiers.get(name, {}).values():
+                if len(handlers) > 0:
+                    return True
+        return self.name in obj._trait_validators
+
+    def _fast_validate(self, obj, value):
+        ''' Validate `value` with the type-specific `validate` of this trait,
+            skipping the traitlets cross-validation machinery (see
+            :func:`_observed`).
+        '''
+        if value is None and self.allow_none:
+            return value
+        return self.validate(obj, value)
 
     def setter(self, func, *args, **kws):
         self.metadata['setter'] = lambda device, trait, value: func(device, value)
@@ -498,6 +774,8 @@ class Int(TraitMixIn, traitlets.CInt):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -506,6 +784,13 @@ class Int(TraitMixIn, traitlets.CInt):
     '''
     doc_attrs = ('min', 'max') + TraitMixIn.doc_attrs
 
+    def _fast_validate(self, obj, value):
+        # An int in bounds needs no conversion
+        if type(value) is int and (self.min is None or value >= self.min)\
+                and (self.max is None or value <= self.max):
+            return value
+        return super(Int, self)._fast_validate(obj, value)
+
 
 class CFLoatSteppedTraitlet(traitlets.CFloat):
     ''' Trait for a quantized floating point value, with type and bounds checking.
@@ -515,6 +800,8 @@ class CFLoatSteppedTraitlet(traitlets.CFloat):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -535,6 +822,8 @@ class Float(TraitMixIn, CFLoatSteppedTraitlet):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -552,6 +841,14 @@ class Float(TraitMixIn, CFLoatSteppedTraitlet):
             value = round(value / self.step) * self.step
         return value
 
+    def _fast_validate(self, obj, value):
+        # A float in bounds needs no conversion, unless it is quantized
+        if type(value) is float and not self.step\
+                and (self.min is None or value >= self.min)\
+                and (self.max is None or value <= self.max):
+            return value
+        return super(Float, self)._fast_validate(obj, value)
+
 
 class Unicode(TraitMixIn, traitlets.CUnicode):
     ''' Trait for a Unicode string value, with type checking.
@@ -561,6 +858,8 @@ class Unicode(TraitMixIn, traitlets.CUnicode):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -568,6 +867,11 @@ class Unicode(TraitMixIn, traitlets.CUnicode):
 
     default_value = ''
 
+    def _fast_validate(self, obj, value):
+        if type(value) is str:
+            return value
+        return super(Unicode, self)._fast_validate(obj, value)
+
 
 class Complex(TraitMixIn, traitlets.CComplex):
     ''' Trait for a complex numeric value, with type checking.
@@ -577,6 +881,8 @@ class Complex(TraitMixIn, traitlets.CComplex):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -591,6 +897,8 @@ class Bytes(TraitMixIn, traitlets.CBytes):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -604,6 +912,8 @@ class TCPAddress(TraitMixIn, traitlets.TCPAddress):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -618,6 +928,8 @@ class List(TraitMixIn, traitlets.List):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -634,6 +946,8 @@ class EnumBytesTraitlet(traitlets.CBytes):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -677,6 +991,8 @@ class CaselessBytesEnum(TraitMixIn, EnumBytesTraitlet):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -695,6 +1011,8 @@ class CaselessStrEnum(TraitMixIn, traitlets.CaselessStrEnum):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -712,12 +1030,66 @@ class Dict(TraitMixIn, traitlets.Dict):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
     '''
 
 
+class ArrayTraitlet(traitlets.TraitType):
+    ''' Trait for a numpy array value, with type checking.
+
+        :param default_value: initial value (in `settings` only, not `state`)
+        :param allow_none: whether to allow pythonic `None` to represent a null value
+        :param read_only: True if this should not accept a set (write) operation
+        :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
+        :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
+        :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
+        :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
+        :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
+        :param dtype: numpy data type of the array values
+    '''
+
+    info_text = 'a numpy array'
+    default_value = ()
+
+    def __init__(self, *args, dtype='float64', **kws):
+        self.dtype = np.dtype(dtype)
+        super(ArrayTraitlet, self).__init__(*args, **kws)
+
+    def validate(self, obj, value):
+        try:
+            return np.asarray(value, dtype=self.dtype)
+        except (TypeError, ValueError):
+            self.error(obj, value)
+
+
+class Array(TraitMixIn, ArrayTraitlet):
+    ''' Trait for a numpy array value, such as a trace, with type checking.
+        :class:`VISADevice` transfers these as IEEE 488.2 binary blocks
+        (see :func:`VISADevice.query_binary`).
+
+        :param default_value: initial value (in `settings` only, not `state`)
+        :param allow_none: whether to allow pythonic `None` to represent a null value
+        :param read_only: True if this should not accept a set (write) operation
+        :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
+        :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
+        :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
+        :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
+        :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
+        :param dtype: numpy data type of the array values (including the byte order, as in '>f4', if it is not native)
+    '''
+
+    doc_attrs = ('dtype',) + TraitMixIn.doc_attrs
+    default_value = ()
+
+
 # class BoolTraitlet(traitlets.CBool):
     # def __init__(self, trues=[True], falses=[False], **kws):
     #     self._trues = [v.upper() if isinstance(v, str) else v for v in trues]
@@ -759,6 +1131,8 @@ class Bool(TraitMixIn, traitlets.CBool):
         :param read_only: True if this should not accept a set (write) operation
         :param write_only: True if this should not accept a get (read) operation (in `state` only, not `settings`)
         :param cache: True if this should only read from the device once, then return that value in future calls (in `state` only, not `settings`)
+        :param cache_ttl: if not None, cache values read from the device for this many seconds, then read again (in `state` only, not `settings`)
+        :param depends: names of other states that affect this one; setting any of them invalidates the cached value of this one (in `state` only, not `settings`)
         :param getter: Function or other callable (no arguments) that retrieves the value from the remote device, or None (in `state` only, not `settings`)
         :param setter: Function or other callable (one `value` argument) that sets the value from the remote device, or None (in `state` only, not `settings`)
         :param remap: A dictionary {python_value: device_representation} to use as a look-up table that transforms python representation into the format expected by a device
@@ -766,6 +1140,11 @@ class Bool(TraitMixIn, traitlets.CBool):
 
     default_value = False
 
+    def _fast_validate(self, obj, value):
+        if type(value) is bool:
+            return value
+        return super(Bool, self)._fast_validate(obj, value)
+
 
 class DisconnectedBackend(object):
     ''' "Null Backend" implementation to raises an exception with discriptive
@@ -1106,6 +1485,10 @@ class Device(object, metaclass=DeviceMetaclass):
                            help='Addressing information needed to make a connection to a device. Type and format are determined by the subclass implementation')
         concurrency_support = Bool(default_value=True, read_only=True,
                                    help='Whether this backend supports threading')
+        thread_affinity = Bool(default_value=False, read_only=True,
+                               help='Whether calls in concurrently threads need to run in one dedicated thread for this device')
+        coherent_cache = Bool(default_value=False,
+                              help='Whether to cache each state that can be set, assuming the device changes them only when they are set from python')
 
     class state(HasStateTraits):
         ''' Container for state traits in a Device. Getting or setting state traits
@@ -1145,8 +1528,38 @@ class Device(object, metaclass=DeviceMetaclass):
         self.backend = DisconnectedBackend(self)
         self.state.connected
 
+    def __cancel_io__(self):
+        ''' Backend implementations can overload this to interrupt any blocking
+            I/O in other threads, such as by closing the connection, when calls
+            to methods of this device in `concurrently` are cancelled (see
+            `CancelToken`). It is called from the thread that cancels.
+        '''
+        pass
+
     __get_state__ = __get_state__    
     __set_state__ = __set_state__
+
+    def __get_states__(self, traits):
+        ''' Get the values of several state traits from the device, for
+            `state.get_many`. This implementation gets each one with its
+            getter. Backends can overload this to combine them into fewer
+            operations.
+
+            :param traits: list of state traits
+            :returns: list of the values retrieved from the device
+        '''
+        return [trait.metadata['getter'](self, trait) for trait in traits]
+
+    def __set_states__(self, items):
+        ''' Apply several state values to the device, for `state.batch` and
+            `state.update`. This implementation sets each one with its
+            setter. Backends can overload this to combine them into fewer
+            operations.
+
+            :param items: list of (trait, value) pairs, in the order they were set
+        '''
+        for trait, value in items:
+            trait.metadata['setter'](self, trait, value)
     __warn_state_names__ = []
     __warn_settings_names__ = []
 
@@ -1261,6 +1674,7 @@ class Device(object, metaclass=DeviceMetaclass):
                     '(Exception suppressed to continue disconnect)\n\n')
 
         self.state.connected
+        self.state.clear_cache()
 
         self.logger.debug('{} disconnected'.format(repr(self)))
 
@@ -1303,6 +1717,77 @@ class Device(object, metaclass=DeviceMetaclass):
     __str__ = __repr__
 
 
+class AsyncDevice(Device):
+    r'''`AsyncDevice` extends :class:`Device` for control from an asyncio
+        event loop, so that one thread can drive many devices at once.
+        Connect it with `async with` instead of `with`, and access its state
+        with `await device.state.aget(name)` and `await device.state.aset(name, value)`::
+
+            async with MyDevice('TCPIP0::192.168.1.2::5025::SOCKET') as inst:
+                print(await inst.state.aget('identity'))
+
+        This implementation calls the blocking `connect` and `disconnect`
+        methods in the default executor of the event loop. Backends with native
+        asyncio I/O (such as :class:`AsyncVISADevice`) overload :func:`aconnect`
+        and :func:`adisconnect`, and implement `__aget_state__` and
+        `__aset_state__` coroutines for state traits that use the default
+        getter and setter.
+    '''
+
+    _loop = None  # The event loop that connected the device
+
+    async def aconnect(self):
+        ''' Connect to the device in the running event loop.
+        '''
+        if self.state.connected:
+            self.logger.debug('{} already connected'.format(repr(self)))
+            return
+        self._loop = asyncio.get_running_loop()
+        await self._loop.run_in_executor(None, self.connect)
+
+    async def adisconnect(self):
+        ''' Disconnect from the device in the running event loop.
+        '''
+        await asyncio.get_running_loop().run_in_executor(None, self.disconnect)
+
+    def _submit_to_loop(self, coro):
+        ''' Schedule the coroutine `coro` in the event loop that connected the
+            device, from another thread.
+
+            :returns: a `concurrent.futures.Future` that resolves to the result of `coro`
+        '''
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self._loop is None or running is self._loop:
+            coro.close()
+            raise DeviceStateError(f'{self}: blocking I/O is not supported in the event loop '
+                                   f'of an AsyncDevice; await the coroutine methods instead')
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def _call_in_loop(self, coro):
+        ''' Run the coroutine `coro` in the event loop that connected the
+            device, from another thread, and return its result. This supports
+            blocking calls from getters and setters that run in an executor.
+        '''
+        return self._submit_to_loop(coro).result()
+
+    async def __aenter__(self):
+        try:
+            await self.aconnect()
+            return self
+        except BaseException as e:
+            args = list(e.args)
+            if len(args) > 0:
+                args[0] = '{}: {}'.format(repr(self), str(args[0]))
+                e.args = tuple(args)
+            raise e
+
+    async def __aexit__(self, type_, value, traceback):
+        await self.adisconnect()
+
+
 def list_devices(depth=1):
     ''' Look for Device instances, and their names, in the calling
         code context (depth == 1) or its callers (if depth in (2,3,...)).
@@ -25,42 +25,71 @@
 # licenses.
 
 __all__ = ['StateAggregator', 'StatesToRelationalTable',
-           'StatesToCSV', 'StatesToSQLite',
-           'read', 'read_relational', 'to_feather']
+           'StatesToCSV', 'StatesToSQLite', 'StatesToParquet',
+           'read', 'read_relational', 'to_feather', 'to_numpy',
+           'ReaderCache', 'query']
 
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import suppress, ExitStack
 from .core import Device
 from .host import Host
 from . import util
 import copy
+import csv
+import datetime
 import inspect
 import io
+import operator
 import logging
 import numpy as np
 import os
 import pandas as pd
 import pickle
+from queue import Queue
 import shutil
+import sqlite3
 import tarfile
 import textwrap
+from threading import Lock, Thread
+import time
 import warnings
 from pyarrow.feather import read_feather
 
+# Types of state values that cannot change in place
+_IMMUTABLE_TYPES = {type(None), bool, int, float, complex, str, bytes}
+
 
 class StateAggregator(object):
     ''' Aggregate state information from multiple devices. This can be the basis
         for automatic database logging.
+
+        :param bool concurrent_polls: Whether to poll the `always` states of each device in concurrent threads, or False (the default) to poll them in sequence in the calling thread
     '''
 
-    def __init__(self):
+    def __init__(self, concurrent_polls=False):
         # Map the state instance of a device (key) to a name (value)
         self.name = {}
+        self.concurrent_polls = concurrent_polls
+        self.poll_latency = {}
 
         # These dictionaries are keyed by Device instance
         self.__always = {}
         self.__never = {}
         self.__auto = {}
 
+        # The gets and removals to perform on each call to get(), compiled
+        # by _compile_plan() from self.__always, self.__never, and the
+        # device names in self.name at the time of compilation
+        self.__plan = None
+        self.__plan_names = None
+
+        # Deep copies of the values in self.__auto, which are shared by the
+        # rows of data until the state changes. self.__changed lists the
+        # keys with values that have changed since the copies were made.
+        self.__frozen = {}
+        self.__changed = set()
+
         self.logger = logging.getLogger(self.__class__.__name__)
         # log_handler = logging.bufHandler()
         # log_handler.setLevel(logging.DEBUG)
@@ -83,7 +112,21 @@ class StateAggregator(object):
         :return: None
         '''
         name, attr = self.name[change['owner']._device], change['name']
-        self.__auto[self.key(name, attr)] = change['new']
+        self.__set_auto(self.key(name, attr), change['new'])
+
+    def __set_auto(self, key, value):
+        # An unchanged object is only unchanged in value if it is immutable.
+        # Others (like a reused array buffer) may have been changed in place.
+        if key in self.__auto and self.__auto[key] is value\
+                and type(value) in _IMMUTABLE_TYPES:
+            return
+        self.__auto[key] = value
+        self.__changed.add(key)
+
+    def __del_auto(self, key):
+        if key in self.__auto:
+            del self.__auto[key]
+            self.__changed.add(key)
 
     def set_device_labels(self, **mapping):
         ''' Manually choose device name for a device instance.
@@ -95,7 +138,7 @@ class StateAggregator(object):
             if not isinstance(device, Device):
                 raise ValueError(f'{device} is not an instance of Device')
 
-        self.name.update([(v.state, k) for k, v in list(mapping.items())])
+        self.name.update([(v, k) for k, v in list(mapping.items())])
 
     def observe(self, devices, changes=True, always=[], never=[]):
         """ Deprecated - use `observe_states` instead
@@ -138,6 +181,13 @@ class StateAggregator(object):
             raise Exception('''Could not automatically determine unique names of device instances!
                                Set manually with the set_label method ''')
 
+        for device in devices:
+            traits = device.state.traits()
+            for attr in always:
+                if attr not in traits:
+                    raise Exception(
+                        f'the requested state {attr} does not exist in {device}')
+
         for device in devices:
             if changes:
                 device.state.observe(self.__on_set_callback)
@@ -146,9 +196,11 @@ class StateAggregator(object):
                 device.state.unobserve(self.__on_set_callback)
                 device.settings.unobserve(self.__on_set_callback)
             if always:
-                self.__always[device.state] = always
+                self.__always[device.state] = tuple(always)
             if never:
-                self.__never[device.state] = never
+                self.__never[device.state] = tuple(never)
+
+        self._compile_plan()
 
     def observe_settings(self, devices, changes=True,
                          always=[], never=['connected']):
@@ -184,6 +236,13 @@ class StateAggregator(object):
             raise Exception('''Could not automatically determine unique names of device instances!
                                Set manually with the set_label method ''')
 
+        for device in devices:
+            traits = device.settings.traits()
+            for attr in always:
+                if attr not in traits:
+                    raise Exception(
+                        f'the requested setting {attr} does not exist in {device}')
+
         for device in devices:
             if changes:
                 device.settings.observe(self.__on_set_callback)
@@ -191,9 +250,11 @@ class StateAggregator(object):
                 raise NotImplementedError('Implement me on changes=False')
                 device.settings.unobserve(self.__on_set_callback)
             if always:
-                self.__always[device.settings] = always
+                self.__always[device.settings] = tuple(always)
             if never:
-                self.__never[device.settings] = never
+                self.__never[device.settings] = tuple(never)
+
+        self._compile_plan()
 
     def get(self):
         ''' Aggregate and return the current device states as configured
@@ -202,44 +263,97 @@ class StateAggregator(object):
             :returns: dictionary of aggregated states. Keys are strings defined by :func:`key` (defaults to '{device name}_{state name}'). Values are the type and value of the corresponding state of the device instance.
         '''
 
+        self._update()
+        return self._spy()
+
+    def _compile_plan(self):
+        ''' Work out the gets and removals to perform on each call to
+            :func:`get`, so that they are not repeated on each call.
+            The plan is a tuple of
+
+            #. state polls: (device, name, ((state name, key), ...)) for each device with `always` states;
+            #. setting gets: (settings, setting name, key) for each `always` setting; and
+            #. removals: the key of each `never` state or setting.
+
+            This is called by :func:`observe_states` and :func:`observe_settings`,
+            and again by :func:`get` if `self.name` has changed since.
+        '''
+        polls, settings, never = [], [], []
+
         for device, name in list(self.name.items()):
-            # Perform gets for each state called out in manual_include
-            if device.state in self.__always.keys():
-                for attr in self.__always[device.state]:
-                    if attr not in device.state.traits():
-                        raise Exception(
-                            f'the requested state {attr} does not exist in {device}')
-                    self.__auto[self.key(name, attr)] = getattr(
-                        device.state, attr)
-
-            # Remove keys corresponding with self.__never
-            if device.state in self.__never.keys():
-                for attr in self.__never[device.state]:
-                    try:
-                        del self.__auto[self.key(name, attr)]
-                    except KeyError:
-                        pass
-
-            # Perform gets for each setting called out in self.__always
-            if device.settings in self.__always.keys():
-                for attr in self.__always[device.settings]:
-                    if attr not in device.settings.traits():
-                        raise Exception(
-                            f'the requested setting {attr} does not exist in {device}')
-                    self.__auto[self.key(name, attr)] = getattr(
-                        device.settings, attr)
-
-            # Remove keys corresponding with self.__never
-            if device.settings in self.__never.keys():
-                for attr in self.__never[device.settings]:
-                    try:
-                        del self.__auto[self.key(name, attr)]
-                    except KeyError:
-                        pass
-
-        ret = self._spy()
+            attrs = self.__always.get(device.state, ())
+            if len(attrs) > 0:
+                keys = tuple([(attr, self.key(name, attr)) for attr in attrs])
+                polls.append((device, name, keys))
+
+            setting_keys = [(device.settings, attr, self.key(name, attr))
+                            for attr in self.__always.get(device.settings, ())]
+            settings.extend(setting_keys)
+            setting_keys = set([key for _, _, key in setting_keys])
+
+            # `never` states are removed before `always` settings are applied,
+            # so settings with the same key take precedence
+            never.extend([self.key(name, attr)
+                          for attr in self.__never.get(device.state, ())
+                          if self.key(name, attr) not in setting_keys])
+            never.extend([self.key(name, attr)
+                          for attr in self.__never.get(device.settings, ())])
+
+        self.__plan = tuple(polls), tuple(settings), tuple(never)
+        self.__plan_names = dict(self.name)
+
+    def _update(self):
+        ''' Perform the gets for states and settings that are configured to be
+            aggregated always, and remove those that are configured never to
+            be aggregated, following the plan made by :func:`_compile_plan`.
+
+            State traits require queries to each device. These are polled
+            for each device in its own thread (through :func:`util.concurrently`),
+            with the queries to each device made in sequence. Devices with
+            `settings.concurrency_support` False are polled in this thread.
+            The time spent polling each device is stored in
+            `self.poll_latency`, keyed by device name.
+        '''
+        if self.__plan is None or self.__plan_names != self.name:
+            self._compile_plan()
+        polls, settings, never = self.__plan
+
+        threaded, unthreaded = {}, {}
+        for device, name, keys in polls:
+            if self.concurrent_polls and getattr(device.settings, 'concurrency_support', True):
+                threaded[name] = util.Call(self.__poll, device, name, keys)
+            else:
+                unthreaded[name] = util.Call(self.__poll, device, name, keys)
 
-        return ret
+        if len(threaded) > 1:
+            results = util.concurrently(nones=True, flatten=False, **threaded)
+        else:
+            unthreaded.update(threaded)
+            results = {}
+        results.update([(name, call()) for name, call in unthreaded.items()])
+
+        # Apply in the order of the plan, regardless of which poll finished first
+        for _, name, _ in polls:
+            for key, value in results[name]:
+                self.__set_auto(key, value)
+
+        for owner, attr, key in settings:
+            self.__set_auto(key, getattr(owner, attr))
+
+        for key in never:
+            self.__del_auto(key)
+
+    def __poll(self, device, name, keys):
+        ''' Get each state trait in `keys` from `device`, in order, and
+            record the time this took in `self.poll_latency`.
+
+            :param keys: iterable of (state name, key) pairs
+            :return: list of (key, value) pairs
+        '''
+        t0 = time.perf_counter()
+        values = [(key, getattr(device.state, attr)) for attr, key in keys]
+        self.poll_latency[name] = time.perf_counter() - t0
+        return values
 
     def _spy(self):
         ''' Return a dictionary of the most recently observed states
@@ -249,6 +363,24 @@ class StateAggregator(object):
         '''
         return copy.copy(self.__auto)
 
+    def _snapshot(self, deep=False):
+        ''' Return the most recently observed states for read-only use, without
+            making a new dictionary. The returned dictionary must not be
+            modified.
+
+            :param bool deep: if True, return deep copies of the values that are protected from later changes to the originals. Only values that have changed since the last deep snapshot are copied; the rest are shared with previous snapshots.
+        '''
+        if not deep:
+            return self.__auto
+
+        for key in self.__changed:
+            if key in self.__auto:
+                self.__frozen[key] = copy.deepcopy(self.__auto[key])
+            else:
+                self.__frozen.pop(key, None)
+        self.__changed.clear()
+        return self.__frozen
+
     def __whoisthis(self, target, from_depth=2):
         ''' Introspect into the caller to find the name of an object .
 
@@ -293,7 +425,13 @@ class MungerBase(object):
            text file;
         3. 1- or 2-D data is converted to a pandas Series or DataFrame, and
            dumped into a relational file defined by the extension set by
-           `nonscalar_file_type`
+           `nonscalar_file_type`. If `nonscalar_file_type` is 'npy', the data
+           are instead written directly as a numpy array (or a structured
+           array, for tables) with no DataFrame conversion.
+
+        If `compression` is set, each relational file in a row is compressed
+        as it is written, and the codec extension is added to its file name
+        (for example, 'trace.csv.zst').
 
     '''
 
@@ -303,14 +441,24 @@ class MungerBase(object):
                  dirname_fmt='{id} {host_time}',
                  nonscalar_file_type='csv',
                  metadata_dirname='metadata',
+                 compression=None,
                  **metadata):
 
+        if compression is not None:
+            import pyarrow as pa
+
+            if compression not in compression_suffixes:
+                raise ValueError(f'compression must be one of {tuple(compression_suffixes)} or None, not {repr(compression)}')
+            if not pa.Codec.is_available(compression):
+                raise ValueError(f'{compression} compression is not available in this pyarrow installation')
+
         self.path = path
         self.text_relational_min = text_relational_min
         self.force_relational = force_relational
         self.dirname_fmt = dirname_fmt
         self.nonscalar_file_type = nonscalar_file_type
         self.metadata_dirname = metadata_dirname
+        self.compression = compression
         self.metadata = metadata
         self.logger = logging.getLogger(self.__class__.__name__)
 
@@ -403,6 +551,8 @@ class MungerBase(object):
             except TypeError:
                 with io.TextIOWrapper(stream, newline='\n') as buf:
                     df.to_csv(buf)
+            else:
+                stream.close()
 
     def _from_nonscalar(self, name, value, index=0, row=None):
         ''' Write nonscalar (potentially array-like, or a python object) data
@@ -423,6 +573,8 @@ class MungerBase(object):
                 pickle.dump(value, stream, 2)
             elif ext == 'feather':
                 to_feather(value, stream)
+            elif ext == 'npy':
+                np.save(stream, value, allow_pickle=False)
             elif ext == 'db':
                 raise Exception('sqlite not implemented for relational files')
             else:
@@ -438,26 +590,35 @@ class MungerBase(object):
             ext = self.nonscalar_file_type
 
         try:
-            value = pd.DataFrame(value)
-            if value.shape[0] == 0:
-                value = pd.DataFrame([value])
+            if ext == 'npy':
+                value = to_numpy(value)
+            else:
+                value = pd.DataFrame(value)
+                if value.shape[0] == 0:
+                    value = pd.DataFrame([value])
         except BaseException:
             # We couldn't make a DataFrame
             self.logger.error(
-                f"Failed to form DataFrame from {repr(name)}; pickling object instead")
+                f"Failed to form {'array' if ext == 'npy' else 'DataFrame'} from {repr(name)}; pickling object instead")
             ext = 'pickle'
         finally:
             if row is None:
                 stream = self._open_metadata(name + '.' + ext)
+                out = stream
             else:
-                stream = self._open_relational(name + '.' + ext, index, row)
+                stream = self._open_relational(name + '.' + ext + self._compression_suffix(),
+                                               index, row)
+                out = self._compress(stream)
 
             # Workaround for bytes/str encoding quirk underlying pandas 0.23.1
             try:
-                write(stream, ext, value)
+                write(out, ext, value)
             except TypeError:
-                with io.TextIOWrapper(stream, newline='\n') as buf:
+                with io.TextIOWrapper(out, newline='\n') as buf:
                     write(buf, ext, value)
+            else:
+                # TarFileIO only adds the file to the tar file on close
+                out.close()
             return self._get_key(stream)
 
     def _from_external_file(self, name, old_path,
@@ -479,9 +640,31 @@ class MungerBase(object):
         :param ext: file extension
         :return: the path to the file, relative to the directory that contains the master database
         '''
-        with self._open_relational(name + ext, index, row) as f:
+        stream = self._open_relational(name + ext + self._compression_suffix(),
+                                       index, row)
+        with self._compress(stream) as f:
             f.write(bytes(value, encoding='utf-8'))
-        return self._get_key(f)
+        return self._get_key(stream)
+
+    def _compression_suffix(self):
+        if self.compression is None:
+            return ''
+        return compression_suffixes[self.compression]
+
+    def _compress(self, stream):
+        ''' Wrap a stream opened for a relational file so that data written
+            to it are compressed according to `self.compression`.
+
+        :param stream: the binary stream returned by `_open_relational`
+        :return: the (possibly compressing) stream; closing it closes `stream`
+        '''
+        if self.compression is None:
+            return stream
+
+        import pyarrow as pa
+
+        return pa.CompressedOutputStream(pa.PythonFile(stream, mode='w'),
+                                         self.compression)
 
     # The following methods need to be implemented in subclasses.
     def _get_key(self, buf):
@@ -576,13 +759,16 @@ class TarFileIO(io.BytesIO):
     ''' For appending data into new files in a tarfile
     '''
 
-    def __init__(self, open_tarfile, relname, mode='w', overwrite=False):
+    def __init__(self, open_tarfile, relname, mode='w', overwrite=False,
+                 names=None, index=None):
         #        self.tarbase = tarbase
         #        self.tarname = tarname
         self.tarfile = open_tarfile
         self.overwrite = False
         self.name = relname
         self.mode = mode
+        self.names = names
+        self.index = index
         super(TarFileIO, self).__init__()
 
     def __del__(self):
@@ -604,7 +790,12 @@ class TarFileIO(io.BytesIO):
         #        f = tarfile.open(tarpath, 'a')
 
         try:
-            if not self.overwrite and self.name in self.tarfile.getnames():
+            if self.names is None:
+                exists = self.name in self.tarfile.getnames()
+            else:
+                exists = self.name in self.names
+
+            if not self.overwrite and exists:
                 raise IOError(
                     f'{self.name} already exists in {self.tarfile.name}')
 
@@ -615,18 +806,87 @@ class TarFileIO(io.BytesIO):
 
             self.tarfile.addfile(tarinfo, self)
 
+            if self.names is not None:
+                self.names.add(self.name)
+            if self.index is not None:
+                # the data end at tarfile.offset, padded to a whole block
+                padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                self.index.add(self.name, self.tarfile.offset - padded,
+                               tarinfo.size)
+
         # Then make sure to close everything
         finally:
             super(TarFileIO, self).close()
 
 
+class TarIndex:
+    ''' A sidecar index file of the members of a tar file, listing the offset
+        and size of the data in each member. This lets readers seek directly
+        to a member instead of scanning the tar file for its header. Each
+        line of the index file is a json list of [name, offset, size].
+    '''
+
+    suffix = '.index'
+
+    def __init__(self, tarpath):
+        self.path = tarpath + self.suffix
+        self.stream = None
+
+    def rebuild(self, members):
+        ''' Replace the index file with entries for `members`, and open it
+            to append further entries.
+
+            :param members: iterable of tarfile.TarInfo
+        '''
+        self.close()
+        with open(self.path + '.tmp', 'w') as f:
+            for m in members:
+                f.write(self._line(m.name, m.offset_data, m.size))
+        os.replace(self.path + '.tmp', self.path)
+        self.stream = open(self.path, 'a')
+
+    def add(self, name, offset, size):
+        self.stream.write(self._line(name, offset, size))
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def load(self):
+        ''' Read the index file.
+
+            :return: dictionary of {name: (offset, size)}
+        '''
+        import json
+
+        with open(self.path, 'r') as f:
+            return {name: (offset, size)
+                    for name, offset, size in map(json.loads, f)}
+
+    @staticmethod
+    def _line(name, offset, size):
+        import json
+
+        return json.dumps([name, offset, size]) + '\n'
+
+
 class MungeToTar(MungerBase):
     ''' Implement data munging into a tar file. This is slower than
         MungeToDirectory but is tidier on the filesystem.
+
+        The names of the members are scanned once when the tar file is opened,
+        and tracked in memory as files are added. If `index` is True, a sidecar
+        index file (see :class:`TarIndex`) of the member offsets is also kept
+        up to date so that :class:`MungeTarReader` can seek directly to members.
     '''
 
     tarname = 'data.tar'
 
+    def __init__(self, path, index=False, **kws):
+        super().__init__(path, **kws)
+        self.index = index
+
     def _open_relational(self, name, index, row):
         if 'host_time' not in row:
             self.logger.error(
@@ -634,20 +894,35 @@ class MungeToTar(MungerBase):
 
         relpath = os.path.join(self.dirname_fmt.format(id=index, **row), name)
 
-        return TarFileIO(self.tarfile, relpath)
+        return TarFileIO(self.tarfile, relpath, names=self._names,
+                         index=self._index)
 
     def _open_metadata(self, name):
         dirpath = os.path.join(self.metadata_dirname, name)
-        return TarFileIO(self.tarfile, dirpath)
+        return TarFileIO(self.tarfile, dirpath, names=self._names,
+                         index=self._index)
 
     def setup(self):
         if not os.path.exists(self.path):
             with suppress(FileExistsError):
                 os.makedirs(self.path)
-        self.tarfile = tarfile.open(os.path.join(self.path, self.tarname), 'a')
+        tarpath = os.path.join(self.path, self.tarname)
+        self.tarfile = tarfile.open(tarpath, 'a')
+
+        members = self.tarfile.getmembers()
+        self._names = {m.name for m in members}
+        if self.index:
+            self._index = TarIndex(tarpath)
+            self._index.rebuild(members)
+        else:
+            self._index = None
 
     def cleanup(self):
-        self.tarfile.close()
+        try:
+            self.tarfile.close()
+        finally:
+            if self._index is not None:
+                self._index.close()
 
     def _get_key(self, buf):
         ''' Where is the file relative to the master database?
@@ -692,6 +967,13 @@ class StatesToRelationalTable(StateAggregator):
         :param nonscalar_file_type: The data type to use in non-scalar (tabular, vector, etc.) relational data
         :param metadata_dirname: The name of the subdirectory that should be used to store metadata (device connection parameters, etc.)
         :param tar: Whether to store the relational data within directories in a tar file, instead of subdirectories
+        :param compression: Codec used to compress each relational data file as it is written: 'lz4' (fastest), 'zstd' (smallest), 'gzip', 'bz2', or None (the default) for no compression
+        :param tar_index: Whether to keep a sidecar index of the offset of each file in the tar file, so that readers can seek to files directly (only if `tar` is True)
+        :param async_write: Whether to munge and write rows in a background thread, so that calls to :func:`write` return without waiting for disk I/O
+        :param async_queue_size: Number of calls to :func:`write` that may be queued for the background writer before :func:`write` blocks (only if `async_write` is True)
+        :param munge_workers: Number of worker threads or processes that write the relational data of pending rows in parallel, or 1 (the default) to write them one at a time
+        :param munge_pool: Either 'thread' (the default, suited to rows dominated by disk I/O) or 'process' (suited to rows dominated by encoding, such as large csv tables)
+        :param concurrent_polls: Whether to poll the `always` states of each device in concurrent threads, or False (the default) to poll them in sequence in the calling thread
     '''
 
     index_label = 'id'
@@ -703,14 +985,34 @@ class StatesToRelationalTable(StateAggregator):
                  nonscalar_file_type='csv',
                  metadata_dirname='metadata',
                  tar=False,
+                 tar_index=False,
+                 compression=None,
+                 async_write=False,
+                 async_queue_size=16,
+                 munge_workers=1,
+                 munge_pool='thread',
+                 concurrent_polls=False,
                  **metadata):
 
-        super(StatesToRelationalTable, self).__init__()
+        super(StatesToRelationalTable, self).__init__(concurrent_polls=concurrent_polls)
         self.pending = []
         self.path = path
+        self.last_index = 0
         self._overwrite = overwrite
+        self._async_write = async_write
+        self._async_queue_size = async_queue_size
+        self._write_queue = None
+        self._writer_exception = None
         self.set_row_preprocessor(None)
 
+        if munge_pool not in ('thread', 'process'):
+            raise ValueError(f"munge_pool must be 'thread' or 'process', not {repr(munge_pool)}")
+        if tar and munge_workers > 1:
+            raise ValueError('parallel munging (munge_workers > 1) is not supported when tar=True')
+        self._munge_workers = munge_workers
+        self._munge_pool = munge_pool
+        self._munge_executor = None
+
         # Need to assign in the namespace like this to detect its name can be
         # detected
         host = Host()
@@ -719,8 +1021,10 @@ class StatesToRelationalTable(StateAggregator):
 
         if tar:
             munge_cls = MungeToTar
+            munge_kws = dict(index=tar_index)
         else:
             munge_cls = MungeToDirectory
+            munge_kws = {}
 
         self.munge = munge_cls(path,
                                text_relational_min=text_relational_min,
@@ -728,6 +1032,8 @@ class StatesToRelationalTable(StateAggregator):
                                dirname_fmt=dirname_fmt,
                                nonscalar_file_type=nonscalar_file_type,
                                metadata_dirname=metadata_dirname,
+                               compression=compression,
+                               **munge_kws,
                                **metadata)
 
     def set_row_preprocessor(self, func):
@@ -777,7 +1083,7 @@ class StatesToRelationalTable(StateAggregator):
             disk, `self.pending`. Nothing is written to disk until
             :func:`write`.
 
-            :param bool copy=True: When `True` (the default), use a deep copy of `data` to avoid problems with overwriting references to data if `data` is reused during test. This takes some extra time; set to `False` to skip this copy operation.
+            :param bool copy=True: When `True` (the default), use a deep copy of `data` to avoid problems with overwriting references to data if `data` is reused during test. Observed states are only copied when they change, and the copy is shared by the rows that follow. This takes some extra time; set to `False` to skip this copy operation.
 
             :return: the dictionary representation of the row added to `self.pending`.
         '''
@@ -793,11 +1099,11 @@ class StatesToRelationalTable(StateAggregator):
             row = {}
 
         # Pull in observed states
-        row.update(copy.deepcopy(dict(self.get())
-                                 if do_copy else dict(self.get())))
+        self._update()
+        row.update(self._snapshot(deep=do_copy))
 
         # Pull in keyword arguments
-        row.update(copy.deepcopy(dict(kwargs)) if do_copy else dict(kwargs))
+        row.update(copy.deepcopy(kwargs) if do_copy else kwargs)
 
         self.pending.append(row)
         return row
@@ -807,26 +1113,117 @@ class StatesToRelationalTable(StateAggregator):
             non-scalar data to data files, and replacing their dictionary value
             with the relative path to the data file.
 
+            If the database was created with `async_write=True`, the rows are
+            instead queued for the background writer thread. This blocks only
+            if the queue is full. Use :func:`flush` to wait until the
+            queued rows are on disk.
+
             :returns: the number of rows written
         '''
         count = len(self.pending)
         if count > 0:
-            proc = self._row_preprocessor
-            pending = enumerate(self.pending)
-            self.pending = [self.munge(self.last_index + i, proc(row))
-                            for i, row in pending]
-            self._write_master()
+            if self._write_queue is None:
+                self.pending = self._munge_rows(self.pending)
+                self._write_master(self.pending)
+            else:
+                self._raise_writer_exception()
+                self._write_queue.put(self.pending)
             self.clear()
         return count
 
-    def _write_master(self):
-        ''' Write pending data. This is an abstract base method (must be
+    def flush(self):
+        ''' Block until all rows passed to :func:`write` have been committed
+            to disk by the background writer thread. Any exception raised in
+            the writer thread is raised here.
+
+            This returns immediately unless the database was created with
+            `async_write=True`.
+        '''
+        if self._write_queue is not None:
+            self._write_queue.join()
+        self._raise_writer_exception()
+
+    def _munge_rows(self, rows):
+        ''' Apply the row preprocessor to each row, and replace relational
+            data with paths to the files written by the munger.
+
+            :return: list of rows ready to write to the master database
+        '''
+        proc = self._row_preprocessor
+        if self._munge_workers <= 1 or len(rows) <= 1:
+            return [self.munge(self.last_index + i, proc(row))
+                    for i, row in enumerate(rows)]
+
+        # Indices are assigned here, and map returns results in the order of
+        # rows, so the outcome is the same as the serial case
+        if self._munge_executor is None:
+            if self._munge_pool == 'process':
+                executor_cls = ProcessPoolExecutor
+            else:
+                executor_cls = ThreadPoolExecutor
+            self._munge_executor = executor_cls(self._munge_workers)
+        indices = range(self.last_index, self.last_index + len(rows))
+        return list(self._munge_executor.map(self.munge, indices,
+                                             [proc(row) for row in rows]))
+
+    def _stop_munge_executor(self):
+        if self._munge_executor is not None:
+            self._munge_executor.shutdown()
+            self._munge_executor = None
+
+    def _write_master(self, rows):
+        ''' Write rows to the master database, and advance `self.last_index`
+            by the number of rows. This is an abstract base method (must be
             implemented by inheriting classes)
 
+            :param rows: list of row dictionaries returned by the munger
             :return: None
         '''
         raise NotImplementedError
 
+    def _start_writer(self):
+        ''' Start the background thread that munges and writes queued rows
+        '''
+        self._writer_exception = None
+        self._write_queue = Queue(self._async_queue_size)
+        self._writer = Thread(target=self._write_worker, daemon=True,
+                              name=f'{self.__class__.__name__} writer')
+        self._writer.start()
+
+    def _stop_writer(self):
+        ''' Write any queued rows, then stop the background writer thread
+        '''
+        if self._write_queue is None:
+            return
+        self._write_queue.put(None)
+        self._writer.join()
+        self._write_queue = None
+        self._writer = None
+
+    def _write_worker(self):
+        ''' Background thread loop for `async_write=True`. Exceptions are kept
+            so that the next call to :func:`write` or :func:`flush` can raise
+            them in the acquisition thread.
+        '''
+        while True:
+            rows = self._write_queue.get()
+            try:
+                if rows is None:
+                    return
+                self._write_master(self._munge_rows(rows))
+            except BaseException as e:
+                self.logger.error(
+                    f'background write of {len(rows)} rows failed: {repr(e)}')
+                if self._writer_exception is None:
+                    self._writer_exception = e
+            finally:
+                self._write_queue.task_done()
+
+    def _raise_writer_exception(self):
+        ex, self._writer_exception = self._writer_exception, None
+        if ex is not None:
+            raise ex
+
     def clear(self):
         ''' Remove any queued data that has been added by append.
         '''
@@ -835,12 +1232,12 @@ class StatesToRelationalTable(StateAggregator):
     def set_relational_file_format(self, format):
         ''' Set the format to use for relational data files.
 
-            :param str format: one of 'csv', 'json', 'feather', or 'pickle'
+            :param str format: one of 'csv', 'json', 'feather', 'npy', or 'pickle'
         '''
         warnings.warn('''set_nonscalar_file_type is deprecated; set when creating
                          the database object instead with the nonscalar_output flag''')
 
-        if format not in ('csv', 'json', 'feather', 'pickle', 'db'):
+        if format not in ('csv', 'json', 'feather', 'npy', 'pickle', 'db'):
             raise Exception(
                 f'relational file data format {format} not supported')
         self.munge.nonscalar_file_type = format
@@ -895,14 +1292,10 @@ class StatesToRelationalTable(StateAggregator):
                       '''
                 raise IOError(textwrap.dedent(txt))
 
+        self.last_index = 0
         self.open()
         self.clear()
 
-        if os.path.exists(self.path) and self._overwrite:
-            os.remove(self.path)
-
-        self.last_index = 0
-
         self.__stack = ExitStack()
         self.__stack.__enter__()
 
@@ -913,12 +1306,24 @@ class StatesToRelationalTable(StateAggregator):
             self.__stack.__exit__(None, None, None)
             raise
 
+        if self._async_write:
+            self._start_writer()
+
         return self
 
     def __exit__(self, *args):
         ret = None
         try:
-            self.write()
+            try:
+                self.write()
+            finally:
+                # Everything queued must be on disk before the munger and
+                # host contexts are closed
+                try:
+                    self._stop_writer()
+                finally:
+                    self._stop_munge_executor()
+            self._raise_writer_exception()
             self.munge.write_metadata(self.name, self.key)
         except BaseException as e:
             ex = e
@@ -993,37 +1398,89 @@ class StatesToCSV(StatesToRelationalTable):
         '''
         if not self.path.lower().endswith('.csv'):
             self.path += '.csv'
+
+        self._columns = []
+        self.last_index = 0
         if os.path.exists(self.path) and not self._overwrite:
-            self.df = pd.read_csv(self.path, nrows=1)
-            self.df.index.name = self.index_label
+            # continue the existing file: read its header and count its rows
+            with open(self.path, 'r', newline='') as f:
+                reader = csv.reader(f)
+                self._columns = next(reader, [])
+                self.last_index = sum(1 for _ in reader)
+            mode = 'a'
         else:
-            self.df = None
+            mode = 'w'
+
+        self._file = open(self.path, mode, newline='')
+        self._writer = None
 
     def close(self):
-        self._write_master()
+        try:
+            self._write_master(self.pending)
+            self.clear()
+        finally:
+            self._file.close()
 
-    def _write_master(self):
-        ''' Write queued rows of data to csv. This is called automatically on :func:`close`, or when
+    def _write_master(self, rows):
+        ''' Append queued rows of data to the csv file through a persistent
+            file handle, so that the cost of each call depends only on `rows`.
+            This is called automatically on :func:`close`, or when
             exiting a `with` block.
 
-            If the class was created with overwrite=True, then the first call to _write_master() will overwrite
-            the preexisting file; subsequent calls append.
+            The header row is fixed by the first write. When `rows` introduce
+            new columns, the file is rewritten once with the wider header,
+            and appending resumes.
         '''
-        if len(self.pending) == 0:
+        if len(rows) == 0:
             return
-        isfirst = self.df is None
-        pending = pd.DataFrame(self.pending)
-        pending.index.name = self.index_label
-        pending.index += self.last_index
-        if isfirst:
-            self.df = pending
-        else:
-            self.df = self.df.append(pending).loc[self.last_index:]
-        self.df.sort_index(inplace=True)
-        self.last_index = self.df.index[-1]
 
-        with open(self.path, 'a') as f:
-            self.df.to_csv(f, header=isfirst, index=False)
+        known = set(self._columns)
+        new_columns = []
+        for row in rows:
+            for k in row:
+                if k not in known:
+                    known.add(k)
+                    new_columns.append(k)
+
+        if new_columns:
+            self._extend_header(new_columns)
+        elif self._writer is None:
+            self._writer = csv.DictWriter(self._file, fieldnames=self._columns,
+                                          restval='')
+
+        self._writer.writerows(rows)
+        self._file.flush()
+        self.last_index += len(rows)
+
+    def _extend_header(self, new_columns):
+        ''' Add columns to the header row of the csv file. Existing rows are
+            streamed into a replacement file with empty values in the new
+            columns.
+        '''
+        self._file.close()
+        old_columns = self._columns
+        self._columns = old_columns + new_columns
+
+        if self.last_index == 0:
+            self._file = open(self.path, 'w', newline='')
+            csv.writer(self._file).writerow(self._columns)
+        else:
+            tmp_path = self.path + '.tmp'
+            padding = [''] * len(new_columns)
+            with open(self.path, 'r', newline='') as fin, \
+                    open(tmp_path, 'w', newline='') as fout:
+                reader = csv.reader(fin)
+                writer = csv.writer(fout)
+                next(reader, None)
+                writer.writerow(self._columns)
+                for line in reader:
+                    line += [''] * (len(old_columns) - len(line))
+                    writer.writerow(line + padding)
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, 'a', newline='')
+
+        self._writer = csv.DictWriter(self._file, fieldnames=self._columns,
+                                      restval='')
 
 
 class StatesToSQLite(StatesToRelationalTable):
@@ -1042,12 +1499,17 @@ class StatesToSQLite(StatesToRelationalTable):
         :param nonscalar_file_type: The data type to use in non-scalar (tabular, vector, etc.) relational data
         :param metadata_dirname: The name of the subdirectory that should be used to store metadata (device connection parameters, etc.)
         :param tar: Whether to store the relational data within directories in a tar file, instead of subdirectories
+        :param index_columns: Columns in the master database to index, in order to speed up :func:`query` calls that filter on them
     '''
 
     index_label = 'id'  # Don't change this or sqlite breaks :(
     master_filename = 'master.db'
     table_name = 'master'
 
+    def __init__(self, path, *args, index_columns=['host_time'], **kws):
+        super().__init__(path, *args, **kws)
+        self.index_columns = list(index_columns)
+
     def open(self):
         ''' Instead of calling `open` directly, consider using
             `with` statements to guarantee proper disconnection
@@ -1069,33 +1531,37 @@ class StatesToSQLite(StatesToRelationalTable):
         os.makedirs(self.path, exist_ok=True)
         path = os.path.join(self.path, self.master_filename)
 
-        # Create an engine via sqlalchemy
-        from sqlalchemy import create_engine  # database connection
-        self._engine = create_engine('sqlite:///{}'.format(path))
+        # A single connection is held open until close(). Each call to
+        # _write_master then only costs one transaction. With async_write,
+        # it is used by the writer thread, and WAL journaling keeps readers
+        # from blocking on (or being blocked by) the writes.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        if self._async_write:
+            self._connection.execute('pragma journal_mode=wal')
+        self._load_schema()
+        if len(self._schema) > 0:
+            self._create_indexes(self._schema)
+
+            # Continue the index where the existing table left off
+            query = f'select max({self.index_label}) from {self.table_name}'
+            last = self._connection.execute(query).fetchone()[0]
+            if last is not None:
+                self.last_index = last + 1
 
-        if os.path.exists(path) and not self._overwrite:
-            # Read the last row to 1) list the columns and 2) get index
-            query = f'select * from {self.table_name} order by {self.index_label} desc limit 1'
-
-            df = pd.read_sql_query(query, self._engine,
-                                   index_col=self.index_label)
-            self._columns = df.columns
-            self.last_index = df.index[-1] + 1
-        else:
-            self._columns = None
         self.inprogress = {}
         self.committed = {}
 
     def close(self):
         try:
-            self._write_master()
+            self._write_master(self.pending)
+            self.clear()
         finally:
             try:
-                self._engine.dispose()
+                self._connection.close()
             except BaseException:
                 pass
 
-    def _write_master(self):
+    def _write_master(self, rows):
         ''' Write queued rows of data to the database. This also is called automatically on :func:`close`, or when
             exiting a `with` block.
 
@@ -1103,50 +1569,142 @@ class StatesToSQLite(StatesToRelationalTable):
             the preexisting file; subsequent calls append.
         '''
 
-        if len(self.pending) == 0:
+        if len(rows) == 0:
+            return
+
+        column_set = frozenset().union(*rows)
+
+        # Only a set of columns that hasn't been seen before needs to be
+        # checked against the schema
+        try:
+            columns, query = self._insert_queries[column_set]
+        except KeyError:
+            columns = tuple(sorted(column_set))
+            self._update_schema(columns, rows)
+            query = self._insert_query(columns)
+            self._insert_queries[column_set] = columns, query
+
+        # Append to db in a single transaction
+        values = [(self.last_index + i,)
+                  + tuple([self._sql_value(row.get(c)) for c in columns])
+                  for i, row in enumerate(rows)]
+
+        with self._connection:
+            self._connection.executemany(query, values)
+
+        self.last_index += len(values)
+
+    def _load_schema(self):
+        ''' Read the column names and types of the master table into
+            `self._schema`, which maps the lower-case name of each column
+            (including the index) to its SQL type. This is empty if the table
+            does not exist yet. After this, the schema is tracked in memory.
+        '''
+        query = f'pragma table_info({self.table_name})'
+        self._schema = dict([(r[1].lower(), r[2])
+                             for r in self._connection.execute(query)])
+        self._insert_queries = {}
+
+    def _update_schema(self, columns, rows):
+        ''' Create the master table, or add any of `columns` that are not
+            in the schema yet. Types of new columns are inferred from their
+            values in `rows`. All changes are applied in a single transaction.
+        '''
+        new_columns = OrderedDict()
+        for c in columns:
+            if c.lower() not in self._schema:
+                new_columns.setdefault(c.lower(), c)
+        if len(new_columns) == 0:
             return
 
-        # Put together a DataFrame from self.pending that is guaranteed
-        # to include the columns defined in self._columns
-        state = pd.DataFrame(self.pending)
-        state.index += self.last_index
-        blank = pd.DataFrame(columns=self._columns)
+        types = dict([(c, self._column_type(c, rows))
+                      for c in new_columns.values()])
 
-        # Check for new columns, and insert into the database
-        if self._columns is None:
-            new_columns = []
+        if len(self._schema) == 0:
+            fields = [f'"{self.index_label}" INTEGER']\
+                + [f'"{c}" {t}' for c, t in types.items()]
+            queries = [f'create table {self.table_name} ({", ".join(fields)})',
+                       f'create index ix_{self.table_name}_{self.index_label} '
+                       f'on {self.table_name} ({self.index_label})']
+            schema = dict([(self.index_label.lower(), 'INTEGER')])
         else:
-            state_cols = [c.lower() for c in state.columns]
-            blank_cols = [c.lower() for c in blank.columns]
-            new_columns = list(set(state_cols).difference(blank_cols))
-
-        for c in new_columns:
-            self.logger.info(
-                'LogSQLite inserting new state column {c} into database')
-            column_type = self._sql_type_name(state[c])
-            with self._engine.connect() as con:
-                query = f"alter table {self.table_name} add column {c} {column_type} default NULL"
-                con.execute(query)
-
-        # Form the new database row
-        df = blank.append(state, sort=True)
-        df.sort_index(inplace=True)
-        self._columns = df.columns
-
-        from sqlalchemy.exc import ArgumentError
-
-        # Append to db
+            queries = []
+            for c, t in types.items():
+                self.logger.info(
+                    f'LogSQLite inserting new state column {c} into database')
+                queries.append(f'alter table {self.table_name} add column "{c}" '
+                               f'{t} default NULL')
+            schema = {}
+        queries += self._index_queries(types)
+
+        self._execute_ddl(queries)
+
+        schema.update([(c.lower(), t) for c, t in types.items()])
+        self._schema.update(schema)
+
+    def _index_queries(self, columns):
+        ''' Return queries that create an index for each of `columns` that
+            is listed in `self.index_columns`
+        '''
+        index_columns = {c.lower() for c in self.index_columns}
+        return [f'create index if not exists "ix_{self.table_name}_{c}" '
+                f'on {self.table_name} ("{c}")'
+                for c in columns if c.lower() in index_columns]
+
+    def _create_indexes(self, columns):
+        ''' Create any missing indexes for `self.index_columns` among the
+            existing `columns`
+        '''
+        self._execute_ddl(self._index_queries(columns))
+
+    def _execute_ddl(self, queries):
+        ''' Execute schema changes in a single transaction
+        '''
+        if len(queries) == 0:
+            return
+
+        # sqlite3 does not open transactions for DDL statements on its own
+        self._connection.execute('begin')
         try:
-            df.to_sql(self.table_name, self._engine, if_exists='append',
-                      index=True, index_label=self.index_label)
-        except ArgumentError:
-            self.logger.error(
-                f'failed to convert index label {self.index_label}')
-            raise ArgumentError
-        except BaseException as e:
-            raise e
+            for query in queries:
+                self._connection.execute(query)
+        except BaseException:
+            self._connection.rollback()
+            raise
+        else:
+            self._connection.commit()
+
+    def _insert_query(self, columns):
+        ''' Return a parameterized insert statement for a tuple of columns
+        '''
+        names = ', '.join([f'"{c}"' for c in (self.index_label,) + columns])
+        marks = ', '.join((len(columns) + 1) * '?')
+        return f'insert into {self.table_name} ({names}) values ({marks})'
+
+    def _column_type(self, name, rows):
+        ''' SQL type name for a column, inferred from its values in rows
+        '''
+        return self._sql_type_name(pd.Series([row.get(name) for row in rows]))
 
-        self.last_index += 1
+    @staticmethod
+    def _sql_value(value):
+        ''' Convert a row value to a type supported by sqlite3
+        '''
+        if isinstance(value, (np.datetime64, datetime.datetime)):
+            # .item() gives an int for ns precision, which would be parsed
+            # as NaT from a TIMESTAMP column
+            value = pd.Timestamp(value)
+            return None if pd.isnull(value) else value.isoformat(sep=' ')
+        elif isinstance(value, (np.timedelta64, datetime.timedelta)):
+            # integer ns, as warned in _sql_type_name
+            value = pd.Timedelta(value)
+            return None if pd.isnull(value) else int(value.value)
+        elif isinstance(value, np.generic):
+            return value.item()
+        elif value is None or isinstance(value, (int, float, str, bytes)):
+            return value
+        else:
+            return str(value)
 
     def key(self, name, attr):
         ''' The key determines the SQL column name. df.to_sql does not seem
@@ -1193,6 +1751,174 @@ class StatesToSQLite(StatesToRelationalTable):
         return pd.api.types.infer_dtype(col_for_inference)
 
 
+class StatesToParquet(StatesToRelationalTable):
+    ''' Store data and states to disk into a master database formatted as an
+        append-only parquet dataset.
+
+        Each call to :func:`write` adds one parquet file (a single row group) to
+        the dataset directory, and a manifest lists the files that have been
+        completely written. Columns are typed, and string columns
+        are dictionary-encoded. Use :func:`read` (or :func:`read_relational`)
+        with the `columns` and `filters` arguments to load only the needed
+        columns and row groups from large datasets.
+
+        This extends :class:`StateAggregator` to support
+
+        #. queuing aggregate state of devices by lists of dictionaries;
+        #. custom metadata in each queued aggregate state entry; and
+        #. custom response to non-scalar data (such as relational databasing).
+
+        :param str path: Base path to use for the master database
+        :param bool overwrite: Whether to overwrite the master database if it exists (otherwise, append)
+        :param text_relational_min: Text with at least this many characters is stored as a relational text file instead of directly in the database
+        :param force_relational: A list of columns that should always be stored as relational data instead of directly in the database
+        :param nonscalar_file_type: The data type to use in non-scalar (tabular, vector, etc.) relational data
+        :param metadata_dirname: The name of the subdirectory that should be used to store metadata (device connection parameters, etc.)
+        :param tar: Whether to store the relational data within directories in a tar file, instead of subdirectories
+    '''
+
+    master_filename = 'master.parquet'
+    manifest_filename = 'manifest.json'
+
+    def open(self):
+        ''' Instead of calling `open` directly, consider using
+            `with` statements to guarantee proper disconnection
+            if there is an error. For example, the following
+            sets up a connected instance::
+
+                with StatesToParquet('my_data') as db:
+                    ### do the data acquisition here
+                    pass
+
+            would instantiate a `StatesToParquet` instance, and also guarantee
+            a final attempt to write unwritten data is written, and that
+            the file is closed when exiting the `with` block, even if there
+            is an exception.
+        '''
+        self._dataset_path = os.path.join(self.path, self.master_filename)
+        os.makedirs(self._dataset_path, exist_ok=True)
+
+        # Continue the index and column types of any existing dataset
+        self._manifest = _read_parquet_manifest(self._dataset_path)
+        self._schema = _parquet_dataset_schema(self._dataset_path, self._manifest)
+        if len(self._manifest['files']) > 0:
+            self.last_index = self._manifest['files'][-1]['last_id'] + 1
+
+    def close(self):
+        self._write_master(self.pending)
+        self.clear()
+
+    def _write_master(self, rows):
+        ''' Write rows of data to a new file in the parquet dataset, and then
+            add it to the manifest. This also is called automatically on
+            :func:`close`, or when exiting a `with` block.
+        '''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if len(rows) == 0:
+            return
+
+        index = np.arange(self.last_index, self.last_index + len(rows))
+        arrays = OrderedDict([(self.index_label, pa.array(index))])
+
+        for name in sorted(set().union(*rows)):
+            array = self._arrow_array([row.get(name) for row in rows])
+            dtype = self._merge_type(self._schema.get(name), array.type)
+            if dtype != array.type:
+                array = array.cast(dtype)
+            self._schema[name] = dtype
+            arrays[name] = array
+
+        table = pa.Table.from_arrays(list(arrays.values()),
+                                     names=list(arrays.keys()))
+        strings = [name for name, array in arrays.items()
+                   if pa.types.is_string(array.type)]
+
+        filename = f'part-{len(self._manifest["files"]):06d}.parquet'
+        pq.write_table(table, os.path.join(self._dataset_path, filename),
+                       use_dictionary=strings)
+
+        self._manifest['files'].append(dict(path=filename, rows=len(rows),
+                                            first_id=int(index[0]),
+                                            last_id=int(index[-1])))
+        _write_parquet_manifest(self._dataset_path, self._manifest)
+
+        self.last_index += len(rows)
+
+    @staticmethod
+    def _arrow_array(values):
+        ''' Convert a list of column values into a typed arrow array. Columns
+            with mixed types that arrow can't reconcile are stored as text.
+        '''
+        import pyarrow as pa
+
+        try:
+            return pa.array(values, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return pa.array([None if v is None else str(v) for v in values],
+                            type=pa.string())
+
+    @staticmethod
+    def _merge_type(old, new):
+        ''' Choose the arrow type of a column that has been written as type
+            `old` (or None if it has not been written yet) and now has values of
+            type `new`.
+        '''
+        import pyarrow as pa
+
+        if old is None or pa.types.is_null(old):
+            return new
+        elif old == new or pa.types.is_null(new):
+            return old
+        elif (pa.types.is_integer(old) or pa.types.is_floating(old))\
+                and (pa.types.is_integer(new) or pa.types.is_floating(new)):
+            return pa.float64()
+        else:
+            return pa.string()
+
+
+def _read_parquet_manifest(path):
+    ''' Load the manifest of a parquet dataset directory written by
+        :class:`StatesToParquet`.
+    '''
+    import json
+
+    try:
+        with open(os.path.join(path, StatesToParquet.manifest_filename), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict(files=[])
+
+
+def _parquet_dataset_schema(path, manifest):
+    ''' Merge the schemas of each file listed in a parquet dataset manifest.
+
+        :return: OrderedDict of arrow types keyed by column name
+    '''
+    import pyarrow.parquet as pq
+
+    schema = OrderedDict()
+    for entry in manifest['files']:
+        for field in pq.read_schema(os.path.join(path, entry['path'])):
+            schema[field.name] = StatesToParquet._merge_type(
+                schema.get(field.name), field.type)
+    return schema
+
+
+def _write_parquet_manifest(path, manifest):
+    ''' Replace the manifest of a parquet dataset directory. The new manifest
+        is written to a temporary file first so that readers never see a
+        partial manifest.
+    '''
+    import json
+
+    manifest_path = os.path.join(path, StatesToParquet.manifest_filename)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
 def to_feather(data, path):
     '''
     Write a dataframe to a feather file on disk. Any index will be moved
@@ -1218,27 +1944,339 @@ def to_feather(data, path):
         data.columns.name = cname
 
 
+def to_numpy(data):
+    '''
+    Convert array-like data to a numpy array that can be saved without
+    pickling. Tables (DataFrames, and dicts of equal-length columns) become
+    structured arrays with one field per column; a DataFrame index is kept as
+    a field unless it is the default range index.
+
+    :param data: array-like data, Series, DataFrame, or dict of columns
+    :return: numpy.ndarray
+    '''
+
+    if isinstance(data, pd.DataFrame):
+        data = data.to_records(index=not isinstance(data.index, pd.RangeIndex))
+        data = np.asarray(data)
+    elif isinstance(data, pd.Series):
+        data = data.values
+    elif isinstance(data, dict):
+        columns = {str(k): np.asarray(v) for k, v in data.items()}
+        lengths = {len(v) for v in columns.values()}
+        if len(lengths) != 1:
+            raise ValueError('columns have different lengths')
+        out = np.empty(lengths.pop(),
+                       dtype=[(k, v.dtype, v.shape[1:]) for k, v in columns.items()])
+        for k, v in columns.items():
+            out[k] = v
+        data = out
+    else:
+        data = np.asarray(data)
+
+    if data.dtype.hasobject:
+        raise TypeError(f'cannot save object dtype {data.dtype} without pickling')
+    return data
+
+
+def read_npy(path_or_buf, columns=None, nrows=None, mmap_mode='r'):
+    ''' Load an array saved in relational data with nonscalar_file_type='npy'.
+        Files on disk are memory-mapped, so that no data are copied until they
+        are accessed.
+
+    :param path_or_buf: path to the .npy file, or a file-like object
+    :param columns: a field name (or list of field names) to select from a structured array, or None (default) to return all fields
+    :param nrows: number of rows of data to read, or None (default) to return all rows
+    :param mmap_mode: memory-mapping mode passed to numpy.load for files on disk, or None to read into memory
+    :return: numpy.ndarray (or numpy.memmap) instance
+    '''
+
+    if isinstance(path_or_buf, str):
+        data = np.load(path_or_buf, mmap_mode=mmap_mode, allow_pickle=False)
+    else:
+        data = np.load(path_or_buf, allow_pickle=False)
+
+    if columns is not None:
+        if data.dtype.names is None:
+            raise ValueError('columns can only be selected from structured arrays')
+        data = data[columns]
+    if nrows is not None:
+        data = data[:nrows]
+    return data
+
+
 def read_sqlite(path, table_name='master', columns=None, nrows=None,
-                index_col=StatesToRelationalTable.index_label):
-    ''' Wrapper to that uses pandas.read_sql_table to load a table from an sqlite database at the specified path.
+                index_col=StatesToRelationalTable.index_label, chunksize=None):
+    ''' Load a table from an sqlite database at the specified path. Only the
+    requested columns and rows are read from the database.
 
     :param path: sqlite database path
     :param table_name: name of table in the sqlite database
     :param columns: columns to query and return, or None (default) to return all columns
     :param nrows: number of rows of data to read, or None (default) to return all rows
     :param index_col: the name of the column to use as the index
+    :param chunksize: if not None, return an iterator of DataFrames with up to this many rows each, instead of a single DataFrame
     :return: pandas.DataFrame instance containing data loaded from `path`
     '''
 
-    from sqlalchemy import create_engine
+    return _query_sqlite(path, table_name=table_name, columns=columns,
+                         limit=nrows, index_col=index_col, chunksize=chunksize)
 
-    engine = create_engine(f'sqlite:///{path}')
-    df = pd.read_sql_table(
-        table_name, engine, index_col=index_col, columns=columns)
-    engine.dispose()
-    if nrows is not None:
-        df = df.iloc[:nrows]
-    return df
+
+_query_ops = {'==': '=', '=': '=', '!=': '!=', '<': '<', '<=': '<=',
+              '>': '>', '>=': '>=', 'in': 'in', 'not in': 'not in'}
+
+
+def _where_filters(where):
+    ''' Normalize a `where` argument of :func:`query` to a list of
+        (column, op, value) tuples
+    '''
+    if isinstance(where, dict):
+        return [(k, 'in', list(v)) if isinstance(v, (list, tuple, set))
+                else (k, '==', v)
+                for k, v in where.items()]
+
+    filters = [tuple(f) for f in where]
+    for f in filters:
+        if len(f) != 3 or f[1] not in _query_ops:
+            raise ValueError(f'invalid filter {repr(f)}; expected (column, op, value) with op in {tuple(_query_ops)}')
+    return filters
+
+
+def _query_sqlite(path, table_name='master', where=None, columns=None,
+                  limit=None, params=(), index_col=StatesToRelationalTable.index_label,
+                  chunksize=None, order_by=None):
+    ''' Run a select query on an sqlite database, and return the result
+        as a DataFrame (see :func:`query`)
+    '''
+    connection = sqlite3.connect(path)
+
+    try:
+        schema = dict([(r[1], r[2]) for r in
+                       connection.execute(f'pragma table_info({table_name})')])
+        if len(schema) == 0:
+            raise ValueError(f'no table named {repr(table_name)} in {path}')
+
+        if columns is None:
+            selected = list(schema)
+        else:
+            selected = list(columns)
+            if index_col in schema and index_col not in selected:
+                selected = [index_col] + selected
+        names = ', '.join([f'"{c}"' for c in selected])
+        sql = f'select {names} from {table_name}'
+
+        params = list(params)
+        if isinstance(where, str):
+            sql += f' where {where}'
+        elif where is not None:
+            clauses = []
+            for c, op, value in _where_filters(where):
+                if op in ('in', 'not in'):
+                    value = list(value)
+                    marks = ', '.join(len(value) * '?')
+                    clauses.append(f'"{c}" {op} ({marks})')
+                    params.extend(StatesToSQLite._sql_value(v) for v in value)
+                elif value is None and op in ('==', '=', '!='):
+                    clauses.append(f'"{c}" is {"not " if op == "!=" else ""}null')
+                else:
+                    clauses.append(f'"{c}" {_query_ops[op]} ?')
+                    params.append(StatesToSQLite._sql_value(value))
+            if len(clauses) > 0:
+                sql += ' where ' + ' and '.join(clauses)
+
+        # only sort on request, so that sqlite remains free to choose the
+        # index of a filtered column when there is a limit
+        if order_by is not None:
+            if isinstance(order_by, str):
+                order_by = [order_by]
+            sql += ' order by ' + ', '.join([f'"{c}"' for c in order_by])
+        if limit is not None:
+            sql += f' limit {int(limit)}'
+
+        # match the datetime parsing of pandas.read_sql_table
+        parse_dates = [c for c in selected
+                       if schema.get(c, '').upper() in ('TIMESTAMP', 'DATETIME', 'DATE')]
+
+        kws = dict(params=params,
+                   index_col=index_col if index_col in selected else None,
+                   parse_dates=parse_dates or None)
+        if chunksize is None:
+            return pd.read_sql_query(sql, connection, **kws)
+    finally:
+        connection.close()
+
+    def generate():
+        # the connection has to stay open while the chunks are generated
+        connection = sqlite3.connect(path)
+        try:
+            yield from pd.read_sql_query(sql, connection, chunksize=chunksize, **kws)
+        finally:
+            connection.close()
+
+    return generate()
+
+
+def query(path, where=None, columns=None, limit=None, params=(),
+          format='auto', index_col=StatesToRelationalTable.index_label,
+          order_by=None):
+    ''' Load only the rows of a master database that satisfy a filter. The
+        filter, column selection, and row limit are evaluated by sqlite for
+        sqlite databases (using any indexes created by :class:`StatesToSQLite`
+        through its `index_columns`), and by skipping row groups for parquet
+        databases. Other formats are loaded in full and then filtered.
+
+    :param path: path to the master database
+    :param where: a dictionary of {column: value} that must all match (a list value matches any of its items), a list of (column, op, value) tuples that must all be satisfied (op is one of '==', '!=', '<', '<=', '>', '>=', 'in', or 'not in'), an SQL expression string (sqlite only), or None (the default) to return all rows
+    :param columns: columns to return, or None (the default) to return all columns
+    :param limit: maximum number of rows to return, or None (the default) to return all matching rows
+    :param params: values for ? placeholders in an SQL `where` string
+    :param str format: data file format (see :func:`read`), or 'auto' (the default) to guess from the file extension
+    :param index_col: the name of the column to use as the index
+    :param order_by: a column name or list of column names to sort the rows by before applying `limit`, or None (the default) to return rows in the order they are read
+    :return: pandas.DataFrame instance containing the matching rows
+    '''
+
+    if format == 'auto':
+        format = os.path.splitext(split_compression(path)[0])[-1][1:]
+
+    if format in ('db', 'sqlite'):
+        return _query_sqlite(path, where=where, columns=columns, limit=limit,
+                             params=params, index_col=index_col, order_by=order_by)
+
+    if isinstance(where, str):
+        raise ValueError('SQL expressions for `where` are only supported for sqlite databases')
+    filters = None if where is None else _where_filters(where)
+
+    if format == 'parquet':
+        if filters is not None:
+            filters = [(c, '==' if op == '=' else op, v) for c, op, v in filters]
+        if order_by is None:
+            return read_parquet(path, columns=columns, nrows=limit,
+                                filters=filters, index_col=index_col)
+        df = read_parquet(path, filters=filters, index_col=index_col)
+        filters = None
+    else:
+        df = read(path, format=format)
+    if filters is not None:
+        ops = {'==': operator.eq, '=': operator.eq, '!=': operator.ne,
+               '<': operator.lt, '<=': operator.le, '>': operator.gt,
+               '>=': operator.ge}
+        mask = np.ones(len(df), dtype=bool)
+        for c, op, value in filters:
+            if op == 'in':
+                mask &= df[c].isin(list(value)).values
+            elif op == 'not in':
+                mask &= ~df[c].isin(list(value)).values
+            else:
+                mask &= ops[op](df[c], value).values
+        df = df[mask]
+    if order_by is not None:
+        df = df.sort_values(order_by, kind='stable')
+    if columns is not None:
+        df = df[list(columns)]
+    return df.iloc[:limit]
+
+
+def read_parquet(path, columns=None, nrows=None, filters=None,
+                 index_col=StatesToRelationalTable.index_label, chunksize=None):
+    ''' Load a master database written by :class:`StatesToParquet`, or any other
+        parquet file or dataset directory. Only the requested columns are read, and
+        `filters` are applied to skip row groups that do not match.
+
+    :param path: path to the parquet file or dataset directory
+    :param columns: columns to return, or None (default) to return all columns
+    :param nrows: number of rows of data to read, or None (default) to return all rows
+    :param filters: a pyarrow.dataset expression, or a list of (column, op, value) tuples (such as `[('dut', '==', 'DUT15')]`) that must all be satisfied, or None (default) to return all rows
+    :param index_col: the name of the column to use as the index
+    :param chunksize: if not None, return an iterator of DataFrames with up to this many rows each, instead of a single DataFrame
+    :return: pandas.DataFrame instance containing data loaded from `path`
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    manifest = _read_parquet_manifest(path) if os.path.isdir(path) else None
+    if manifest is not None and len(manifest['files']) > 0:
+        # Scan only the files in the manifest, as the merged schema
+        paths = [os.path.join(path, entry['path']) for entry in manifest['files']]
+        schema = pa.schema(list(_parquet_dataset_schema(path, manifest).items()))
+        dataset = ds.dataset(paths, schema=schema, format='parquet')
+    else:
+        dataset = ds.dataset(path, format='parquet')
+
+    if columns is not None:
+        columns = list(columns)
+        if index_col is not None and index_col not in columns\
+           and index_col in dataset.schema.names:
+            columns = [index_col] + columns
+
+    if isinstance(filters, (list, tuple)):
+        filters = pq.filters_to_expression(filters)
+
+    def to_pandas(table):
+        df = table.to_pandas()
+        if index_col is not None and index_col in df.columns:
+            df.set_index(index_col, inplace=True)
+        return df
+
+    if chunksize is not None:
+        batches = dataset.to_batches(columns=columns, filter=filters,
+                                     batch_size=chunksize)
+        return _record_batch_frames(batches, nrows, to_pandas)
+
+    if nrows is None:
+        table = dataset.to_table(columns=columns, filter=filters)
+    else:
+        table = dataset.head(nrows, columns=columns, filter=filters)
+
+    return to_pandas(table)
+
+
+def _record_batch_frames(batches, nrows, to_pandas):
+    ''' Generate DataFrames from an iterable of pyarrow record batches, ending
+        after `nrows` rows (or all rows, if `nrows` is None)
+    '''
+    import pyarrow as pa
+
+    remaining = nrows
+    for batch in batches:
+        if remaining is not None:
+            if remaining <= 0:
+                return
+            batch = batch.slice(0, remaining)
+            remaining -= batch.num_rows
+        if batch.num_rows > 0:
+            yield to_pandas(pa.Table.from_batches([batch]))
+
+
+def read_feather_chunks(path, columns=None, nrows=None, chunksize=1000):
+    ''' Generate DataFrames with up to `chunksize` rows each from a feather
+        file. The file is memory-mapped, so only the current chunk is
+        converted into memory.
+    '''
+    import pyarrow.feather as feather
+
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    return _record_batch_frames(table.to_batches(max_chunksize=chunksize),
+                                nrows, lambda t: t.to_pandas())
+
+
+compression_suffixes = {'lz4': '.lz4',
+                        'zstd': '.zst',
+                        'gzip': '.gz',
+                        'bz2': '.bz2'}
+
+
+def split_compression(name):
+    ''' Identify the compression codec of a file from its name.
+
+    :param str name: file name, like 'trace.csv.zst'
+    :return: tuple of (name without the codec suffix, codec or None)
+    '''
+    for codec, suffix in compression_suffixes.items():
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)], codec
+    return name, None
 
 
 reader_guess = {'p': pd.read_pickle,
@@ -1246,6 +2284,8 @@ reader_guess = {'p': pd.read_pickle,
                 'db': read_sqlite,
                 'sqlite': read_sqlite,
                 'json': pd.read_json,
+                'parquet': read_parquet,
+                'npy': read_npy,
                 'csv': pd.read_csv}
 
 try:
@@ -1256,36 +2296,70 @@ except BaseException:
         'feather format is not available in this pandas installation, and will not be supported in labbench')
 
 
-def read(path_or_buf, columns=None, nrows=None, format='auto', **kws):
+def read(path_or_buf, columns=None, nrows=None, format='auto',
+         compression='infer', chunksize=None, **kws):
     ''' Read tabular data from a file in one of various formats
     using pandas.
 
     :param str path: path to the  data file.
     :param columns: a column or iterable of multiple columns to return from the data file, or None (the default) to return all columns
     :param nrows: number of rows to read at the beginning of the table, or None (the default) to read all rows
-    :param str format: data file format, one of ['pickle','feather','csv','json','csv'], or 'auto' (the default) to guess from the file extension
+    :param str format: data file format, one of ['pickle','feather','csv','json','csv','db','parquet','npy'], or 'auto' (the default) to guess from the file extension
+    :param compression: codec used to compress the file (see `compression_suffixes`), None for an uncompressed file, or 'infer' (the default) to guess from the file extension
+    :param chunksize: if not None, return an iterator of DataFrames with up to this many rows each, instead of a single DataFrame. Only csv, sqlite, feather, and parquet files are read one chunk at a time; other formats are read in full, and then split into chunks.
     :param kws: additional keyword arguments to pass to the pandas read_<ext> function matching the file extension
-    :return: pandas.DataFrame instance containing data read from file
+    :return: pandas.DataFrame instance containing data read from file, or a numpy.ndarray for 'npy' files (see :func:`read_npy`)
     '''
 
     if isinstance(path_or_buf, str):
-        if os.path.getsize(path_or_buf) == 0:
+        # directories (such as parquet datasets) have size 0 on windows
+        if not os.path.isdir(path_or_buf) and os.path.getsize(path_or_buf) == 0:
             raise IOError('file is empty')
 
+        name, codec = split_compression(path_or_buf)
+        if compression == 'infer':
+            compression = codec
         if format == 'auto':
-            format = os.path.splitext(path_or_buf)[-1][1:]
+            format = os.path.splitext(name)[-1][1:]
     else:
+        if compression == 'infer':
+            compression = None
         if format == 'auto':
             raise ValueError(
                 "can only guess format for string path - specify extension")
 
+    if compression is not None:
+        import pyarrow as pa
+
+        if isinstance(path_or_buf, str):
+            source = pa.OSFile(path_or_buf)
+        else:
+            source = pa.PythonFile(path_or_buf, mode='r')
+        with pa.CompressedInputStream(source, compression) as stream:
+            path_or_buf = io.BytesIO(stream.read())
+
     try:
         reader = reader_guess[format]
     except KeyError as e:
         raise Exception(
             f"couldn't guess a reader from extension of file {path_or_buf}")
 
-    if reader == read_sqlite:
+    if chunksize is not None:
+        if reader in (read_sqlite, read_parquet):
+            return reader(path_or_buf, columns=columns, nrows=nrows,
+                          chunksize=chunksize, **kws)
+        elif reader == pd.read_csv:
+            return iter(reader(path_or_buf, usecols=columns, nrows=nrows,
+                               chunksize=chunksize, **kws))
+        elif reader == read_feather and isinstance(path_or_buf, str):
+            return read_feather_chunks(path_or_buf, columns=columns,
+                                       nrows=nrows, chunksize=chunksize)
+        else:
+            data = read(path_or_buf, columns=columns, nrows=nrows,
+                        format=format, compression=None, **kws)
+            return (data[i:i + chunksize] for i in range(0, len(data), chunksize))
+
+    if reader in (read_sqlite, read_parquet, read_npy):
         return reader(path_or_buf, columns=columns, nrows=nrows, **kws)
     elif reader == pd.read_csv:
         return reader(path_or_buf, usecols=columns, nrows=nrows, **kws)
@@ -1295,58 +2369,244 @@ def read(path_or_buf, columns=None, nrows=None, format='auto', **kws):
         return reader(path_or_buf, **kws)[columns].iloc[:nrows]
 
 
+class ReaderCache:
+    ''' A least-recently-used cache of data loaded by :class:`MungeReader`, so
+        that repeated reads of the same relational files skip parsing. Entries
+        are keyed by the path of each file together with its modification time
+        and size, so changed files are loaded again.
+
+        Share one instance between calls to :func:`read_relational` (through
+        its `cache` argument) to reuse loaded data between calls.
+
+        :param maxsize: the maximum total size of cached data in memory, in bytes. Memory-mapped arrays (such as those read from '.npy' files) count as `memmap_size` bytes each, instead of their full size.
+        :param path: a directory where loaded data are also saved in a binary (pickle) format so that they can be loaded quickly in later sessions, or None (the default) to cache only in memory
+    '''
+
+    memmap_size = 4096
+
+    def __init__(self, maxsize=256e6, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(hits={self.hits}, misses={self.misses}, ' \
+               f'disk_hits={self.disk_hits}, size={self.size})'
+
+    def get(self, key, load):
+        ''' Return the cached data for `key`, or call `load()` to load and
+            cache the data on a miss.
+
+        :param key: a hashable key identifying the file and its state
+        :param load: callable that takes no arguments and returns the data
+        :return: the data
+        '''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._share(self._entries[key][0])
+            self.misses += 1
+
+        value = self._load_disk(key)
+        if value is None:
+            value = load()
+            self._save_disk(key, value)
+        else:
+            with self._lock:
+                self.disk_hits += 1
+
+        size = self._sizeof(value)
+        with self._lock:
+            if key not in self._entries and size <= self.maxsize:
+                self._entries[key] = value, size
+                self.size += size
+                while self.size > self.maxsize:
+                    old, old_size = self._entries.popitem(last=False)[1]
+                    self.size -= old_size
+
+        return self._share(value)
+
+    def clear(self):
+        ''' Empty the in-memory cache and reset the counters. Files in the
+            on-disk cache are kept.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = self.misses = self.disk_hits = 0
+
+    @staticmethod
+    def _share(value):
+        # a shallow copy, so that callers that rename or add columns
+        # do not change the cached DataFrame
+        if isinstance(value, pd.DataFrame):
+            return value.copy(deep=False)
+        return value
+
+    @staticmethod
+    def _sizeof(value):
+        if isinstance(value, np.memmap):
+            # mapped pages are loaded and released on demand by the OS, so count
+            # only a nominal size that limits the number of open mappings
+            return ReaderCache.memmap_size
+        elif isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(index=True).sum())
+        elif isinstance(value, np.ndarray):
+            return value.nbytes
+        else:
+            return 0
+
+    def _disk_path(self, key):
+        import hashlib
+
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.pickle')
+
+    def _load_disk(self, key):
+        if self.path is None:
+            return None
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_disk(self, key, value):
+        if self.path is None:
+            return
+        path = self._disk_path(key)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(np.asarray(value) if isinstance(value, np.memmap) else value,
+                        f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+
 class MungeTarReader:
     tarnames = 'data.tar', 'data.tar.gz', 'data.tar.bz2', 'data.tar.lz4'
 
-    def __init__(self, path, tarname='data.tar'):
-        self.tarfile = tarfile.open(os.path.join(path, tarname), 'r')
+    def __init__(self, path, tarname='data.tar', cache=None):
+        tarpath = os.path.join(path, tarname)
+        self.tarfile = tarfile.open(tarpath, 'r')
+        self.cache = cache
+        self._tarpath = os.path.abspath(tarpath)
+        self._members = None
+        self._resolved = {}
+        self._lock = Lock()
+
+        index = TarIndex(tarpath)
+        if os.path.exists(index.path):
+            self._index = index.load()
+        else:
+            self._index = None
 
     def __call__(self, key, *args, **kws):
-        key = key.replace('\\\\', '\\')
+        name = self._resolve(key)
+        base, codec = split_compression(name)
+        ext = os.path.splitext(base)[1][1:]
 
-        for k in key,\
-                key.replace('\\', '/').replace('//', '/'):
-            try:
+        def load():
+            return read(self._extract(name), format=ext,
+                        compression=codec, *args, **kws)
 
-                ext = os.path.splitext(key)[1][1:]
-                return read(self.tarfile.extractfile(k), format=ext,
-                            *args, **kws)
-            except KeyError as e:
-                ex = e
-                continue
-            else:
-                break
+        if self.cache is None:
+            return load()
         else:
-            raise ex
+            cache_key = self._tarpath, name, self._stat(name), repr(args), repr(kws)
+            return self.cache.get(cache_key, load)
+
+    def _resolve(self, key):
+        ''' Find the name of the tar member that matches `key`, which may
+            have been written with windows path separators
+        '''
+        with self._lock:
+            if key in self._resolved:
+                return self._resolved[key]
+
+            k = key.replace('\\\\', '\\')
+            for name in k, k.replace('\\', '/').replace('//', '/'):
+                if (self._index is not None and name in self._index)\
+                   or name in self._member_dict():
+                    self._resolved[key] = name
+                    return name
+
+        raise KeyError(f'{repr(key)} not found in {self.tarfile.name}')
+
+    def _member_dict(self):
+        if self._members is None:
+            self._members = {m.name: m for m in self.tarfile.getmembers()}
+        return self._members
+
+    def _stat(self, name):
+        if self._index is not None and name in self._index:
+            return self._index[name]
+        m = self._member_dict()[name]
+        return m.offset_data, m.size, m.mtime
+
+    def _extract(self, name):
+        # The tar file is shared, so only one thread may seek and read it at
+        # a time; parsing the returned buffer can proceed in parallel
+        with self._lock:
+            if self._index is not None and name in self._index:
+                offset, size = self._index[name]
+                fileobj = self.tarfile.fileobj
+                fileobj.seek(offset)
+                return io.BytesIO(fileobj.read(size))
+
+            member = self._member_dict()[name]
+            return io.BytesIO(self.tarfile.extractfile(member).read())
 
 
 class MungeDirectoryReader:
-    def __init__(self, path):
+    def __init__(self, path, cache=None):
         self.path = path
+        self.cache = cache
 
     def __call__(self, key, *args, **kws):
-        return read(os.path.join(self.path, key), *args, **kws)
+        path = os.path.join(self.path, key)
+
+        if self.cache is None:
+            return read(path, *args, **kws)
+        else:
+            stat = os.stat(path)
+            cache_key = os.path.abspath(path), stat.st_mtime_ns, stat.st_size, \
+                repr(args), repr(kws)
+            return self.cache.get(cache_key, lambda: read(path, *args, **kws))
 
 
 class MungeReader:
     ''' Guess the type of munging performed on the relational data, and return
         a reader suited to loading that file.
 
+        :param path: path to the master database
+        :param cache: a :class:`ReaderCache` to reuse previously loaded data, a maximum cache size in bytes to create a new :class:`ReaderCache`, or None (the default) to load data on every call
     '''
     ''' TODO: Make this smarter, perhaps by trying to read an entry from
         the master database
     '''
-    def __new__(cls, path):
+    def __new__(cls, path, cache=None):
         dirname = os.path.dirname(path)
 
+        if cache is not None and not isinstance(cache, ReaderCache):
+            cache = ReaderCache(cache)
+
         for n in MungeTarReader.tarnames:
             if os.path.exists(os.path.join(dirname, n)):
-                return MungeTarReader(dirname, tarname=n)
-        return MungeDirectoryReader(dirname)
+                return MungeTarReader(dirname, tarname=n, cache=cache)
+        return MungeDirectoryReader(dirname, cache=cache)
 
 
 def read_relational(path, expand_col, master_cols=None, target_cols=None,
-                    master_nrows=None, master_format='auto', prepend_column_name=True):
+                    master_nrows=None, master_format='auto', prepend_column_name=True,
+                    master_filters=None, workers=1, lazy=False, chunksize=1000,
+                    cache=None):
     ''' Flatten a relational database table by loading the table located each row of
         `master[expand_col]`. The value of each column in this row
         is copied to the loaded table. The columns in the resulting table generated
@@ -1365,7 +2625,12 @@ def read_relational(path, expand_col, master_cols=None, target_cols=None,
         :param target_cols: a column (or array-like iterable of multiple columns) listing the master columns to include in the expanded dataframe, or None (the default) to pass all columns loaded from each master[expand_col]
         :param master_path: a string containing the full path to the master database (to help find the relational files)
         :param bool prepend_column_name: whether to prepend the name of the expanded column from the master database
-        :returns: the expanded dataframe
+        :param master_filters: row filters to apply when reading a parquet master database (see :func:`read_parquet`), or None (the default) to expand all rows. Other master formats raise ValueError.
+        :param int workers: number of threads that load relational files ahead of the expansion, or 1 (the default) to load them one at a time
+        :param bool lazy: if True, return a generator of expanded dataframes, each covering up to `chunksize` rows of the master database, instead of one dataframe. The master database is also read in chunks (see :func:`read`).
+        :param int chunksize: the number of master database rows read and expanded into each dataframe (only if `lazy` is True)
+        :param cache: a :class:`ReaderCache` that keeps loaded relational data for reuse between calls, or None (the default) to load all relational data
+        :returns: the expanded dataframe, or a generator of expanded dataframes if `lazy` is True
 
     '''
 
@@ -1377,34 +2642,104 @@ def read_relational(path, expand_col, master_cols=None, target_cols=None,
 
     if master_cols is not None:
         master_cols = list(master_cols) + [expand_col]
+    if master_filters is None:
+        master_kws = {}
+    else:
+        # only the parquet reader can apply filters as it reads
+        if master_format == 'auto':
+            fmt = os.path.splitext(split_compression(path)[0])[-1][1:]
+        else:
+            fmt = master_format
+        if reader_guess.get(fmt) is not read_parquet:
+            raise ValueError(f'master_filters are only supported for parquet master databases, '
+                             f'but the format of {path} is {repr(fmt)}; use query() to filter other formats')
+        master_kws = dict(filters=master_filters)
+    if lazy:
+        # the master database is read one chunk at a time, too
+        master_kws['chunksize'] = chunksize
     master = read(path, columns=master_cols,
-                  nrows=master_nrows, format=master_format)
-    reader = MungeReader(path)
-
-    def generate():
-        for i, row in master.iterrows():
-            if row[expand_col] is None or len(row[expand_col]) == 0:
-                continue
+                  nrows=master_nrows, format=master_format, **master_kws)
+    reader = MungeReader(path, cache=cache)
 
-            sub = reader(row[expand_col], columns=target_cols)
-
-            if prepend_column_name:
-                prepend = expand_col + '_'
-            else:
-                prepend = ''
+    if prepend_column_name:
+        prepend = expand_col + '_'
+    else:
+        prepend = ''
+
+    def valid_rows(master):
+        # Skip rows with no relational data
+        relpaths = master[expand_col]
+        return master[[isinstance(p, str) and len(p) > 0 for p in relpaths]]
+
+    def load(relpath):
+        sub = reader(relpath, columns=target_cols)
+        if isinstance(sub, np.ndarray):
+            sub = pd.DataFrame(sub)
+        return sub
+
+    def expand(master, subs):
+        # Concatenate once, then broadcast each master row across the
+        # length of its table in a single take
+        expanded = pd.concat(subs, sort=True)
+        expanded.columns = [prepend + str(c) for c in expanded.columns]
+        expanded[prepend + 'id'] = expanded.index
+        expanded.reset_index(drop=True, inplace=True)
+        expanded.drop(columns=master.columns.intersection(expanded.columns),
+                      inplace=True)
+
+        take = np.repeat(np.arange(len(master)), [len(sub) for sub in subs])
+        master = master.iloc[take].reset_index(drop=True)
+
+        return pd.concat([expanded, master], axis=1).sort_index(axis=1)
+
+    if not lazy:
+        master = valid_rows(master)
+        return expand(master, list(_prefetch(load, master[expand_col], workers)))
+
+    chunks = deque()
+
+    def relpaths():
+        for chunk in master:
+            chunk = valid_rows(chunk)
+            if len(chunk) > 0:
+                chunks.append(chunk)
+                yield from chunk[expand_col]
 
-            # Rename columns
-            sub.columns = [prepend + c for c in sub.columns]
-            sub[prepend + 'id'] = sub.index
+    def generate():
+        # Prefetching may run ahead into later master chunks. Each chunk is
+        # queued in `chunks` before its first path is loaded.
+        subs = _prefetch(load, relpaths(), workers)
+        try:
+            for first in subs:
+                chunk = chunks.popleft()
+                rest = [next(subs) for i in range(len(chunk) - 1)]
+                yield expand(chunk, [first] + rest)
+        finally:
+            subs.close()
 
-            # # Downselect master columns
-            # if master_cols is not None:
-            #     row = row[master_cols]
+    return generate()
 
-            # Add in columns from the master
-            for c, v in row.iteritems():
-                sub[c] = v
 
-            yield sub
+def _prefetch(func, items, workers):
+    ''' Generate func(item) for each of `items`, in order. If `workers` is more
+        than 1, a pool of `workers` threads evaluates calls ahead of the
+        consumer, with no more than 2*`workers` results in flight at once.
+    '''
+    if workers <= 1:
+        yield from map(func, items)
+        return
 
-    return pd.concat(generate(), ignore_index=True, sort=True)
+    items = iter(items)
+    executor = ThreadPoolExecutor(workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
@@ -24,17 +24,21 @@
 # legally bundled with the code in compliance with the conditions of those
 # licenses.
 
+import asyncio
 from collections import OrderedDict
+import contextlib
 from contextlib import contextmanager, _GeneratorContextManager
 from . import core
 import inspect
+import linecache
 import pandas as pd
 import os
-from queue import Queue, Empty
+from queue import Queue, Empty, SimpleQueue
 from sortedcontainers import SortedDict
 import sys
-from threading import Thread, ThreadError, Event
-from functools import wraps
+import threading
+from threading import Thread, ThreadError, Event, Lock, current_thread
+from functools import lru_cache, wraps
 import psutil
 
 from typing import Callable
@@ -42,10 +46,11 @@ from typing import Callable
 
 import time
 import traceback
+import weakref
 
-__all__ = ['concurrently', 'sequentially', 'Call', 'ConcurrentException',
+__all__ = ['concurrently', 'sequentially', 'async_concurrently', 'Call', 'ConcurrentException',
            'ConfigStore', 'ConcurrentRunner', 'FilenameDict', 'hash_caller',
-           'kill_by_name', 'check_master',
+           'kill_by_name', 'check_master', 'CancelToken',
            'retry', 'show_messages', 'sleep', 'stopwatch', 'ThreadSandbox',
            'ThreadEndedByMaster', 'until_timeout']
 
@@ -65,35 +70,162 @@ class ThreadEndedByMaster(ThreadError):
     '''
 
 
-concurrency_count = 0
-stop_request_event = Event()
+class CancelToken(object):
+    ''' A scope for cancelling calls that run in threads. Each call to
+        `concurrently` runs its callables in a new token that is a child of
+        the token of the calling thread, so cancelling a token also cancels
+        calls in nested `concurrently` (and `sequentially`) calls, but not those
+        in other scopes. `concurrently` cancels its token if the calling
+        thread raises an exception (such as KeyboardInterrupt) while it waits.
 
+        On cancel, waits in :func:`sleep` in the scope wake and raise
+        `ThreadEndedByMaster`, and callbacks registered with :func:`on_cancel`
+        are called, such as to close a connection to interrupt blocking I/O.
 
-def sleep(seconds, tick=1.):
-    ''' Drop-in replacement for time.sleep that raises ConcurrentException
-        if another thread requests that all threads stop.
+        Use a token in a `with` block to make it the scope of the current
+        thread. For example, to stop a procedure from another thread::
+
+            token = CancelToken()
+
+            def procedure():
+                with token:
+                    lb.concurrently(inst1.fetch, inst2.fetch)
+
+            # ... in another thread
+            token.cancel()
+
+        :param parent: the token that cancels this one, or None to use the token of the current thread
     '''
-    t0 = time.time()
-    global stop_request_event
-    remaining = 0
 
-    while True:
-        # Raise ConcurrentException if the stop_request_event is set
-        if stop_request_event.wait(min(remaining, tick)):
+    def __init__(self, parent=None):
+        self.__event = Event()
+        self.__lock = Lock()
+        self.__callbacks = []
+        self.__children = weakref.WeakSet()
+
+        if parent is None:
+            parent = CancelToken.current()
+        if parent is not None:
+            parent.__add_child(self)
+
+    @staticmethod
+    def current():
+        ''' The token of the current scope in this thread.
+        '''
+        stack = getattr(_scope, 'stack', None)
+        if not stack:
+            return _root_token
+        return stack[-1]
+
+    def cancel(self):
+        ''' Cancel this token and its children. Each callback is called once.
+        '''
+        with self.__lock:
+            if self.__event.is_set():
+                return
+            self.__event.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+            children = list(self.__children)
+
+        for func in callbacks:
+            try:
+                func()
+            except BaseException as e:
+                core.logger.warning(f'{repr(func)} raised {repr(e)} on cancel')
+        for child in children:
+            child.cancel()
+
+    def cancelled(self):
+        ''' Whether the token has been cancelled.
+        '''
+        return self.__event.is_set()
+
+    def check(self):
+        ''' Raise ThreadEndedByMaster if the token has been cancelled.
+        '''
+        if self.__event.is_set():
             raise ThreadEndedByMaster
 
-        remaining = seconds - (time.time() - t0)
+    def wait(self, timeout=None):
+        ''' Wait until the token is cancelled, or the timeout expires.
+
+            :param timeout: maximum time to wait in seconds, or None to wait indefinitely
+            :returns: whether the token has been cancelled
+        '''
+        return self.__event.wait(timeout)
+
+    def add_callback(self, func):
+        ''' Call `func` (with no arguments) when the token is cancelled. If it
+            has already been cancelled, call `func` now.
+        '''
+        with self.__lock:
+            if not self.__event.is_set():
+                self.__callbacks.append(func)
+                return
+        func()
+
+    def remove_callback(self, func):
+        ''' Remove a callback added by :func:`add_callback`, if it has not been called.
+        '''
+        with self.__lock:
+            if func in self.__callbacks:
+                self.__callbacks.remove(func)
+
+    @contextmanager
+    def on_cancel(self, func):
+        ''' Call `func` if the token is cancelled inside the `with` block. For
+            example, to interrupt a blocking read::
+
+                with lb.CancelToken.current().on_cancel(self.backend.close):
+                    self.backend.read()
+        '''
+        self.add_callback(func)
+        try:
+            yield
+        finally:
+            self.remove_callback(func)
+
+    def __add_child(self, child):
+        with self.__lock:
+            if not self.__event.is_set():
+                self.__children.add(child)
+                return
+        child.cancel()
+
+    def __enter__(self):
+        if not hasattr(_scope, 'stack'):
+            _scope.stack = []
+        _scope.stack.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _scope.stack.pop()
 
-        # Return normally if the sleep finishes as requested
-        if remaining <= 0:
-            return
+
+# The stack of CancelToken scopes entered in each thread
+_scope = threading.local()
+
+# The token of threads outside of any scope, which is the parent of the others
+_root_token = None
+_root_token = CancelToken()
+
+
+def sleep(seconds, tick=1.):
+    ''' Drop-in replacement for time.sleep that raises ThreadEndedByMaster
+        as soon as the `CancelToken` of the current scope is cancelled.
+
+        :param seconds: the time to sleep
+        :param tick: unused, kept for backward compatibility
+    '''
+    if CancelToken.current().wait(seconds):
+        raise ThreadEndedByMaster
 
 
 def check_master():
     ''' Raise ThreadEndedByMaster if the master thread as requested this
-        thread to end.
+        thread to end, by cancelling the `CancelToken` of the current scope.
     '''
-    sleep(0.)
+    CancelToken.current().check()
 
 
 def retry(exception_or_exceptions, tries=4, delay=0,
@@ -393,6 +525,7 @@ class Call(object):
         self.args = args
         self.kws = kws
         self.queue = None
+        self.token = None
 
         # This is a means for the main thread to raise an exception
         # if this is running in a separate thread
@@ -406,7 +539,11 @@ class Call(object):
 
     def __call__(self):
         try:
-            self.result = self.func(*self.args, **self.kws)
+            if self.token is None:
+                self.result = self.func(*self.args, **self.kws)
+            else:
+                with self.token:
+                    self.result = self.func(*self.args, **self.kws)
         except BaseException:
             self.result = None
             self.traceback = sys.exc_info()
@@ -423,6 +560,21 @@ class Call(object):
         '''
         self.queue = queue
 
+    def device(self, bound_only=False):
+        ''' The Device that this calls a method of, or that is the first
+            argument of the call (such as the __enter__ calls of
+            flexible_enter), or None.
+
+            :param bool bound_only: if True, only return the Device of a bound method
+        '''
+        device = getattr(self.func, '__self__', None)
+        if not isinstance(device, core.Device) and len(self.args) > 0 \
+                and not bound_only:
+            device = self.args[0]
+        if isinstance(device, core.Device):
+            return device
+        return None
+
     @classmethod
     def wrap_list_to_dict(cls, name_func_pairs):
         ''' Adjust naming and wrap callables with Call
@@ -444,6 +596,119 @@ class Call(object):
             
         return ret
 
+class PoolWorker(Thread):
+    ''' A thread in `ThreadPool` that runs calls from its queue until it
+        receives None.
+    '''
+
+    def __init__(self, pool, name, dedicated=False):
+        super().__init__(name=name, daemon=True)
+        self.pool = pool
+        self.dedicated = dedicated
+        self.calls = SimpleQueue()
+
+    def run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            try:
+                call()
+            finally:
+                # Drop the call (and any Device it references) before waiting
+                # for the next one, so that the Device can be garbage collected
+                # and its dedicated thread can end
+                del call
+            if not self.dedicated and not self.pool._release(self):
+                return
+
+
+class ThreadPool(object):
+    ''' A persistent pool of threads that run calls for `concurrently`, so that
+        each call does not start a new thread. A call is handed to an idle
+        thread if there is one, or else to a new thread, so nested calls never
+        wait for a free thread. At most `max_idle` threads are kept waiting for
+        more calls after they finish.
+
+        Calls to a Device with `settings.thread_affinity` enabled (such as
+        .NET and COM backends, which need objects to be used from the thread
+        that made them) always run in one dedicated thread for that device.
+
+        :param max_idle: the most finished threads to keep for reuse
+    '''
+
+    def __init__(self, max_idle=32):
+        self.max_idle = max_idle
+        self.__idle = []
+        self.__lock = Lock()
+        self.__dedicated = weakref.WeakKeyDictionary()
+        self.__count = 0
+
+    def submit(self, call):
+        ''' Run `call` in a thread from the pool.
+
+            :param call: a callable that takes no arguments, such as a `Call`
+        '''
+        device = self.affinity(call)
+        worker = None
+
+        with self.__lock:
+            if device is not None:
+                worker = self.__dedicated.get(device, None)
+                if worker is None:
+                    worker = self.__new_worker(f'{device} worker', dedicated=True)
+                    self.__dedicated[device] = worker
+                    weakref.finalize(device, worker.calls.put, None)
+            elif len(self.__idle) > 0:
+                worker = self.__idle.pop()
+            else:
+                worker = self.__new_worker(f'labbench worker {self.__count}')
+
+        if worker is current_thread():
+            # A nested call from the dedicated thread would wait for itself
+            call()
+        else:
+            worker.calls.put(call)
+
+    @staticmethod
+    def affinity(call):
+        ''' Find the Device that needs `call` to run in its dedicated thread.
+
+            :returns: the Device, or None if the call can run in any thread
+        '''
+        if not isinstance(call, Call):
+            call = Call(call)
+        device = call.device()
+        if device is not None and getattr(device.settings, 'thread_affinity', False):
+            return device
+        return None
+
+    def idle_count(self):
+        ''' The number of threads waiting for calls (not including dedicated threads)
+        '''
+        return len(self.__idle)
+
+    def __new_worker(self, name, dedicated=False):
+        self.__count += 1
+        worker = PoolWorker(self, name, dedicated)
+        worker.start()
+        return worker
+
+    def _release(self, worker):
+        ''' Return `worker` to the idle list after its call is finished.
+
+            :returns: False if the worker should exit instead
+        '''
+        with self.__lock:
+            if len(self.__idle) >= self.max_idle:
+                return False
+            self.__idle.append(worker)
+            return True
+
+
+thread_pool = ThreadPool()
+
+
 @contextmanager
 def flexible_enter(call_handler: Callable[[dict,list,dict],dict],
                     params: dict,
@@ -526,6 +791,7 @@ RUNNERS = {(False, False): None,
 
 DIR_DICT = set(dir(dict))
 
+@lru_cache(maxsize=None)
 def isdictducktype(cls):
     return set(dir(cls)).issuperset(DIR_DICT)  
 
@@ -579,8 +845,10 @@ def enter_or_call(flexible_caller, objs, kws):
             params[name] = kws.pop(name)
 
     if params['name'] is None:
-        stack = inspect.stack()
-        params['name'] = stack[2].code_context[0].strip()
+        # The source line of the caller. This avoids inspect.stack(), which
+        # is slow because it looks up the source of every frame in the stack.
+        frame = sys._getframe(2)
+        params['name'] = linecache.getline(frame.f_code.co_filename, frame.f_lineno).strip()
     
     # Combine the position and keyword arguments, and assign labels
     allobjs = list(objs) + list(kws.values())
@@ -642,8 +910,6 @@ def enter_or_call(flexible_caller, objs, kws):
         return ret
 
 def concurrently_call(params: dict, name_func_pairs: list) -> dict:
-    global concurrency_count
-
     def traceback_skip(exc_tuple, count):
         ''' Skip the first `count` traceback entries in
             an exception.
@@ -667,25 +933,30 @@ def concurrently_call(params: dict, name_func_pairs: list) -> dict:
                     f'{func.__self__} does not support concurrency')
         return func_in
 
-    stop_request_event.clear()
-
     results = {}
 
     catch = params['catch']
     traceback_delay = params['traceback_delay']
 
     # Setup calls then funcs
-    # Set up mappings between wrappers, threads, and the function to call
+    # Set up mappings between the names of running calls and wrappers
     wrappers = Call.wrap_list_to_dict(name_func_pairs)
-    threads = OrderedDict([(name, Thread(target=w))
-                           for name, w in wrappers.items()])
+    threads = OrderedDict()
 
-    # Start threads with calls to each function
+    # Run each function in a thread from the pool, in a new cancellation
+    # scope. Cancelling it interrupts I/O in the devices whose methods are
+    # called (but not devices that are only passed as arguments).
+    # Each wrapper puts itself into the `finished` queue when it returns.
+    token = CancelToken()
     finished = Queue()
-    for name, thread in list(threads.items()):
-        wrappers[name].set_queue(finished)
-        thread.start()
-        concurrency_count += 1
+    for name, wrapper in wrappers.items():
+        wrapper.set_queue(finished)
+        wrapper.token = token
+        device = wrapper.device(bound_only=True)
+        if device is not None:
+            token.add_callback(device.__cancel_io__)
+        thread_pool.submit(wrapper)
+        threads[name] = wrapper
 
     # As each thread ends, collect the return value and any exceptions
     tracebacks = []
@@ -704,7 +975,7 @@ def concurrently_call(params: dict, name_func_pairs: list) -> dict:
             continue
         except BaseException as e:
             master_exception = e
-            stop_request_event.set()
+            token.cancel()
             called = None
 
         if called is None:
@@ -721,30 +992,31 @@ def concurrently_call(params: dict, name_func_pairs: list) -> dict:
         if called.traceback is not None:
             tb = traceback_skip(called.traceback, 1)
             
-            if called.traceback[0] is not ThreadEndedByMaster:
+            # Exceptions after a cancel are usually caused by it, such as from
+            # closing a connection in the middle of a read
+            if called.traceback[0] is not ThreadEndedByMaster\
+                    and not token.cancelled():
 #                exception_count += 1
                 tracebacks.append(tb)
                 last_exception = called.traceback[1]
 
-            if not traceback_delay:
-                try:
-                    traceback.print_exception(*tb)
-                except BaseException as e:
-                    sys.stderr.write('\nthread exception, but failed to print exception')
-                    sys.stderr.write(str(e))
-                    sys.stderr.write('\n')
+                if not traceback_delay:
+                    try:
+                        traceback.print_exception(*tb)
+                    except BaseException as e:
+                        sys.stderr.write('\nthread exception, but failed to print exception')
+                        sys.stderr.write(str(e))
+                        sys.stderr.write('\n')
         else:
             if params['nones'] or called.result is not None:
                 results[called.name] = called.result
 
         # Remove this thread from the dictionary of running threads
         del threads[called.name]
-        concurrency_count -= 1
-    
-    # Clear the stop request, if there are no other threads that
-    # still need to exit
-    if concurrency_count == 0 and stop_request_event.is_set():
-        stop_request_event.clear()
+
+    # Stop this thread too if the scope was cancelled by a parent scope
+    if master_exception is None and token.cancelled():
+        raise ThreadEndedByMaster
 
     # Raise exceptions as necessary
     if master_exception is not None:        
@@ -843,11 +1115,14 @@ def sequentially_call(params: dict, name_func_pairs: list) -> dict:
 
     wrappers = Call.wrap_list_to_dict(name_func_pairs)
 
-    # Run each callable
+    # Run each callable, stopping if the current scope is cancelled
+    token = CancelToken.current()
     for name, wrapper in wrappers.items():
+        token.check()
         ret = wrapper()       
         if ret is not None or params['nones']:
             results[name] = ret
+    token.check()
 
     return results
 
@@ -908,6 +1183,141 @@ def sequentially(*objs, **kws):
     return enter_or_call(sequentially_call, objs, kws)
 
 
+async def async_concurrently_call(params: dict, name_coro_pairs: list) -> dict:
+    ''' Await the awaitables in `name_coro_pairs` concurrently in the running
+        event loop, and return their results with the dictionary conventions
+        of `concurrently_call`.
+    '''
+    rets = await asyncio.gather(*[coro for name, coro in name_coro_pairs],
+                                return_exceptions=True)
+
+    results = {}
+    exceptions = []
+    for (name, coro), ret in zip(name_coro_pairs, rets):
+        if isinstance(ret, BaseException):
+            exceptions.append(ret)
+        elif params['flatten'] and isdictducktype(ret.__class__):
+            conflicts = set(ret.keys()).intersection(results.keys())
+            if len(conflicts) > 0:
+                conflicts = ','.join(conflicts)
+                raise KeyError(f'conflicts in keys ({conflicts}) when merging return dictionaries')
+            results.update(ret)
+        elif ret is not None or params['nones']:
+            results[name] = ret
+
+    if len(exceptions) > 0 and not params['catch']:
+        for h in core.logger.handlers:
+            h.flush()
+        if len(exceptions) == 1:
+            raise exceptions[0]
+        for ex in exceptions:
+            traceback.print_exception(type(ex), ex, ex.__traceback__)
+        raise ConcurrentException(f'{len(exceptions)} call(s) raised exceptions')
+
+    return results
+
+
+@contextlib.asynccontextmanager
+async def async_enter(params: dict, name_context_pairs: list):
+    ''' Enter the asynchronous context managers in `name_context_pairs`
+        concurrently, and exit them concurrently at the end of the block.
+        As in `flexible_enter`, only contexts that have been entered are exited
+        in the event of an exception.
+    '''
+    entered = []
+
+    async def enter(c):
+        await c.__aenter__()
+        entered.append(c)
+
+    try:
+        await async_concurrently_call(dict(params, flatten=False),
+                                      [(name, enter(c)) for name, c in name_context_pairs])
+        yield
+    except BaseException:
+        exc = sys.exc_info()
+    else:
+        exc = (None, None, None)
+
+    rets = await asyncio.gather(*[c.__aexit__(*exc) for c in entered],
+                                return_exceptions=True)
+    for ret in rets:
+        if isinstance(ret, BaseException):
+            exc = type(ret), ret, ret.__traceback__
+
+    if exc != (None, None, None):
+        for h in core.logger.handlers:
+            h.flush()
+        raise exc[1]
+
+
+def async_concurrently(*objs, **kws):
+    r''' The asyncio counterpart to :func:`concurrently`. If `*objs` are
+        awaitables (such as coroutines), return a coroutine that awaits them
+        concurrently in the running event loop. If `*objs` are asynchronous
+        context managers (such as :class:`AsyncDevice` instances to be
+        connected), return an asynchronous context manager that enters them
+        concurrently. All of this runs in one thread, so it scales to many
+        more devices than threads would.
+
+        :param objs:  each argument may be an awaitable or an asynchronous context manager
+        :param kws: further awaitables or asynchronous context managers, with names set by the keyword
+        :param catch:  if `False` (the default), an exception is raised if any of the awaitables raise an exception; otherwise, any remaining successful results are returned as normal
+        :param nones: if True, include dictionary entries for awaitables that return None (default is False)
+        :param flatten: if `True`, results that are dictionaries are merged into the return dictionary with update (instead of passed through as dictionaries)
+        :return: the values returned by each awaitable, keyed by the name of its coroutine function or keyword
+        :rtype: dictionary
+
+        :Example: Get states from two devices at once
+
+        >>> async with lb.async_concurrently(inst1, inst2):
+        >>>     rets = await lb.async_concurrently(freq=inst1.state.aget('frequency'),
+        >>>                                        power=inst2.state.aget('power'))
+        >>> rets['freq']
+    '''
+    params = dict(catch=False, nones=False, flatten=True)
+
+    def is_context(obj):
+        return hasattr(obj, '__aenter__') and hasattr(obj, '__aexit__')
+
+    # Pull parameters from the passed keywords
+    for name in params.keys():
+        if name in kws and not inspect.isawaitable(kws[name]) and not is_context(kws[name]):
+            params[name] = kws.pop(name)
+
+    candidates = []
+    for obj in objs:
+        if is_context(obj):
+            name = f'{repr(obj)} at {hex(id(obj))}'
+        elif hasattr(obj, '__name__'):
+            name = obj.__name__
+        else:
+            raise TypeError(f'pass {repr(obj)} as a keyword argument to give it a name')
+        candidates.append((name, obj))
+    candidates += list(kws.items())
+
+    # Enforce uniqueness in the names and objects
+    names = [name for name, obj in candidates]
+    if len(set(names)) != len(names):
+        raise ValueError('each awaitable and context manager must have a unique name')
+    candidate_objs = [obj for name, obj in candidates]
+    if len(set(map(id, candidate_objs))) != len(candidate_objs):
+        raise ValueError('each awaitable and context manager must be unique')
+
+    contexts = [is_context(obj) for obj in candidate_objs]
+    if len(candidates) > 0 and all(contexts):
+        return async_enter(params, candidates)
+    elif any(contexts):
+        raise TypeError('cannot run a mixture of context managers and awaitables')
+
+    for name, obj in candidates:
+        if not inspect.isawaitable(obj):
+            raise TypeError(f'each argument must be an awaitable or an asynchronous '
+                            f'context manager, but given {name}={repr(obj)}')
+
+    return async_concurrently_call(params, candidates)
+
+
 OP_CALL = 'op'
 OP_GET = 'get'
 OP_SET = 'set'
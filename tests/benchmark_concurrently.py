@@ -0,0 +1,81 @@
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), an agency of the Federal Government.
+# Pursuant to title 17 United States Code Section 105, works of NIST employees
+# are not subject to copyright protection in the United States and are
+# considered to be in the public domain. Permission to freely use, copy,
+# modify, and distribute this software and its documentation without fee is
+# hereby granted, provided that this notice and disclaimer of warranty appears
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' WITHOUT ANY WARRANTY OF ANY KIND, EITHER
+# EXPRESSED, IMPLIED, OR STATUTORY, INCLUDING, BUT NOT LIMITED TO, ANY WARRANTY
+# THAT THE SOFTWARE WILL CONFORM TO SPECIFICATIONS, ANY IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, AND FREEDOM FROM
+# INFRINGEMENT, AND ANY WARRANTY THAT THE DOCUMENTATION WILL CONFORM TO THE
+# SOFTWARE, OR ANY WARRANTY THAT THE SOFTWARE WILL BE ERROR FREE. IN NO EVENT
+# SHALL NIST BE LIABLE FOR ANY DAMAGES, INCLUDING, BUT NOT LIMITED TO, DIRECT,
+# INDIRECT, SPECIAL OR CONSEQUENTIAL DAMAGES, ARISING OUT OF, RESULTING FROM,
+# OR IN ANY WAY CONNECTED WITH THIS SOFTWARE, WHETHER OR NOT BASED UPON
+# WARRANTY, CONTRACT, TORT, OR OTHERWISE, WHETHER OR NOT INJURY WAS SUSTAINED
+# BY PERSONS OR PROPERTY OR OTHERWISE, AND WHETHER OR NOT LOSS WAS SUSTAINED
+# FROM, OR AROSE OUT OF THE RESULTS OF, OR USE OF, THE SOFTWARE OR SERVICES
+# PROVIDED HEREUNDER. Distributions of NIST software should also include
+# copyright and licensing statements of any third-party software that are
+# legally bundled with the code in compliance with the conditions of those
+# licenses.
+
+
+''' Overhead of each call to concurrently. Run this as a script:
+
+        python benchmark_concurrently.py
+'''
+
+import importlib
+import sys
+import time
+from threading import Thread
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+import labbench as lb
+lb = importlib.reload(lb)
+
+
+def fetch1():
+    return 1
+
+
+def fetch2():
+    return 2
+
+
+def new_threads():
+    ''' The same calls in new threads for each call, as concurrently
+        did before it used a thread pool
+    '''
+    threads = [Thread(target=fetch1), Thread(target=fetch2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def overhead(func, count):
+    t0 = time.perf_counter()
+    for i in range(count):
+        func()
+    return (time.perf_counter() - t0) / count
+
+
+def benchmark_concurrently(count=5000):
+    ''' Time per call of concurrently with two functions that return
+        immediately, compared with starting and joining new threads
+    '''
+    print(f'concurrently overhead ({count} calls, us/call)')
+    pooled = overhead(lambda: lb.concurrently(fetch1, fetch2), count)
+    print(f"{'thread pool':>16}{pooled * 1e6:>10.1f}")
+    fresh = overhead(new_threads, count)
+    print(f"{'new threads':>16}{fresh * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    benchmark_concurrently()
@@ -0,0 +1,385 @@
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), an agency of the Federal Government.
+# Pursuant to title 17 United States Code Section 105, works of NIST employees
+# are not subject to copyright protection in the United States and are
+# considered to be in the public domain. Permission to freely use, copy,
+# modify, and distribute this software and its documentation without fee is
+# hereby granted, provided that this notice and disclaimer of warranty appears
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' WITHOUT ANY WARRANTY OF ANY KIND, EITHER
+# EXPRESSED, IMPLIED, OR STATUTORY, INCLUDING, BUT NOT LIMITED TO, ANY WARRANTY
+# THAT THE SOFTWARE WILL CONFORM TO SPECIFICATIONS, ANY IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, AND FREEDOM FROM
+# INFRINGEMENT, AND ANY WARRANTY THAT THE DOCUMENTATION WILL CONFORM TO THE
+# SOFTWARE, OR ANY WARRANTY THAT THE SOFTWARE WILL BE ERROR FREE. IN NO EVENT
+# SHALL NIST BE LIABLE FOR ANY DAMAGES, INCLUDING, BUT NOT LIMITED TO, DIRECT,
+# INDIRECT, SPECIAL OR CONSEQUENTIAL DAMAGES, ARISING OUT OF, RESULTING FROM,
+# OR IN ANY WAY CONNECTED WITH THIS SOFTWARE, WHETHER OR NOT BASED UPON
+# WARRANTY, CONTRACT, TORT, OR OTHERWISE, WHETHER OR NOT INJURY WAS SUSTAINED
+# BY PERSONS OR PROPERTY OR OTHERWISE, AND WHETHER OR NOT LOSS WAS SUSTAINED
+# FROM, OR AROSE OUT OF THE RESULTS OF, OR USE OF, THE SOFTWARE OR SERVICES
+# PROVIDED HEREUNDER. Distributions of NIST software should also include
+# copyright and licensing statements of any third-party software that are
+# legally bundled with the code in compliance with the conditions of those
+# licenses.
+
+''' Throughput and memory benchmarks for the master database writers. Run this
+    as a script:
+
+        python benchmark_db.py
+'''
+
+import copy
+import importlib
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+import labbench as lb
+import numpy as np
+import pandas as pd
+lb = importlib.reload(lb)
+
+
+def make_rows(count, columns=40):
+    ''' Rows of the kind produced by StateAggregator: mostly floats, plus
+        some integers and short strings.
+    '''
+    rng = np.random.RandomState(0)
+    rows = []
+    for i in range(count):
+        row = {f'inst{j}_value': rng.uniform() for j in range(columns)}
+        row.update(host_time=f'2019-10-09 12:00:{i % 60:02d}.{i}',
+                   inst_count=i,
+                   dut='DUT15')
+        rows.append(row)
+    return rows
+
+
+def pandas_sqlite_write(path, batches):
+    ''' The previous StatesToSQLite path: a DataFrame per batch pushed through
+        sqlalchemy with DataFrame.to_sql
+    '''
+    from sqlalchemy import create_engine
+
+    engine = create_engine(f"sqlite:///{os.path.join(path, 'master.db')}")
+    last_index = 0
+    for batch in batches:
+        df = pd.DataFrame(batch)
+        df.index += last_index
+        df.to_sql('master', engine, if_exists='append',
+                  index=True, index_label='id')
+        last_index += len(batch)
+    engine.dispose()
+
+
+def labbench_sqlite_write(path, batches):
+    db = lb.StatesToSQLite(path)
+    db.open()
+    for batch in batches:
+        db._write_master(batch)
+    db.close()
+
+
+def rows_per_second(func, rows, batch_size):
+    batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    with tempfile.TemporaryDirectory() as path:
+        t0 = time.perf_counter()
+        func(path, batches)
+        return len(rows) / (time.perf_counter() - t0)
+
+
+def benchmark_sqlite(count=20000):
+    rows = make_rows(count)
+    print(f'master database writes ({count} rows, rows/s)')
+    print(f"{'batch size':>12}{'pandas':>12}{'labbench':>12}")
+    for batch_size in (1, 10, 100, 1000):
+        n = count // 20 if batch_size == 1 else count
+        pandas_rate = rows_per_second(pandas_sqlite_write, rows[:n], batch_size)
+        lb_rate = rows_per_second(labbench_sqlite_write, rows[:n], batch_size)
+        print(f'{batch_size:>12}{pandas_rate:>12.0f}{lb_rate:>12.0f}')
+
+
+def pandas_csv_write(path, batches):
+    ''' The previous StatesToCSV path: DataFrame.append onto the retained
+        frame, then DataFrame.to_csv, for each batch
+    '''
+    path = os.path.join(path, 'master.csv')
+    warnings.simplefilter('ignore', FutureWarning)
+    df = None
+    last_index = 0
+    for batch in batches:
+        isfirst = df is None
+        pending = pd.DataFrame(batch)
+        pending.index += last_index
+        if isfirst:
+            df = pending
+        else:
+            df = df.append(pending).loc[last_index:]
+        df.sort_index(inplace=True)
+        last_index = df.index[-1]
+        with open(path, 'a') as f:
+            df.to_csv(f, header=isfirst, index=False)
+
+
+def labbench_csv_write(path, batches):
+    db = lb.StatesToCSV(os.path.join(path, 'master'))
+    db.open()
+    for batch in batches:
+        db._write_master(batch)
+    db.close()
+
+
+def peak_memory(func, rows, batch_size):
+    ''' Returns (peak traced memory in MB, seconds per flush for the first
+        and last 10 batches)
+    '''
+    batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    times = []
+
+    def timed(path, batches):
+        def each():
+            for batch in batches:
+                t0 = time.perf_counter()
+                yield batch
+                times.append(time.perf_counter() - t0)
+        func(path, each())
+
+    with tempfile.TemporaryDirectory() as path:
+        tracemalloc.start()
+        timed(path, batches)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return peak / 1e6, np.mean(times[:10]), np.mean(times[-10:])
+
+
+def benchmark_csv(count=1000000, batch_size=1000):
+    rows = make_rows(count, columns=5)
+    print(f'csv master database writes ({count} rows, batch size {batch_size})')
+    print(f"{'':>12}{'peak MB':>12}{'first (s)':>12}{'last (s)':>12}")
+    for name, func in (('pandas', pandas_csv_write),
+                       ('labbench', labbench_csv_write)):
+        peak, first, last = peak_memory(func, rows, batch_size)
+        print(f'{name:>12}{peak:>12.1f}{first:>12.4f}{last:>12.4f}')
+
+
+def iterrows_read_relational(path, expand_col, prepend_column_name=True):
+    ''' The previous read_relational: iterrows over the master database,
+        assigning each master column into each loaded table
+    '''
+    master = lb.read(path)
+    reader = lb.data.MungeReader(path)
+
+    def generate():
+        for i, row in master.iterrows():
+            if row[expand_col] is None or len(row[expand_col]) == 0:
+                continue
+
+            sub = reader(row[expand_col])
+            prepend = expand_col + '_' if prepend_column_name else ''
+            sub.columns = [prepend + c for c in sub.columns]
+            sub[prepend + 'id'] = sub.index
+            for c, v in row.iteritems():
+                sub[c] = v
+            yield sub
+
+    return pd.concat(generate(), ignore_index=True, sort=True)
+
+
+def benchmark_read_relational(count=2000, points=100):
+    warnings.simplefilter('ignore', FutureWarning)
+    rows = make_rows(count)
+    with tempfile.TemporaryDirectory() as path:
+        with lb.StatesToSQLite(path) as db:
+            for row in rows:
+                db.append(trace=pd.DataFrame({'power': np.arange(points, dtype=float)}),
+                          **row)
+            db.write()
+
+        master_path = os.path.join(path, 'master.db')
+        print(f'read_relational ({count} rows, {points} points per table)')
+        for name, func, kws in (('iterrows', iterrows_read_relational, {}),
+                                ('labbench', lb.read_relational, {}),
+                                ('8 workers', lb.read_relational, dict(workers=8))):
+            t0 = time.perf_counter()
+            df = func(master_path, 'trace', **kws)
+            print(f'{name:>12}{time.perf_counter() - t0:>12.2f} s{df.shape}')
+
+
+def benchmark_query(count=1000000, batch_size=10000):
+    ''' Select one DUT from a large campaign, with and without an index
+    '''
+    rng = np.random.RandomState(0)
+    print(f'query one DUT ({count} rows)')
+    for index_columns in (['host_time'], ['host_time', 'dut']):
+        with tempfile.TemporaryDirectory() as path:
+            db = lb.StatesToSQLite(path, index_columns=index_columns)
+            db.open()
+            for start in range(0, count, batch_size):
+                db._write_master([{'dut': f'DUT{rng.randint(1000)}',
+                                   'host_time': f'{i}',
+                                   'value': rng.uniform()}
+                                  for i in range(start, start + batch_size)])
+            db.close()
+
+            master_path = os.path.join(path, 'master.db')
+            t0 = time.perf_counter()
+            df = lb.query(master_path, where={'dut': 'DUT15'})
+            query_time = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            full = lb.read(master_path)
+            full = full[full['dut'] == 'DUT15']
+            read_time = time.perf_counter() - t0
+
+        print(f"{'indexed ' + ', '.join(index_columns):>24}: query {query_time:.3f} s, "
+              f"read and filter {read_time:.3f} s ({len(df)} rows)")
+
+
+class TraceDevice(lb.Device):
+    class settings(lb.Device.settings):
+        trace = lb.List([])
+        frequency = lb.Float(0.)
+
+
+def legacy_append(db, do_copy, **kwargs):
+    ''' The previous StatesToRelationalTable.append
+    '''
+    row = {}
+    row.update(copy.deepcopy(dict(db.get()) if do_copy else dict(db.get())))
+    row.update(copy.deepcopy(dict(kwargs)) if do_copy else dict(kwargs))
+    db.pending.append(row)
+    return row
+
+
+def benchmark_append(count=200, points=100000, states=40):
+    ''' Append rows while a large trace setting stays the same, and a scalar
+        setting changes on every row
+    '''
+    print(f'append ({points}-point trace state, {states} scalar states, rows/s)')
+    print(f"{'copy':>12}{'previous':>12}{'labbench':>12}")
+    with tempfile.TemporaryDirectory() as path:
+        devices = [TraceDevice() for i in range(states)]
+        db = lb.StatesToRelationalTable(path)
+        db.observe_states(db.host, always=['time'])
+        db.name.update({d: f'dev{i}' for i, d in enumerate(devices)})
+        db.observe_settings(devices)
+        devices[0].settings.trace = np.arange(points, dtype=float).tolist()
+
+        for do_copy in (False, True):
+            rates = []
+            for append in (lambda **kws: legacy_append(db, do_copy, **kws),
+                           lambda **kws: db.append(copy=do_copy, **kws)):
+                db.clear()
+                t0 = time.perf_counter()
+                for i in range(count):
+                    for dev in devices[1:]:
+                        dev.settings.frequency = i
+                    append(index=i)
+                rates.append(count / (time.perf_counter() - t0))
+            print(f'{str(do_copy):>12}{rates[0]:>12.0f}{rates[1]:>12.0f}')
+
+
+def legacy_get(db):
+    ''' The previous StateAggregator.get, which worked through the
+        observed states of each device on every call
+    '''
+    always = db._StateAggregator__always
+    never = db._StateAggregator__never
+    auto = db._StateAggregator__auto
+
+    for device, name in list(db.name.items()):
+        for owner in (device.state, device.settings):
+            if owner in always.keys():
+                for attr in always[owner]:
+                    if attr not in owner.traits():
+                        raise Exception(
+                            f'the requested state {attr} does not exist in {device}')
+                    auto[db.key(name, attr)] = getattr(owner, attr)
+            if owner in never.keys():
+                for attr in never[owner]:
+                    auto.pop(db.key(name, attr), None)
+
+    return db._spy()
+
+
+class ScalarDevice(lb.Device):
+    class settings(lb.Device.settings):
+        value0 = lb.Float(0.)
+        value1 = lb.Float(0.)
+        value2 = lb.Float(0.)
+        value3 = lb.Float(0.)
+        value4 = lb.Float(0.)
+
+
+def benchmark_get(count=2000, devices=20):
+    ''' Aggregate the `always` settings of several devices at a high rate
+    '''
+    states = [f'value{i}' for i in range(5)]
+    print(f'get ({devices} devices, {len(states)} settings each, gets/s)')
+    print(f"{'previous':>12}{'labbench':>12}")
+
+    with tempfile.TemporaryDirectory() as path,\
+            lb.StatesToCSV(os.path.join(path, 'master')) as db:
+        devs = [ScalarDevice() for i in range(devices)]
+        db.name.update({d: f'dev{i}' for i, d in enumerate(devs)})
+        db.observe_settings(devs, always=states)
+
+        rates = []
+        for get in (lambda: legacy_get(db), db.get):
+            t0 = time.perf_counter()
+            for i in range(count):
+                get()
+            rates.append(count / (time.perf_counter() - t0))
+        print(f'{rates[0]:>12.0f}{rates[1]:>12.0f}')
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, dirs, files in os.walk(path) for name in files)
+
+
+def benchmark_compression(count=50, points=100000):
+    ''' Write and read back 100k-point traces for each compression codec
+    '''
+    rng = np.random.RandomState(0)
+    # a noisy, quantized trace compresses roughly like instrument data
+    traces = [np.round(rng.normal(-80, 3, points), 2) for i in range(count)]
+
+    print(f'relational compression ({count} traces of {points} points)')
+    print(f"{'codec':>12}{'write MB/s':>12}{'ratio':>12}{'read (ms)':>12}")
+    for codec in (None, 'lz4', 'zstd'):
+        with tempfile.TemporaryDirectory() as path:
+            t0 = time.perf_counter()
+            with lb.StatesToSQLite(path, compression=codec) as db:
+                for trace in traces:
+                    db.append(trace=trace)
+                db.write()
+            elapsed = time.perf_counter() - t0
+            size = directory_size(path)
+
+            master = lb.read(os.path.join(path, 'master.db'))
+            relpaths = [os.path.join(path, p) for p in master['trace']]
+            raw = sum(os.path.getsize(p) for p in relpaths) if codec is None\
+                else raw
+            t0 = time.perf_counter()
+            for p in relpaths:
+                lb.read(p)
+            read_ms = 1e3 * (time.perf_counter() - t0) / count
+
+        print(f'{str(codec):>12}{raw / elapsed / 1e6:>12.1f}{raw / size:>12.2f}{read_ms:>12.1f}')
+
+
+if __name__ == '__main__':
+    benchmark_sqlite()
+    benchmark_csv()
+    benchmark_compression()
+    benchmark_read_relational()
+    benchmark_query()
+    benchmark_append()
+    benchmark_get()
@@ -0,0 +1,83 @@
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), an agency of the Federal Government.
+# Pursuant to title 17 United States Code Section 105, works of NIST employees
+# are not subject to copyright protection in the United States and are
+# considered to be in the public domain. Permission to freely use, copy,
+# modify, and distribute this software and its documentation without fee is
+# hereby granted, provided that this notice and disclaimer of warranty appears
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' WITHOUT ANY WARRANTY OF ANY KIND, EITHER
+# EXPRESSED, IMPLIED, OR STATUTORY, INCLUDING, BUT NOT LIMITED TO, ANY WARRANTY
+# THAT THE SOFTWARE WILL CONFORM TO SPECIFICATIONS, ANY IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, AND FREEDOM FROM
+# INFRINGEMENT, AND ANY WARRANTY THAT THE DOCUMENTATION WILL CONFORM TO THE
+# SOFTWARE, OR ANY WARRANTY THAT THE SOFTWARE WILL BE ERROR FREE. IN NO EVENT
+# SHALL NIST BE LIABLE FOR ANY DAMAGES, INCLUDING, BUT NOT LIMITED TO, DIRECT,
+# INDIRECT, SPECIAL OR CONSEQUENTIAL DAMAGES, ARISING OUT OF, RESULTING FROM,
+# OR IN ANY WAY CONNECTED WITH THIS SOFTWARE, WHETHER OR NOT BASED UPON
+# WARRANTY, CONTRACT, TORT, OR OTHERWISE, WHETHER OR NOT INJURY WAS SUSTAINED
+# BY PERSONS OR PROPERTY OR OTHERWISE, AND WHETHER OR NOT LOSS WAS SUSTAINED
+# FROM, OR AROSE OUT OF THE RESULTS OF, OR USE OF, THE SOFTWARE OR SERVICES
+# PROVIDED HEREUNDER. Distributions of NIST software should also include
+# copyright and licensing statements of any third-party software that are
+# legally bundled with the code in compliance with the conditions of those
+# licenses.
+
+''' Rates of gets and sets of device state traits. Run this as a script:
+
+        python benchmark_states.py
+'''
+
+import importlib
+import sys
+import time
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+import labbench as lb
+lb = importlib.reload(lb)
+
+
+class EmulatedInstrument(lb.EmulatedVISADevice):
+    class state(lb.EmulatedVISADevice.state):
+        count = lb.Int(command='COUN', min=0, max=1000)
+        frequency = lb.Float(command='FREQ', min=10e6, max=18e9)
+        label = lb.Unicode(command='LAB')
+        output = lb.Bool(command='OUTP', remap={False: '0', True: '1'})
+
+
+values = dict(count=5, frequency=1e9, label='text', output=True)
+
+
+def rate(func, count):
+    t0 = time.perf_counter()
+    for i in range(count):
+        func()
+    return count / (time.perf_counter() - t0)
+
+
+def benchmark_traits(count=20000):
+    ''' Gets and sets per second for each type of state trait, with and
+        without an observer registered on the state
+    '''
+    print(f"state traits ({count} calls, calls/s)")
+    print(f"{'trait':>12}{'op':>6}{'observed':>12}{'unobserved':>12}")
+
+    with EmulatedInstrument() as inst:
+        def observer(change):
+            pass
+
+        for name, value in values.items():
+            for op, func in (('get', lambda: getattr(inst.state, name)),
+                             ('set', lambda: setattr(inst.state, name, value))):
+                inst.state.observe(observer)
+                observed = rate(func, count)
+                inst.state.unobserve(observer)
+                # Make sure this times the path without notification
+                assert not inst.state.traits()[name]._observed(inst.state)
+                unobserved = rate(func, count)
+                print(f'{name:>12}{op:>6}{observed:>12.0f}{unobserved:>12.0f}')
+
+
+if __name__ == '__main__':
+    benchmark_traits()
@@ -0,0 +1,263 @@
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), an agency of the Federal Government.
+# Pursuant to title 17 United States Code Section 105, works of NIST employees
+# are not subject to copyright protection in the United States and are
+# considered to be in the public domain. Permission to freely use, copy,
+# modify, and distribute this software and its documentation without fee is
+# hereby granted, provided that this notice and disclaimer of warranty appears
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED 'AS IS' WITHOUT ANY WARRANTY OF ANY KIND, EITHER
+# EXPRESSED, IMPLIED, OR STATUTORY, INCLUDING, BUT NOT LIMITED TO, ANY WARRANTY
+# THAT THE SOFTWARE WILL CONFORM TO SPECIFICATIONS, ANY IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, AND FREEDOM FROM
+# INFRINGEMENT, AND ANY WARRANTY THAT THE DOCUMENTATION WILL CONFORM TO THE
+# SOFTWARE, OR ANY WARRANTY THAT THE SOFTWARE WILL BE ERROR FREE. IN NO EVENT
+# SHALL NIST BE LIABLE FOR ANY DAMAGES, INCLUDING, BUT NOT LIMITED TO, DIRECT,
+# INDIRECT, SPECIAL OR CONSEQUENTIAL DAMAGES, ARISING OUT OF, RESULTING FROM,
+# OR IN ANY WAY CONNECTED WITH THIS SOFTWARE, WHETHER OR NOT BASED UPON
+# WARRANTY, CONTRACT, TORT, OR OTHERWISE, WHETHER OR NOT INJURY WAS SUSTAINED
+# BY PERSONS OR PROPERTY OR OTHERWISE, AND WHETHER OR NOT LOSS WAS SUSTAINED
+# FROM, OR AROSE OUT OF THE RESULTS OF, OR USE OF, THE SOFTWARE OR SERVICES
+# PROVIDED HEREUNDER. Distributions of NIST software should also include
+# copyright and licensing statements of any third-party software that are
+# legally bundled with the code in compliance with the conditions of those
+# licenses.
+
+
+import asyncio
+import numpy as np
+import unittest
+import importlib
+import sys
+import threading
+import time
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+import labbench as lb
+lb = importlib.reload(lb)
+
+
+class FakeSCPIServer(object):
+    ''' Respond to SCPI messages on a local TCP socket, like an instrument
+    '''
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.values = {'FREQ': '1e9', 'OUTP': 'OFF', 'LAB': 'a'}
+        self.messages = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f'TCPIP0::127.0.0.1::{port}::SOCKET'
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        while True:
+            try:
+                msg = (await reader.readuntil(b'\n'))[:-1]
+            except asyncio.IncompleteReadError:
+                break
+            self.messages.append(msg)
+            if msg == b'TRAC?':
+                data = np.arange(100, dtype='<f4').tobytes()
+                writer.write(b'#3400' + data + b'\n')
+            elif msg.startswith(b'TRAC '):
+                pass
+            elif msg.endswith(b'?'):
+                await asyncio.sleep(self.delay)
+                queries = [q.lstrip(':')[:-1] for q in msg.decode().split(';')]
+                writer.write(';'.join([self.values[q] for q in queries]).encode() + b'\n')
+            else:
+                for command in msg.decode().split(';'):
+                    key, value = command.lstrip(':').split(' ', 1)
+                    self.values[key] = value
+        writer.close()
+
+
+class AsyncMock(lb.AsyncVISADevice):
+    class state(lb.AsyncVISADevice.state):
+        frequency = lb.Float(command='FREQ', min=0)
+        output = lb.Bool(command='OUTP', remap={False: 'OFF', True: 'ON'})
+        label = lb.Unicode()
+        trace = lb.Array(command='TRAC', dtype='<f4')
+
+    @state.label.getter
+    def _(self):
+        return self.query('LAB?')
+
+
+class AsyncEmulated(lb.AsyncDevice, lb.EmulatedVISADevice):
+    class state(lb.EmulatedVISADevice.state):
+        frequency = lb.Float(command='FREQ', min=0, max=10)
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+class TestAsyncDevice(unittest.TestCase):
+    def test_aget_aset(self):
+        async def main():
+            server = FakeSCPIServer()
+            async with AsyncMock(await server.start()) as inst:
+                self.assertEqual(await inst.state.aget('frequency'), 1e9)
+                await inst.state.aset('output', True)
+                self.assertEqual(await inst.state.aget('output'), True)
+            await server.stop()
+            return server.messages
+
+        self.assertEqual(run(main()), [b'FREQ?', b'OUTP ON', b'OUTP?'])
+
+    def test_custom_getter(self):
+        async def main():
+            server = FakeSCPIServer()
+            async with AsyncMock(await server.start()) as inst:
+                ret = await inst.state.aget('label')
+            await server.stop()
+            return ret
+
+        self.assertEqual(run(main()), 'a')
+
+    def test_array(self):
+        async def main():
+            server = FakeSCPIServer()
+            async with AsyncMock(await server.start()) as inst:
+                ret = await inst.state.aget('trace')
+            await server.stop()
+            return ret
+
+        np.testing.assert_array_equal(run(main()), np.arange(100))
+
+    def test_blocking_in_loop(self):
+        async def main():
+            server = FakeSCPIServer()
+            async with AsyncMock(await server.start()) as inst:
+                with self.assertRaises(lb.DeviceStateError):
+                    inst.state.frequency
+            await server.stop()
+
+        run(main())
+
+    def test_blocking_from_thread(self):
+        def blocking(inst):
+            values = inst.state.get_many(['frequency', 'output'])
+            inst.state.update(frequency=2e9, output=True)
+            future = inst.query_async('FREQ?')
+            inst.write_binary('TRAC ', np.arange(4, dtype='<f4'))
+            into = np.zeros(200, dtype='<f4')
+            trace = inst.query_binary('TRAC?', '<f4', into=into)
+            return values, future.result(), trace, into
+
+        async def main():
+            server = FakeSCPIServer()
+            async with AsyncMock(await server.start()) as inst:
+                ret = await asyncio.get_running_loop().run_in_executor(None, blocking, inst)
+            await server.stop()
+            return ret, server.messages
+
+        (values, freq, trace, into), messages = run(main())
+        self.assertEqual(values, dict(frequency=1e9, output=False))
+        self.assertEqual(freq, '2000000000.0')
+        np.testing.assert_array_equal(trace, np.arange(100))
+        np.testing.assert_array_equal(into[:100], np.arange(100))
+        self.assertEqual(messages[:3], [b'FREQ?;:OUTP?', b'FREQ 2000000000.0;:OUTP ON', b'FREQ?'])
+        self.assertEqual(messages[3], b'TRAC #216' + np.arange(4, dtype='<f4').tobytes())
+
+    def test_sync_connect(self):
+        with self.assertRaises(lb.ConnectionError):
+            AsyncMock('TCPIP0::127.0.0.1::5025::SOCKET').connect()
+
+    def test_bad_resource(self):
+        async def main():
+            async with AsyncMock('USB0::0x2A8D::0x1E01::SG56360004::INSTR'):
+                pass
+
+        with self.assertRaises(ValueError):
+            run(main())
+
+    def test_executor_fallback(self):
+        async def main():
+            async with AsyncEmulated() as inst:
+                await inst.state.aset('frequency', 5)
+                return await inst.state.aget('frequency')
+
+        self.assertLessEqual(run(main()), 10)
+
+    def test_many_devices(self):
+        count = 20
+        server = FakeSCPIServer(delay=0.2)
+
+        async def main():
+            resource = await server.start()
+            devices = [AsyncMock(resource) for i in range(count)]
+            threads = threading.active_count()
+            async with lb.async_concurrently(*devices):
+                t0 = time.perf_counter()
+                rets = await lb.async_concurrently(**{str(i): d.state.aget('frequency')
+                                                      for i, d in enumerate(devices)})
+                elapsed = time.perf_counter() - t0
+                self.assertEqual(threading.active_count(), threads)
+            self.assertFalse(any([d.state.connected for d in devices]))
+            await server.stop()
+            return rets, elapsed
+
+        rets, elapsed = run(main())
+        self.assertEqual(rets, dict([(str(i), 1e9) for i in range(count)]))
+        self.assertLess(elapsed, 0.2 * count / 4)
+
+
+class TestAsyncConcurrently(unittest.TestCase):
+    @staticmethod
+    async def one():
+        await asyncio.sleep(0.1)
+        return 1
+
+    @staticmethod
+    async def nothing():
+        await asyncio.sleep(0.1)
+
+    @staticmethod
+    async def fail():
+        raise ZeroDivisionError()
+
+    def test_names(self):
+        ret = run(lb.async_concurrently(self.one(), two=self.one(), three=self.nothing()))
+        self.assertEqual(ret, dict(one=1, two=1))
+
+        ret = run(lb.async_concurrently(self.one(), self.nothing(), nones=True))
+        self.assertEqual(ret, dict(one=1, nothing=None))
+
+    def test_concurrent(self):
+        t0 = time.perf_counter()
+        run(lb.async_concurrently(**{str(i): self.one() for i in range(10)}))
+        self.assertLess(time.perf_counter() - t0, 0.5)
+
+    def test_flatten(self):
+        async def values():
+            return dict(a=1, b=2)
+
+        self.assertEqual(run(lb.async_concurrently(values(), self.one())), dict(a=1, b=2, one=1))
+        self.assertEqual(run(lb.async_concurrently(values(), flatten=False)),
+                         dict(values=dict(a=1, b=2)))
+
+    def test_exceptions(self):
+        with self.assertRaises(ZeroDivisionError):
+            run(lb.async_concurrently(self.one(), self.fail()))
+
+        ret = run(lb.async_concurrently(self.one(), self.fail(), catch=True))
+        self.assertEqual(ret, dict(one=1))
+
+    def test_duplicate_names(self):
+        a, b = self.one(), self.one()
+        with self.assertRaises(ValueError):
+            lb.async_concurrently(a, b)
+        a.close()
+        b.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
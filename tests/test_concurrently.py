@@ -25,7 +25,9 @@
 # licenses.
 
 import unittest
+import gc
 import importlib
+import socket
 import threading
 import sys
 import time
@@ -344,6 +346,157 @@ class TestCases(unittest.TestCase):
         self.assertEqual(ret['d1'], dict(a='a'))
         self.assertEqual(ret['d2'], dict(b='b'))
 
+
+class AffineInstrument(LaggyInstrument):
+    class settings(LaggyInstrument.settings):
+        thread_affinity = lb.Bool(True, read_only=True)
+
+    def thread(self):
+        return threading.get_ident()
+
+    def thread2(self):
+        return threading.get_ident()
+
+    def nested(self):
+        return lb.concurrently(n1=self.thread, n2=self.thread2)
+
+    def current_thread(self):
+        return threading.current_thread()
+
+
+class TestThreadPool(unittest.TestCase):
+    @staticmethod
+    def thread():
+        return threading.get_ident()
+
+    def test_reuse(self):
+        def thread2():
+            return threading.get_ident()
+
+        first = lb.concurrently(self.thread, thread2)
+        second = lb.concurrently(self.thread, thread2)
+        self.assertEqual(set(first.values()), set(second.values()))
+        self.assertNotIn(threading.get_ident(), first.values())
+
+    def test_nested(self):
+        def outer1():
+            return lb.concurrently(self.thread, inner=lambda: threading.get_ident())
+
+        def outer2():
+            return lb.concurrently(self.thread, inner=lambda: threading.get_ident())
+
+        ret = lb.concurrently(outer1, outer2, flatten=False)
+        self.assertEqual(len(ret), 2)
+
+    def test_affinity(self):
+        inst1 = AffineInstrument('a')
+        inst2 = AffineInstrument('b')
+        with lb.concurrently(inst1, inst2):
+            first = lb.concurrently(a=inst1.thread, b=inst2.thread)
+            second = lb.concurrently(a=inst1.thread, b=inst2.thread, c=self.thread)
+            self.assertEqual(first['a'], second['a'])
+            self.assertEqual(first['b'], second['b'])
+            self.assertNotEqual(first['a'], first['b'])
+            self.assertNotIn(second['c'], (second['a'], second['b']))
+
+            nested = lb.concurrently(inst1.nested)
+            self.assertEqual(nested, dict(n1=first['a'], n2=first['a']))
+
+    def test_affinity_cleanup(self):
+        inst = AffineInstrument('a')
+        worker = lb.concurrently(inst.current_thread)['current_thread']
+        self.assertTrue(worker.is_alive())
+
+        del inst
+        gc.collect()
+        worker.join(timeout=2)
+        self.assertFalse(worker.is_alive())
+
+
+class BlockingInstrument(LaggyInstrument):
+    def connect(self):
+        super().connect()
+        self.unblock = threading.Event()
+
+    def read(self):
+        # Like a blocking read that only ends when the connection closes
+        self.unblock.wait(10)
+        raise ConnectionAbortedError()
+
+    def __cancel_io__(self):
+        self.unblock.set()
+
+
+class TestCancel(unittest.TestCase):
+    def assert_cancelled(self, func, delay=0.1):
+        token = lb.CancelToken()
+        threading.Timer(delay, token.cancel).start()
+        t0 = time.perf_counter()
+        with self.assertRaises(lb.ThreadEndedByMaster):
+            with token:
+                func()
+        self.assertLess(time.perf_counter() - t0, delay + 0.5)
+
+    def test_sleep(self):
+        self.assert_cancelled(lambda: lb.sleep(10))
+
+    def test_nested(self):
+        def inner():
+            lb.sleep(10)
+
+        def outer():
+            lb.concurrently(inner, other=lambda: lb.sleep(10))
+
+        self.assert_cancelled(lambda: lb.concurrently(outer))
+        self.assert_cancelled(lambda: lb.sequentially(outer))
+
+    def test_scopes(self):
+        def cancelled():
+            self.assert_cancelled(lambda: lb.concurrently(lambda: lb.sleep(10)))
+
+        def finishes():
+            lb.sleep(0.3)
+            return True
+
+        ret = lb.concurrently(cancelled, finishes)
+        self.assertEqual(ret, dict(finishes=True))
+
+    def test_interrupt_io(self):
+        inst = BlockingInstrument('a')
+        with inst:
+            self.assert_cancelled(lambda: lb.concurrently(inst.read))
+
+    def test_cancel_io_bound_only(self):
+        def poll(device):
+            lb.sleep(10)
+
+        inst = BlockingInstrument('a')
+        with inst:
+            self.assert_cancelled(lambda: lb.concurrently(lb.Call(poll, inst)))
+            self.assertFalse(inst.unblock.is_set())
+
+    def test_cancel_io_disconnects(self):
+        with socket.socket() as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            inst = lb.TelnetDevice('127.0.0.1', port=server.getsockname()[1])
+            with inst:
+                inst.__cancel_io__()
+                self.assertFalse(inst.state.connected)
+
+    def test_callbacks(self):
+        token = lb.CancelToken()
+        calls = []
+        with token.on_cancel(lambda: calls.append(1)):
+            pass
+        token.add_callback(lambda: calls.append(2))
+        token.cancel()
+        token.cancel()
+        token.add_callback(lambda: calls.append(3))
+        self.assertEqual(calls, [2, 3])
+        self.assertTrue(lb.CancelToken(parent=token).cancelled())
+
+
 if __name__ == '__main__':
     lb.show_messages('warning')
     unittest.main()
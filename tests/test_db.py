@@ -24,11 +24,17 @@
 # legally bundled with the code in compliance with the conditions of those
 # licenses.
 
+import datetime
 import unittest
+from unittest import mock
 import pandas as pd
 import numpy as np
 import labbench as lb
 import importlib
+import os
+import tempfile
+import time
+import warnings
 
 import sys
 if '..' not in sys.path:
@@ -89,6 +95,734 @@ class TestWrappers(unittest.TestCase):
             self.assertEqual(m.state.param, int_stop)
 
 
+class TestSQLite(unittest.TestCase):
+    def write_batches(self, path, *batches):
+        db = lb.StatesToSQLite(path)
+        db.open()
+        try:
+            for batch in batches:
+                db._write_master([dict(row) for row in batch])
+        finally:
+            db.close()
+
+    def test_write_batches(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.write_batches(path,
+                               [{'a': 1, 'b': 'x'}, {'a': np.int64(2), 'b': 'y'}],
+                               [{'a': 3, 'c': 1.5}])
+            df = lb.read(os.path.join(path, 'master.db'))
+
+            self.assertEqual(list(df.index), [0, 1, 2])
+            self.assertEqual(list(df['a']), [1, 2, 3])
+            self.assertEqual(df['c'].iloc[-1], 1.5)
+            self.assertTrue(pd.isnull(df['c'].iloc[0]))
+
+    def test_reopen_continues_index(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.write_batches(path, [{'a': 1}, {'a': 2}])
+            self.write_batches(path, [{'a': 3}])
+            df = lb.read(os.path.join(path, 'master.db'))
+
+            self.assertEqual(list(df.index), [0, 1, 2])
+
+    def test_schema(self):
+        with tempfile.TemporaryDirectory() as path:
+            db = lb.StatesToSQLite(path)
+            db.open()
+            try:
+                db._write_master([{'a': 1, 'b': 'x'}])
+                db._write_master([{'A': 2, 'c': 1.5}])
+                db._write_master([{'a': 3, 'C': 2.5}])
+            finally:
+                db.close()
+
+            db.open()
+            try:
+                self.assertEqual(db._schema,
+                                 {'id': 'INTEGER', 'a': 'INTEGER',
+                                  'b': 'TEXT', 'c': 'REAL'})
+                self.assertEqual(db.last_index, 3)
+            finally:
+                db.close()
+
+    def test_datetime_roundtrip(self):
+        values = dict(a=np.datetime64('2020-01-01T00:00:00.000000001'),
+                      b=pd.Timestamp('2020-01-02 03:04:05.000000006'),
+                      c=datetime.datetime(2020, 1, 3, 4, 5, 6, 7))
+
+        with tempfile.TemporaryDirectory() as path:
+            with lb.StatesToSQLite(path) as db:
+                db.append(**values)
+                db.append(**values)
+                db.write()
+            df = lb.read(os.path.join(path, 'master.db'))
+
+        for name, value in values.items():
+            self.assertEqual(list(df[name]), 2 * [pd.Timestamp(value)])
+
+    def test_timedelta(self):
+        with tempfile.TemporaryDirectory() as path:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.write_batches(path, [{'a': np.timedelta64(5, 'us')}])
+            df = lb.read(os.path.join(path, 'master.db'))
+
+        self.assertEqual(list(df['a']), [5000])
+
+    def test_async_write(self):
+        with tempfile.TemporaryDirectory() as path:
+            db = lb.StatesToSQLite(path, async_write=True, async_queue_size=1)
+            db.open()
+            db._start_writer()
+            try:
+                for i in range(10):
+                    db.pending = [{'a': i}, {'a': i, 'b': str(i)}]
+                    db.write()
+                db.flush()
+                df = lb.read(os.path.join(path, 'master.db'))
+            finally:
+                db._stop_writer()
+                db.close()
+
+            self.assertEqual(list(df.index), list(range(20)))
+            self.assertEqual(list(df['a']), sorted(2 * list(range(10))))
+
+
+class TestCSV(unittest.TestCase):
+    def write_batches(self, path, *batches):
+        db = lb.StatesToCSV(path)
+        db.open()
+        try:
+            for batch in batches:
+                db._write_master([dict(row) for row in batch])
+        finally:
+            db.close()
+        return db
+
+    def test_new_columns(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'master')
+            self.write_batches(path,
+                               [{'a': 1, 'b': 'x'}, {'a': 2, 'b': 'y'}],
+                               [{'a': 3, 'c': 1.5}],
+                               [{'a': 4, 'b': 'z'}])
+            df = pd.read_csv(path + '.csv')
+
+            self.assertEqual(list(df.columns), ['a', 'b', 'c'])
+            self.assertEqual(list(df['a']), [1, 2, 3, 4])
+            self.assertEqual(df['c'].iloc[2], 1.5)
+            self.assertTrue(pd.isnull(df['c'].iloc[0]))
+            self.assertTrue(pd.isnull(df['b'].iloc[2]))
+
+    def test_overwrite(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'master')
+            self.write_batches(path, [{'a': 1}, {'a': 2}])
+            with lb.StatesToCSV(path, overwrite=True) as db:
+                db.append(a=3)
+            df = pd.read_csv(path + '.csv')
+
+            self.assertEqual(list(df['a']), [3])
+
+    def test_reopen_continues_index(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'master')
+            self.write_batches(path, [{'a': 1}, {'a': 2}])
+            db = self.write_batches(path, [{'a': 3, 'b': 'x'}])
+            df = pd.read_csv(path + '.csv')
+
+            self.assertEqual(db.last_index, 3)
+            self.assertEqual(list(df['a']), [1, 2, 3])
+            self.assertEqual(list(df.columns), ['a', 'b'])
+
+
+class TestNpy(unittest.TestCase):
+    def munge(self, path, **row):
+        munge = lb.data.MungeToDirectory(path, nonscalar_file_type='npy')
+        row = munge(0, dict(row, host_time='2019-10-09 12.00.00'))
+        return {k: os.path.join(path, v) for k, v in row.items()
+                if k != 'host_time'}
+
+    def test_vector(self):
+        with tempfile.TemporaryDirectory() as path:
+            trace = np.linspace(0, 1, 100001)
+            paths = self.munge(path, trace=trace)
+            data = lb.read(paths['trace'])
+
+            self.assertTrue(paths['trace'].endswith('.npy'))
+            self.assertIsInstance(data, np.memmap)
+            np.testing.assert_array_equal(data, trace)
+            del data
+
+    def test_array_state(self):
+        class TraceInstrument(lb.EmulatedVISADevice):
+            class state(lb.EmulatedVISADevice.state):
+                trace = lb.Array(command='TRAC', dtype='float32')
+
+        with tempfile.TemporaryDirectory() as path,\
+                TraceInstrument() as inst,\
+                lb.StatesToCSV(os.path.join(path, 'master'),
+                               nonscalar_file_type='npy') as db:
+            db.observe_states(inst, always=['trace'])
+            row = db.append()
+            trace = row['inst_trace']
+            db.write()
+
+            master = lb.read(os.path.join(path, 'master.csv'))
+            data = lb.read(os.path.join(path, 'master', master['inst_trace'][0]))
+            self.assertEqual(data.dtype, np.float32)
+            np.testing.assert_array_equal(data, trace)
+            del data
+
+    def test_table(self):
+        with tempfile.TemporaryDirectory() as path:
+            table = pd.DataFrame({'frequency': [1., 2., 3.],
+                                  'power': np.array([-1, -2, -3], dtype=int)})
+            paths = self.munge(path, table=table,
+                               columns=dict(a=[1, 2], b=[0.5, 1.5]))
+
+            data = lb.read(paths['table'], columns='power', nrows=2)
+            self.assertEqual(list(data), [-1, -2])
+            del data
+
+            data = lb.read(paths['columns'])
+            self.assertEqual(data.dtype.names, ('a', 'b'))
+            self.assertEqual(list(data['b']), [0.5, 1.5])
+            del data
+
+
+class TestParallelMunge(unittest.TestCase):
+    def write(self, path, **kws):
+        with lb.StatesToSQLite(path, **kws) as db:
+            for i in range(8):
+                db.append(trace=np.arange(i + 1), label=f'row {i}')
+            db.write()
+        return lb.read(os.path.join(path, 'master.db'))
+
+    def check(self, **kws):
+        with tempfile.TemporaryDirectory() as path:
+            df = self.write(path, **kws)
+
+            self.assertEqual(list(df.index), list(range(8)))
+            self.assertEqual(list(df['label']), [f'row {i}' for i in range(8)])
+            for i, relpath in df['trace'].items():
+                self.assertTrue(relpath.startswith(f'{i} '))
+                trace = lb.read(os.path.join(path, relpath))
+                self.assertEqual(list(trace.iloc[:, -1]), list(range(i + 1)))
+
+    def test_threads(self):
+        self.check(munge_workers=4)
+
+    def test_processes(self):
+        self.check(munge_workers=4, munge_pool='process')
+
+
+class TestTar(unittest.TestCase):
+    def write(self, path, start, stop, **kws):
+        with lb.StatesToSQLite(path, tar=True, **kws) as db:
+            for i in range(start, stop):
+                db.append(trace=np.arange(3) + i)
+            db.write()
+
+    def check(self, path, count):
+        df = lb.read_relational(os.path.join(path, 'master.db'), 'trace')
+        expected = [i + j for i in range(count) for j in range(3)]
+        self.assertEqual(list(df['trace_0']), expected)
+
+    def test_append(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.write(path, 0, 3)
+            self.write(path, 3, 5)
+            self.check(path, 5)
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.write(path, 0, 3)
+            self.write(path, 3, 5, tar_index=True)
+            self.assertTrue(os.path.exists(os.path.join(path, 'data.tar.index')))
+
+            reader = lb.data.MungeTarReader(path)
+            traces = [k for k in reader._index if k.endswith('trace.csv')]
+            self.assertEqual(len(traces), 5)
+            self.check(path, 5)
+
+    def test_duplicate(self):
+        with tempfile.TemporaryDirectory() as path:
+            munge = lb.data.MungeToTar(path)
+            with munge:
+                munge._open_relational('a.txt', 0, {'host_time': 't'}).close()
+                with self.assertRaises(IOError):
+                    munge._open_relational('a.txt', 0, {'host_time': 't'}).close()
+
+
+class TestCompression(unittest.TestCase):
+    def check(self, codec, **kws):
+        with tempfile.TemporaryDirectory() as path:
+            with lb.StatesToSQLite(path, compression=codec, **kws) as db:
+                for i in range(3):
+                    db.append(trace=np.arange(3) + i, log='x' * 2000)
+                db.write()
+
+            master = lb.read(os.path.join(path, 'master.db'))
+            suffix = lb.data.compression_suffixes[codec]
+            self.assertTrue(master['trace'].str.endswith('.csv' + suffix).all())
+            self.assertTrue(master['log'].str.endswith('.txt' + suffix).all())
+
+            df = lb.read_relational(os.path.join(path, 'master.db'), 'trace')
+            expected = [i + j for i in range(3) for j in range(3)]
+            self.assertEqual(list(df['trace_0']), expected)
+
+    def test_lz4(self):
+        self.check('lz4')
+
+    def test_zstd(self):
+        self.check('zstd')
+
+    def test_zstd_tar(self):
+        self.check('zstd', tar=True)
+
+    def test_text(self):
+        with tempfile.TemporaryDirectory() as path:
+            with lb.StatesToSQLite(path, compression='lz4') as db:
+                db.append(log='x' * 2000)
+                db.write()
+            relpath = lb.read(os.path.join(path, 'master.db'))['log'].iloc[0]
+
+            import pyarrow as pa
+            with pa.CompressedInputStream(pa.OSFile(os.path.join(path, relpath)), 'lz4') as f:
+                self.assertEqual(f.read(), b'x' * 2000)
+
+
+class TestReadRelational(unittest.TestCase):
+    def test_expand(self):
+        with tempfile.TemporaryDirectory() as path:
+            with lb.StatesToSQLite(path) as db:
+                db.append(trace=np.arange(2), label='a', value=1.5)
+                db.append(trace=[], label='skip', value=2.5)
+                db.append(trace=np.arange(3) + 10, label='b', value=3.5)
+                db.write()
+
+            df = lb.read_relational(os.path.join(path, 'master.db'), 'trace',
+                                    master_cols=['label', 'value'])
+
+            self.assertEqual(list(df.columns), sorted(df.columns))
+            self.assertEqual(list(df['trace_0']), [0, 1, 10, 11, 12])
+            self.assertEqual(list(df['trace_id']), [0, 1, 0, 1, 2])
+            self.assertEqual(list(df['label']), ['a', 'a', 'b', 'b', 'b'])
+            self.assertEqual(list(df['value']), [1.5, 1.5, 3.5, 3.5, 3.5])
+            self.assertEqual(list(df.index), list(range(5)))
+
+    def write(self, path, count, **kws):
+        with lb.StatesToSQLite(path, **kws) as db:
+            for i in range(count):
+                db.append(trace=np.arange(i % 4 + 1) + i, label=f'row {i}')
+            db.write()
+        return os.path.join(path, 'master.db')
+
+    def test_workers(self):
+        for tar in False, True:
+            with tempfile.TemporaryDirectory() as path:
+                master_path = self.write(path, 20, tar=tar)
+                expected = lb.read_relational(master_path, 'trace')
+                df = lb.read_relational(master_path, 'trace', workers=4)
+
+                pd.testing.assert_frame_equal(df, expected)
+
+    def test_master_filters(self):
+        with tempfile.TemporaryDirectory() as path:
+            with lb.StatesToParquet(path) as db:
+                for i in range(4):
+                    db.append(trace=np.arange(2) + i, label=f'row {i}')
+                db.write()
+
+            df = lb.read_relational(os.path.join(path, 'master.parquet'), 'trace',
+                                    master_filters=[('label', '==', 'row 2')])
+            self.assertEqual(list(df['trace_0']), [2, 3])
+            self.assertEqual(set(df['label']), {'row 2'})
+
+        with tempfile.TemporaryDirectory() as path:
+            master_path = self.write(path, 4)
+            with self.assertRaises(ValueError):
+                lb.read_relational(master_path, 'trace',
+                                   master_filters=[('label', '==', 'row 2')])
+
+    def test_cache(self):
+        for tar in False, True:
+            with tempfile.TemporaryDirectory() as path:
+                master_path = self.write(path, 5, tar=tar)
+                cache = lb.ReaderCache()
+                expected = lb.read_relational(master_path, 'trace')
+
+                df = lb.read_relational(master_path, 'trace', cache=cache)
+                self.assertEqual((cache.hits, cache.misses), (0, 5))
+                df = lb.read_relational(master_path, 'trace', cache=cache)
+                self.assertEqual((cache.hits, cache.misses), (5, 5))
+                pd.testing.assert_frame_equal(df, expected)
+
+    def test_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as path:
+            with lb.StatesToSQLite(path) as db:
+                for i in range(3):
+                    db.append(trace=np.arange(10) + i)
+                db.write()
+            master_path = os.path.join(path, 'master.db')
+            relpaths = lb.read(master_path)['trace']
+            size = lb.ReaderCache._sizeof(lb.read(os.path.join(path, relpaths[0])))
+
+            cache = lb.ReaderCache(maxsize=2 * size)
+            reader = lb.data.MungeReader(master_path, cache=cache)
+            for relpath in relpaths:
+                reader(relpath)
+            reader(relpaths[2])
+            reader(relpaths[0])
+
+            # the first table was evicted by the third
+            self.assertEqual((cache.hits, cache.misses), (1, 4))
+            self.assertEqual(cache.size, 2 * size)
+
+    def test_cache_memmap(self):
+        with tempfile.TemporaryDirectory() as path:
+            munge = lb.data.MungeToDirectory(path, nonscalar_file_type='npy')
+            relpaths = [munge(i, dict(trace=np.arange(100000.) + i,
+                                      host_time='2019-10-09 12.00.00'))['trace']
+                        for i in range(3)]
+
+            cache = lb.ReaderCache(maxsize=1e6)
+            reader = lb.data.MungeReader(os.path.join(path, 'master.db'), cache=cache)
+            for relpath in relpaths:
+                self.assertIsInstance(reader(relpath), np.memmap)
+            for relpath in relpaths:
+                reader(relpath)
+
+            # each 800 kB trace is mapped, so all of them stay cached
+            self.assertEqual((cache.hits, cache.misses), (3, 3))
+            self.assertEqual(cache.size, 3 * lb.ReaderCache.memmap_size)
+            cache.clear()
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as path:
+            master_path = self.write(path, 5)
+            cache_path = os.path.join(path, 'cache')
+            expected = lb.read_relational(master_path, 'trace',
+                                          cache=lb.ReaderCache(path=cache_path))
+
+            cache = lb.ReaderCache(path=cache_path)
+            df = lb.read_relational(master_path, 'trace', cache=cache)
+            self.assertEqual(cache.disk_hits, 5)
+            pd.testing.assert_frame_equal(df, expected)
+
+    def test_lazy(self):
+        with tempfile.TemporaryDirectory() as path:
+            master_path = self.write(path, 20)
+            expected = lb.read_relational(master_path, 'trace')
+            chunks = list(lb.read_relational(master_path, 'trace', lazy=True,
+                                             chunksize=6, workers=2))
+
+            self.assertEqual(len(chunks), 4)
+            self.assertEqual(list(chunks[0]['label'].unique()),
+                             [f'row {i}' for i in range(6)])
+            df = pd.concat(chunks, ignore_index=True)
+            pd.testing.assert_frame_equal(df, expected)
+
+
+class TestQuery(unittest.TestCase):
+    rows = [{'dut': 'DUT1', 'freq': 1e9, 'host_time': 't0'},
+            {'dut': 'DUT2', 'freq': 2e9, 'host_time': 't1'},
+            {'dut': 'DUT1', 'freq': 3e9, 'host_time': 't2'},
+            {'dut': 'DUT3', 'freq': None, 'host_time': 't3'}]
+
+    def write(self, path, cls, **kws):
+        db = cls(path, **kws)
+        db.open()
+        try:
+            db._write_master([dict(row) for row in self.rows])
+        finally:
+            db.close()
+
+    def check(self, master_path):
+        df = lb.query(master_path, where={'dut': 'DUT1'}, columns=['freq'])
+        self.assertEqual(list(df.columns), ['freq'])
+        self.assertEqual(list(df.index), [0, 2])
+        self.assertEqual(list(df['freq']), [1e9, 3e9])
+
+        df = lb.query(master_path, where=[('freq', '>', 1.5e9),
+                                          ('dut', 'in', ['DUT1', 'DUT2'])],
+                      order_by='id')
+        self.assertEqual(list(df['dut']), ['DUT2', 'DUT1'])
+
+        df = lb.query(master_path, where={'dut': ['DUT2', 'DUT3']}, limit=1,
+                      order_by='id')
+        self.assertEqual(list(df.index), [1])
+
+        df = lb.query(master_path, where={'dut': ['DUT1', 'DUT2']},
+                      order_by='freq', limit=2)
+        self.assertEqual(list(df['freq']), [1e9, 2e9])
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.write(path, lb.StatesToSQLite, index_columns=['host_time', 'dut'])
+            master_path = os.path.join(path, 'master.db')
+            self.check(master_path)
+
+            df = lb.query(master_path, where='freq is null or freq < ?',
+                          params=(1.5e9,))
+            self.assertEqual(list(df['dut']), ['DUT1', 'DUT3'])
+
+            import sqlite3
+            with sqlite3.connect(master_path) as connection:
+                indexes = {r[1] for r in connection.execute('pragma index_list(master)')}
+            self.assertEqual(indexes, {'ix_master_id', 'ix_master_host_time',
+                                       'ix_master_dut'})
+
+            # a limited query on an indexed column uses its index, not the id
+            with sqlite3.connect(master_path) as connection:
+                plan = ' '.join(str(r[-1]) for r in connection.execute(
+                    'explain query plan select * from master where "dut" = ? limit 1',
+                    ('DUT1',)))
+            self.assertIn('ix_master_dut', plan)
+
+    def test_sqlite_missing_index_col(self):
+        with tempfile.TemporaryDirectory() as path:
+            master_path = os.path.join(path, 'master.db')
+            import sqlite3
+            with sqlite3.connect(master_path) as connection:
+                pd.DataFrame(self.rows).to_sql('master', connection, index=False)
+
+            df = lb.query(master_path, where={'dut': 'DUT1'}, columns=['freq'])
+            self.assertEqual(list(df.columns), ['freq'])
+            self.assertEqual(list(df['freq']), [1e9, 3e9])
+
+    def test_parquet(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.write(path, lb.StatesToParquet)
+            self.check(os.path.join(path, 'master.parquet'))
+
+
+class TestChunks(unittest.TestCase):
+    df = pd.DataFrame({'a': np.arange(10), 'b': np.arange(10) * 0.5})
+
+    def check(self, path, **kws):
+        chunks = list(lb.read(path, chunksize=4, **kws))
+        self.assertEqual([len(c) for c in chunks], [4, 4, 2])
+        self.assertEqual(list(pd.concat(chunks)['b']), list(self.df['b']))
+
+        chunks = list(lb.read(path, chunksize=4, nrows=5, columns=['b'], **kws))
+        self.assertEqual([len(c) for c in chunks], [4, 1])
+        self.assertEqual(list(chunks[0].columns), ['b'])
+
+    def test_csv(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'data.csv')
+            self.df.to_csv(path, index=False)
+            self.check(path)
+
+    def test_feather(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'data.feather')
+            self.df.to_feather(path)
+            self.check(path)
+
+    def test_json(self):
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'data.json')
+            self.df.to_json(path)
+            self.check(path)
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as path:
+            db = lb.StatesToSQLite(path)
+            db.open()
+            db._write_master(self.df.to_dict('records'))
+            db.close()
+            self.check(os.path.join(path, 'master.db'))
+
+    def test_parquet(self):
+        with tempfile.TemporaryDirectory() as path:
+            db = lb.StatesToParquet(path)
+            db.open()
+            db._write_master(self.df.to_dict('records'))
+            db.close()
+            self.check(os.path.join(path, 'master.parquet'))
+
+
+class ListDevice(lb.Device):
+    class settings(lb.Device.settings):
+        values = lb.List()
+
+
+class BufferDevice(lb.Device):
+    buffer = np.zeros(4)
+
+    trace = lb.Array()
+
+    @trace.getter
+    def _(self):
+        # Like query_binary(into=...), fill and return the same array each time
+        return self.buffer
+
+
+class TestAppend(unittest.TestCase):
+    def test_copy_buffer(self):
+        with tempfile.TemporaryDirectory() as path,\
+                BufferDevice() as dev,\
+                lb.StatesToCSV(os.path.join(path, 'master')) as db:
+            db.observe_states(dev, always=['trace'])
+
+            dev.buffer[:] = 1
+            first = db.append(copy=True)
+            dev.buffer[:] = 2
+            second = db.append(copy=True)
+
+            np.testing.assert_array_equal(first['dev_trace'], np.ones(4))
+            np.testing.assert_array_equal(second['dev_trace'], 2 * np.ones(4))
+
+    def test_copy(self):
+        with tempfile.TemporaryDirectory() as path,\
+                ListDevice() as dev,\
+                lb.StatesToCSV(os.path.join(path, 'master')) as db:
+            db.observe_settings(dev)
+
+            data = [1, 2]
+            dev.settings.values = data
+            first = db.append(copy=True)
+            second = db.append(copy=True)
+            data.append(3)
+            third = db.append(copy=True, other=data)
+            data.append(4)
+
+            self.assertEqual(first['dev_values'], [1, 2])
+            # unchanged states are shared between rows, not copied again
+            self.assertIs(second['dev_values'], first['dev_values'])
+            self.assertEqual(third['other'], [1, 2, 3])
+
+            dev.settings.values = [5]
+            fourth = db.append(copy=True)
+            self.assertEqual(fourth['dev_values'], [5])
+            self.assertEqual(first['dev_values'], [1, 2])
+
+    def test_no_copy(self):
+        with tempfile.TemporaryDirectory() as path,\
+                ListDevice() as dev,\
+                lb.StatesToCSV(os.path.join(path, 'master')) as db:
+            db.observe_settings(dev)
+
+            dev.settings.values = [1, 2]
+            row = db.append(other=3)
+            row['other'] = 4
+
+            self.assertEqual(row['dev_values'], [1, 2])
+            self.assertEqual(db.get()['dev_values'], [1, 2])
+            self.assertNotIn('other', db.get())
+
+
+class TestObservePlan(unittest.TestCase):
+    def test_missing_trait(self):
+        with tempfile.TemporaryDirectory() as path,\
+                ListDevice() as dev,\
+                lb.StatesToCSV(os.path.join(path, 'master')) as db:
+            with self.assertRaises(Exception):
+                db.observe_settings(dev, always=['missing'])
+
+    def test_relabel(self):
+        with tempfile.TemporaryDirectory() as path,\
+                ListDevice() as dev,\
+                lb.StatesToCSV(os.path.join(path, 'master')) as db:
+            dev.settings.values = [1]
+            db.observe_settings(dev, always=['values'], never=['resource'])
+            self.assertEqual(db.get()['dev_values'], [1])
+
+            db.set_device_labels(other=dev)
+            row = db.get()
+            self.assertEqual(row['other_values'], [1])
+            self.assertNotIn('other_resource', row)
+
+
+class SlowDevice(lb.Device):
+    class state(lb.Device.state):
+        delay = lb.Float(0.2, command=True)
+
+    @state.getter
+    def _(self, trait):
+        time.sleep(0.2)
+        return 0.2
+
+
+class TestConcurrentPolls(unittest.TestCase):
+    def poll(self, **kws):
+        with tempfile.TemporaryDirectory() as path,\
+                SlowDevice(resource='a') as a,\
+                SlowDevice(resource='b') as b,\
+                SlowDevice(resource='c') as c,\
+                lb.StatesToCSV(os.path.join(path, 'master'), **kws) as db:
+            db.name.update({a: 'a', b: 'b', c: 'c'})
+            for dev in (a, b, c):
+                db.observe_states(dev, always=['delay'])
+
+            t0 = time.perf_counter()
+            row = db.get()
+            elapsed = time.perf_counter() - t0
+
+            for name in 'abc':
+                self.assertEqual(row[f'{name}_delay'], 0.2)
+                self.assertGreaterEqual(db.poll_latency[name], 0.2)
+            return elapsed
+
+    def test_concurrent(self):
+        self.assertLess(self.poll(concurrent_polls=True), 0.5)
+
+    def test_sequential(self):
+        self.assertGreaterEqual(self.poll(concurrent_polls=False), 0.6)
+
+    def test_sequential_by_default(self):
+        self.assertGreaterEqual(self.poll(), 0.6)
+
+
+class TestParquet(unittest.TestCase):
+    def write_batches(self, path, *batches):
+        db = lb.StatesToParquet(path)
+        db.open()
+        try:
+            for batch in batches:
+                db._write_master([dict(row) for row in batch])
+        finally:
+            db.close()
+
+    def test_write_batches(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.write_batches(path,
+                               [{'a': 1, 'b': None}, {'a': 2, 'b': None}],
+                               [{'a': 3.5, 'b': 'x', 'c': 'DUT1'}])
+            self.write_batches(path, [{'a': 4, 'c': 'DUT2'}])
+            df = lb.read(os.path.join(path, 'master.parquet'))
+
+            self.assertEqual(list(df.index), [0, 1, 2, 3])
+            self.assertEqual(list(df['a']), [1., 2., 3.5, 4.])
+            self.assertEqual(df['b'].iloc[2], 'x')
+            self.assertEqual(list(df['c'].iloc[2:]), ['DUT1', 'DUT2'])
+
+    def test_read_directory_size(self):
+        # on windows, the size of a directory is 0
+        getsize = os.path.getsize
+        with tempfile.TemporaryDirectory() as path:
+            self.write_batches(path, [{'a': 1}, {'a': 2}])
+            master_path = os.path.join(path, 'master.parquet')
+            with mock.patch('os.path.getsize',
+                            lambda p: 0 if os.path.isdir(p) else getsize(p)):
+                df = lb.read(master_path)
+            self.assertEqual(list(df['a']), [1, 2])
+
+    def test_read_filters(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.write_batches(path,
+                               [{'a': i, 'dut': f'DUT{i % 3}'} for i in range(10)],
+                               [{'a': i, 'dut': f'DUT{i % 3}'} for i in range(10, 20)])
+            df = lb.read(os.path.join(path, 'master.parquet'), columns=['a'],
+                         filters=[('dut', '==', 'DUT1')])
+
+            self.assertEqual(list(df.columns), ['a'])
+            self.assertEqual(list(df['a']), list(range(1, 20, 3)))
+
+
 if __name__ == '__main__':
 
     path = 'test'
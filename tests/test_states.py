@@ -24,9 +24,13 @@
 # legally bundled with the code in compliance with the conditions of those
 # licenses.
 
+import numpy as np
 import unittest
 import importlib
 import sys
+import threading
+import time
+import traitlets
 if '..' not in sys.path:
     sys.path.insert(0, '..')
 import labbench as lb
@@ -169,8 +173,317 @@ class TestWrappers(unittest.TestCase):
         self.assertEqual(m.state.flag, stop['flag'])
         self.assertEqual(m.values['flag'], remap[stop['flag']])
         
-        self.assertEqual(m._getter_counts['flag'], 4)
-        self.assertEqual(m._getter_counts['param'], 4)
+        # one query for each get, and none for each set
+        self.assertEqual(m._getter_counts['flag'], 2)
+        self.assertEqual(m._getter_counts['param'], 2)
+
+    def test_observed(self):
+        with MockStateWrapper() as m:
+            changes = []
+            m.state.param = 3
+            self.assertEqual(m.state.param, 3)
+
+            m.state.observe(changes.append)
+            m.state.param = 4
+            m.values['param'] = 5
+            self.assertEqual(m.state.param, 5)
+            self.assertEqual([c['new'] for c in changes], [4, 5])
+
+            m.state.unobserve(changes.append)
+            m.state.param = 6
+            self.assertEqual(m.state.param, 6)
+            self.assertEqual(len(changes), 2)
+
+    def test_observed_after_unobserve(self):
+        with MockStateWrapper() as m:
+            trait = m.state.traits()['param']
+            self.assertFalse(trait._observed(m.state))
+
+            def observer(change):
+                pass
+
+            m.state.observe(observer)
+            self.assertTrue(trait._observed(m.state))
+            m.state.unobserve(observer)
+            self.assertFalse(trait._observed(m.state))
+
+            m.state.observe(observer, names=['param'])
+            self.assertTrue(trait._observed(m.state))
+            m.state.unobserve(observer, names=['param'])
+            self.assertFalse(trait._observed(m.state))
+
+    def test_validate(self):
+        with MockStateWrapper() as m:
+            with self.assertRaises(traitlets.TraitError):
+                m.state.param = 11
+
+            m.values['param'] = '7'
+            self.assertEqual(m.state.param, 7)
+
+            m.values['param'] = 11
+            with self.assertRaises(traitlets.TraitError):
+                m.state.param
+
+class MockCached(lb.Device):
+    class state(lb.Device.state):
+        level = lb.Float(command=True, cache_ttl=0.2, depends=['atten'])
+        atten = lb.Float(command=True)
+        span = lb.Float(command=True)
+
+    def connect(self):
+        self.values = dict(level=0., atten=0., span=0.)
+        self.queries = []
+
+    def __get_state__(self, trait):
+        self.queries.append(trait.name)
+        return self.values[trait.name]
+
+    def __set_state__(self, trait, value):
+        self.values[trait.name] = value
+
+
+class TestCache(unittest.TestCase):
+    def test_ttl(self):
+        with MockCached() as m:
+            m.state.level
+            m.values['level'] = 1.
+            self.assertEqual(m.state.level, 0.)
+            time.sleep(0.25)
+            self.assertEqual(m.state.level, 1.)
+            self.assertEqual(m.queries, ['level', 'level'])
+            self.assertEqual(m.state.cache_stats()['level'],
+                             {'hits': 1, 'misses': 2})
+
+    def test_depends(self):
+        with MockCached() as m:
+            m.state.level
+            m.values['level'] = 1.
+            m.state.atten = 10.
+            self.assertEqual(m.state.level, 1.)
+            self.assertEqual(m.queries, ['level', 'level'])
+
+    def test_coherent(self):
+        with MockCached(coherent_cache=True) as m:
+            m.state.span = 5.
+            self.assertEqual(m.state.span, 5.)
+            self.assertEqual(m.queries, [])
+
+            m.state.clear_cache('span')
+            m.values['span'] = 6.
+            self.assertEqual(m.state.span, 6.)
+            self.assertEqual(m.state.span, 6.)
+            self.assertEqual(m.queries, ['span'])
+
+    def test_not_coherent(self):
+        with MockCached() as m:
+            m.state.span = 5.
+            m.state.span
+            self.assertEqual(m.queries, ['span'])
+            self.assertNotIn('span', m.state.cache_stats())
+
+    def test_disconnect(self):
+        m = MockCached(coherent_cache=True)
+        with m:
+            m.state.span = 5.
+        with m:
+            m.values['span'] = 6.
+            self.assertEqual(m.state.span, 6.)
+
+
+class FakeVISABackend(object):
+    def __init__(self, replies={}):
+        self.replies = replies
+        self.messages = []
+        self.pending = []
+        self.max_pending = 0
+
+    def write(self, msg):
+        self.messages.append(msg)
+        if isinstance(self.replies.get(msg), bytes):
+            self.raw = bytearray(self.replies[msg])
+        elif msg.endswith('?'):
+            self.pending.append(self.replies[msg])
+            self.max_pending = max(self.max_pending, len(self.pending))
+
+    def write_raw(self, msg):
+        self.messages.append(msg)
+
+    def read_bytes(self, count):
+        ret, self.raw = bytes(self.raw[:count]), self.raw[count:]
+        return ret
+
+    def read_raw(self):
+        return self.read_bytes(self.raw.index(b'\n') + 1)
+
+    def read(self):
+        time.sleep(0.01)
+        return self.pending.pop(0)
+
+    def query(self, msg):
+        self.write(msg)
+        return self.read()
+
+
+class MockVISA(lb.VISADevice):
+    @classmethod
+    def __imports__(cls):
+        pass
+
+    class state(lb.VISADevice.state):
+        frequency = lb.Float(command='SENS:FREQ', min=0)
+        span = lb.Float(command='SPAN', min=0, max=1e9)
+        output = lb.Bool(command='OUTP', remap={False: 'OFF', True: 'ON'})
+        label = lb.Unicode()
+        trace = lb.Array(command='TRAC', dtype='<f4')
+
+    @state.label.getter
+    def _(self):
+        return self.backend.query('LAB?')
+
+    @state.label.setter
+    def _(self, value):
+        self.backend.write('LAB ' + value)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.dev = MockVISA()
+        self.dev.backend = FakeVISABackend({'SENS:FREQ?;:SPAN?;:OUTP?': '1e9;2e6;ON\n',
+                                            'LAB?': 'a'})
+
+    def tearDown(self):
+        self.dev.backend = lb.core.DisconnectedBackend(self.dev)
+
+    def test_update(self):
+        self.dev.state.update(frequency=1e9, label='a', span=2e6, output=True)
+        self.assertEqual(self.dev.backend.messages,
+                         ['SENS:FREQ 1000000000.0', 'LAB a', 'SPAN 2000000.0;:OUTP ON'])
+        self.assertEqual(self.dev.state._trait_values['output'], True)
+
+    def test_validate_first(self):
+        with self.assertRaises(traitlets.TraitError):
+            self.dev.state.update(frequency=1e9, span=2e9)
+        self.assertEqual(self.dev.backend.messages, [])
+
+    def test_batch(self):
+        changes = []
+        self.dev.state.observe(changes.append)
+        with self.dev.state.batch():
+            self.dev.state.frequency = 1e9
+            self.dev.state.span = 2e6
+            self.assertEqual(self.dev.backend.messages, [])
+        self.assertEqual(self.dev.backend.messages, ['SENS:FREQ 1000000000.0;:SPAN 2000000.0'])
+        self.assertEqual([c['name'] for c in changes], ['frequency', 'span'])
+
+    def test_get_many(self):
+        values = self.dev.state.get_many(['frequency', 'span', 'label', 'output'])
+        self.assertEqual(values, dict(frequency=1e9, span=2e6, label='a', output=True))
+        self.assertEqual(self.dev.backend.messages, ['SENS:FREQ?;:SPAN?;:OUTP?', 'LAB?'])
+
+
+class TestQueryAsync(unittest.TestCase):
+    def setUp(self):
+        self.dev = MockVISA(async_depth=3)
+        replies = dict([(f'TRAC{i}?', str(i)) for i in range(10)], **{'*OPC?': '1'})
+        self.dev.backend = FakeVISABackend(replies)
+
+    def tearDown(self):
+        self.dev._VISADevice__stop_io_worker()
+        self.dev.backend = lb.core.DisconnectedBackend(self.dev)
+
+    def test_order(self):
+        futures = [self.dev.query_async(f'TRAC{i}?') for i in range(10)]
+        self.assertEqual([f.result() for f in futures], [str(i) for i in range(10)])
+        self.assertLessEqual(self.dev.backend.max_pending, 3)
+        self.assertGreater(self.dev.backend.max_pending, 1)
+
+    def test_one_worker(self):
+        barrier = threading.Barrier(8)
+
+        def first_query(i):
+            barrier.wait()
+            return self.dev.query_async(f'TRAC{i}?')
+
+        futures = lb.concurrently(**{str(i): lb.Call(first_query, i) for i in range(8)})
+        self.assertEqual(sorted([f.result() for f in futures.values()]),
+                         [str(i) for i in range(8)])
+        workers = [t for t in threading.enumerate() if t.name == f'{self.dev} I/O']
+        self.assertEqual(len(workers), 1)
+
+    def test_reset_clears_cache(self):
+        writing, release = threading.Event(), threading.Event()
+        write = self.dev.backend.write
+
+        def blocking_write(msg):
+            writing.set()
+            release.wait(2)
+            write(msg)
+
+        self.dev.backend.write = blocking_write
+        self.dev.backend.replies['*RST;*OPC?'] = '1'
+        future = self.dev.query_async('*RST;*OPC?')
+        writing.wait(2)
+
+        # A cached get before the write finishes
+        self.dev.state._cache['identity'] = ('before reset', time.perf_counter())
+        release.set()
+        self.assertEqual(future.result(), '1')
+        self.assertNotIn('identity', self.dev.state._cache)
+
+    def test_then_query(self):
+        future = self.dev.query_async('TRAC1?')
+        self.assertEqual(self.dev.query('TRAC2?'), '2')
+        self.assertTrue(future.done())
+        self.assertEqual(self.dev.backend.messages, ['TRAC1?', 'TRAC2?'])
+
+    def test_overlap_and_block(self):
+        with self.dev.overlap_and_block():
+            futures = [self.dev.query_async(f'TRAC{i}?') for i in range(3)]
+        self.assertTrue(all([f.done() for f in futures]))
+        self.assertEqual(self.dev.backend.messages,
+                         ['TRAC0?', 'TRAC1?', 'TRAC2?', '*OPC?'])
+
+
+class TestBinary(unittest.TestCase):
+    def setUp(self):
+        self.trace = np.arange(1000, dtype='<f4')
+        data = self.trace.tobytes()
+        self.dev = MockVISA()
+        self.dev.backend = FakeVISABackend({'TRAC?': b'#44000' + data + b'\n',
+                                            'TRAC0?': b'#0' + np.ones(100, dtype='<f4').tobytes() + b'\n',
+                                            'BAD?': b'1,2,3\n'})
+
+    def tearDown(self):
+        self.dev.backend = lb.core.DisconnectedBackend(self.dev)
+
+    def test_definite(self):
+        values = self.dev.query_binary('TRAC?', '<f4')
+        np.testing.assert_array_equal(values, self.trace)
+        self.assertEqual(len(self.dev.backend.raw), 0)
+
+    def test_indefinite(self):
+        values = self.dev.query_binary('TRAC0?', '<f4')
+        np.testing.assert_array_equal(values, np.ones(100))
+
+    def test_into(self):
+        buf = np.zeros(2000, dtype='<f4')
+        values = self.dev.query_binary('TRAC?', '<f4', into=buf)
+        self.assertIs(values.base, buf)
+        np.testing.assert_array_equal(buf[:1000], self.trace)
+
+        with self.assertRaises(ValueError):
+            self.dev.query_binary('TRAC?', '<f4', into=np.zeros(10, dtype='<f4'))
+
+    def test_not_binary(self):
+        with self.assertRaises(ValueError):
+            self.dev.query_binary('BAD?', '<f4')
+
+    def test_trait(self):
+        np.testing.assert_array_equal(self.dev.state.trace, self.trace)
+        self.dev.state.trace = [1, 2]
+        self.assertEqual(self.dev.backend.messages[-1],
+                         b'TRAC #18' + np.array([1, 2], dtype='<f4').tobytes() + b'\n')
+
 
 if __name__ == '__main__':
     lb.show_messages('debug')